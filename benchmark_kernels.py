@@ -0,0 +1,361 @@
+"""
+Micro-benchmarks for the hot functions in the exercise_code packages.
+
+Every kernel is timed for each combination of the shape parameters it uses
+and reported with time per call, GFLOP/s (for kernels with a meaningful flop
+count; the counts of the elementwise and normalization kernels are estimates)
+and the peak memory allocated during one call, as seen by tracemalloc.
+Results can be written to json and compared against a stored baseline, so a
+kernel optimisation can be shipped together with its numbers.
+
+Like benchmark_tasks.py, every exercise is benchmarked in its own python
+process because they all ship a package called exercise_code.
+
+Example usage:
+
+python benchmark_kernels.py --output baseline.json
+python benchmark_kernels.py --baseline baseline.json --output after.json
+python benchmark_kernels.py --exercises exercise_2 --kernels batchnorm --N 64 256 1024
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SHAPE = {
+    'N': [100],  # batch size
+    'D': [3072],  # input features
+    'M': [512],  # hidden units
+    'C': [10],  # classes for losses, channels for the convolutional kernels
+    'H': [32],  # image height
+    'W': [32],  # image width
+    'K': [3],  # kernel size of the convolution
+    'F': [16],  # number of filters of the convolution
+}
+
+
+def _exercise_1_kernels():
+    from exercise_code.classifiers import softmax
+    from exercise_code.features import hog_feature, color_histogram_hsv, extract_features
+
+    def loss(fn):
+        def setup(N, D, C):
+            rng = np.random.RandomState(0)
+            W = 0.001 * rng.randn(D, C)
+            X = rng.randn(N, D)
+            y = rng.randint(C, size=N)
+            return lambda: fn(W, X, y, 0.1)
+        return setup
+
+    def image(H, W):
+        return np.random.RandomState(0).uniform(0, 255, size=(H, W, 3))
+
+    def hog_setup(H, W):
+        im = image(H, W)
+        return lambda: hog_feature(im)
+
+    def histogram_setup(H, W):
+        im = image(H, W)
+        return lambda: color_histogram_hsv(im, nbin=10)
+
+    def extract_setup(N, H, W):
+        imgs = np.random.RandomState(0).uniform(0, 255, size=(N, H, W, 3))
+        feature_fns = [hog_feature, lambda img: color_histogram_hsv(img, nbin=10)]
+        return lambda: extract_features(imgs, feature_fns)
+
+    return [
+        ('cross_entropoy_loss_naive', loss(softmax.cross_entropoy_loss_naive), lambda N, D, C: 4 * N * D * C),
+        ('cross_entropoy_loss_vectorized', loss(softmax.cross_entropoy_loss_vectorized), lambda N, D, C: 4 * N * D * C),
+        ('hog_feature', hog_setup, None),
+        ('color_histogram_hsv', histogram_setup, None),
+        ('extract_features', extract_setup, None),
+    ]
+
+
+def _exercise_2_kernels():
+    from exercise_code import layers, optim
+
+    def forward_backward(forward, backward, make_inputs):
+        """
+        Returns setup functions for a layer's forward pass and for its backward
+        pass, which is timed on the cache of a single forward pass.
+        """
+        def forward_setup(N, M):
+            args = make_inputs(np.random.RandomState(0), N, M)
+            return lambda: forward(*args)
+
+        def backward_setup(N, M):
+            rng = np.random.RandomState(0)
+            out, cache = forward(*make_inputs(rng, N, M))
+            dout = rng.randn(*out.shape)
+            # Backward passes may update dout in place, so time them on a copy
+            return lambda: backward(dout.copy(), cache)
+
+        return forward_setup, backward_setup
+
+    def affine_inputs(rng, N, D, M):
+        return rng.randn(N, D), 0.01 * rng.randn(D, M), np.zeros(M)
+
+    def affine_forward_setup(N, D, M):
+        args = affine_inputs(np.random.RandomState(0), N, D, M)
+        return lambda: layers.affine_forward(*args)
+
+    def affine_backward_setup(N, D, M):
+        rng = np.random.RandomState(0)
+        out, cache = layers.affine_forward(*affine_inputs(rng, N, D, M))
+        dout = rng.randn(*out.shape)
+        return lambda: layers.affine_backward(dout, cache)
+
+    relu_forward, relu_backward = forward_backward(
+        layers.relu_forward, layers.relu_backward, lambda rng, N, M: (rng.randn(N, M),))
+    batchnorm_forward, batchnorm_backward = forward_backward(
+        layers.batchnorm_forward, layers.batchnorm_backward,
+        lambda rng, N, M: (rng.randn(N, M), np.ones(M), np.zeros(M), {'mode': 'train'}))
+    dropout_forward, dropout_backward = forward_backward(
+        layers.dropout_forward, layers.dropout_backward,
+        lambda rng, N, M: (rng.randn(N, M), {'mode': 'train', 'p': 0.5, 'seed': 0}))
+
+    def softmax_loss_setup(N, C):
+        rng = np.random.RandomState(0)
+        x = rng.randn(N, C)
+        y = rng.randint(C, size=N)
+        return lambda: layers.softmax_loss(x, y)
+
+    def update_rule(rule, config):
+        def setup(D, M):
+            rng = np.random.RandomState(0)
+            w = rng.randn(D, M)
+            dw = rng.randn(D, M)
+            state = dict(config)
+            # Let the rule create its state before timing it
+            w, state = rule(w, dw, state)
+
+            def run():
+                next_w, _ = rule(w, dw, state)
+                return next_w
+            return run
+        return setup
+
+    return [
+        ('affine_forward', affine_forward_setup, lambda N, D, M: 2 * N * D * M),
+        ('affine_backward', affine_backward_setup, lambda N, D, M: 4 * N * D * M),
+        ('relu_forward', relu_forward, lambda N, M: N * M),
+        ('relu_backward', relu_backward, lambda N, M: N * M),
+        ('batchnorm_forward', batchnorm_forward, lambda N, M: 9 * N * M),
+        ('batchnorm_backward', batchnorm_backward, lambda N, M: 12 * N * M),
+        ('dropout_forward', dropout_forward, lambda N, M: 2 * N * M),
+        ('dropout_backward', dropout_backward, lambda N, M: N * M),
+        ('softmax_loss', softmax_loss_setup, lambda N, C: 6 * N * C),
+        ('sgd', update_rule(optim.sgd, {'learning_rate': 1e-3}), lambda D, M: 2 * D * M),
+        ('sgd_momentum', update_rule(optim.sgd_momentum, {'learning_rate': 1e-3}), lambda D, M: 4 * D * M),
+        ('adam', update_rule(optim.adam, {'learning_rate': 1e-3}), lambda D, M: 14 * D * M),
+    ]
+
+
+def _exercise_3_kernels():
+    from exercise_code import layers
+
+    def conv_inputs(rng, N, C, H, W, K, F):
+        x = rng.randn(N, C, H, W)
+        w = 0.01 * rng.randn(F, C, K, K)
+        return x, w, np.zeros(F), {'stride': 1, 'pad': (K - 1) // 2}
+
+    def conv_flops(N, C, H, W, K, F):
+        return 2 * N * F * C * K * K * H * W
+
+    def conv_forward_setup(N, C, H, W, K, F):
+        args = conv_inputs(np.random.RandomState(0), N, C, H, W, K, F)
+        return lambda: layers.conv_forward_naive(*args)
+
+    def conv_backward_setup(N, C, H, W, K, F):
+        rng = np.random.RandomState(0)
+        out, cache = layers.conv_forward_naive(*conv_inputs(rng, N, C, H, W, K, F))
+        dout = rng.randn(*out.shape)
+        return lambda: layers.conv_backward_naive(dout, cache)
+
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    def pool_forward_setup(N, C, H, W):
+        x = np.random.RandomState(0).randn(N, C, H, W)
+        return lambda: layers.max_pool_forward_naive(x, pool_param)
+
+    def pool_backward_setup(N, C, H, W):
+        rng = np.random.RandomState(0)
+        out, cache = layers.max_pool_forward_naive(rng.randn(N, C, H, W), pool_param)
+        dout = rng.randn(*out.shape)
+        return lambda: layers.max_pool_backward_naive(dout, cache)
+
+    def spatial_bn_inputs(rng, N, C, H, W):
+        return rng.randn(N, C, H, W), np.ones(C), np.zeros(C), {'mode': 'train'}
+
+    def spatial_bn_forward_setup(N, C, H, W):
+        args = spatial_bn_inputs(np.random.RandomState(0), N, C, H, W)
+        return lambda: layers.spatial_batchnorm_forward(*args)
+
+    def spatial_bn_backward_setup(N, C, H, W):
+        rng = np.random.RandomState(0)
+        out, cache = layers.spatial_batchnorm_forward(*spatial_bn_inputs(rng, N, C, H, W))
+        dout = rng.randn(*out.shape)
+        return lambda: layers.spatial_batchnorm_backward(dout, cache)
+
+    return [
+        ('conv_forward_naive', conv_forward_setup, conv_flops),
+        ('conv_backward_naive', conv_backward_setup, lambda *shape: 2 * conv_flops(*shape)),
+        ('max_pool_forward_naive', pool_forward_setup, lambda N, C, H, W: N * C * H * W),
+        ('max_pool_backward_naive', pool_backward_setup, lambda N, C, H, W: N * C * H * W),
+        ('spatial_batchnorm_forward', spatial_bn_forward_setup, lambda N, C, H, W: 9 * N * C * H * W),
+        ('spatial_batchnorm_backward', spatial_bn_backward_setup, lambda N, C, H, W: 12 * N * C * H * W),
+    ]
+
+
+EXERCISES = {
+    'exercise_1': _exercise_1_kernels,
+    'exercise_2': _exercise_2_kernels,
+    'exercise_3': _exercise_3_kernels,
+}
+
+
+def _shape_params(setup):
+    code = setup.__code__
+    return list(code.co_varnames[:code.co_argcount])
+
+
+def time_kernel(fn, min_time):
+    """
+    Time fn and return (seconds per call, peak bytes allocated during a call).
+    The call is repeated until min_time seconds have been spent; the median
+    of the individual calls is reported.
+    """
+    out = fn()  # warm up
+    if out is None or (isinstance(out, tuple) and out[0] is None):
+        raise NotImplementedError('kernel returned None')
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    total = 0.0
+    while total < min_time or len(times) < 3:
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        total += times[-1]
+        if total > min_time and times[-1] > min_time:
+            # Slow kernels like the naive loss are only run once
+            break
+
+    return float(np.median(times)), peak - baseline
+
+
+def run_exercise(args):
+    """
+    Benchmark the kernels of one exercise; runs inside the child process.
+    """
+    sys.path.insert(0, os.path.join(REPO_DIR, args.run_exercise))
+    results = []
+    for name, setup, flops in EXERCISES[args.run_exercise]():
+        if args.kernels and not any(pattern in name for pattern in args.kernels):
+            continue
+
+        params = _shape_params(setup)
+        for values in itertools.product(*[args.shape[p] for p in params]):
+            shape = dict(zip(params, values))
+            result = {'exercise': args.run_exercise, 'kernel': name, 'shape': shape}
+            try:
+                seconds, alloc = time_kernel(setup(**shape), args.min_time)
+                result['time_per_call_s'] = seconds
+                result['alloc_peak_bytes'] = alloc
+                if flops is not None:
+                    result['gflops'] = flops(**shape) / seconds / 1e9
+            except Exception as e:
+                # The exercise_3 layers are only stubs until they are implemented
+                result['error'] = '%s: %s' % (type(e).__name__, e)
+            results.append(result)
+    return results
+
+
+def _key(result):
+    shape = ','.join('%s=%d' % (k, v) for k, v in sorted(result['shape'].items()))
+    return '%s/%s[%s]' % (result['exercise'], result['kernel'], shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--exercises', nargs='+', default=sorted(EXERCISES), choices=sorted(EXERCISES))
+    parser.add_argument('--kernels', nargs='+', default=None,
+                        help='Only run kernels whose name contains one of these strings')
+    for dim, values in sorted(DEFAULT_SHAPE.items()):
+        parser.add_argument('--' + dim, type=int, nargs='+', default=values)
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds spent timing each kernel and shape')
+    parser.add_argument('--output', default=None, help='Write the results as json to this file')
+    parser.add_argument('--baseline', default=None, help='Json results of an earlier run to compare against')
+    parser.add_argument('--run-exercise', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.shape = {dim: getattr(args, dim) for dim in DEFAULT_SHAPE}
+
+    if args.run_exercise is not None:
+        results = run_exercise(args)
+        with open(args.result_file, 'w') as f:
+            json.dump(results, f)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'result.json')
+        for exercise in args.exercises:
+            # Forward all options to the child, only the exercise changes
+            command = [sys.executable, os.path.abspath(__file__), '--run-exercise', exercise,
+                       '--result-file', result_file, '--min-time', str(args.min_time)]
+            for dim, values in args.shape.items():
+                command += ['--' + dim] + [str(v) for v in values]
+            if args.kernels:
+                command += ['--kernels'] + args.kernels
+
+            process = subprocess.run(command, cwd=os.path.join(REPO_DIR, exercise))
+            if process.returncode != 0:
+                print('Benchmarking %s failed' % exercise)
+                continue
+            with open(result_file) as f:
+                results += json.load(f)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {_key(r): r for r in json.load(f)['results'] if 'time_per_call_s' in r}
+
+    print('%-60s %12s %10s %12s %10s' % ('kernel', 'time [ms]', 'GFLOP/s', 'alloc [MB]', 'speedup'))
+    for result in results:
+        key = _key(result)
+        if 'error' in result:
+            print('%-60s failed: %s' % (key, result['error']))
+            continue
+
+        gflops = '%10.2f' % result['gflops'] if 'gflops' in result else '%10s' % '-'
+        speedup = '%10s' % '-'
+        if key in baseline:
+            result['speedup'] = baseline[key]['time_per_call_s'] / result['time_per_call_s']
+            speedup = '%9.2fx' % result['speedup']
+        print('%-60s %12.4f %s %12.2f %s' % (key, result['time_per_call_s'] * 1000, gflops,
+                                             result['alloc_peak_bytes'] / 2 ** 20, speedup))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'shape': args.shape, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+End-to-end throughput benchmark for the TaskPlan projects registered in app.py.
+
+Every project is run in its own python process (the exercises all ship a
+package called exercise_code) against generated stand-in datasets of the
+correct shape, so no download and no TaskPlan UI is needed. Each task is
+constructed from one of its presets and stepped N times with a summary writer
+that drops everything.
+
+Example usage:
+
+python benchmark_tasks.py --steps 200 --output bench.json
+python benchmark_tasks.py --projects "Exercise 2" --set batch_size=500
+python benchmark_tasks.py --generate-only /tmp/datasets
+"""
+import argparse
+import csv
+import json
+import os
+import pickle
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (name, exercise dir, task class, config dir, preset used by default)
+PROJECTS = [
+    ("Exercise 4.2", "exercise_4", "KeyPointTask", "config", "empty"),
+    ("Exercise 1.1", "exercise_1", "SoftmaxTask", "config_1", "Basic"),
+    ("Exercise 1.2", "exercise_1", "TwoLayerTask", "config_2", "learning_rate: 0.0001 - momentum: 0.9 - dropout: 0.5"),
+    ("Exercise 1.3", "exercise_1", "FeaturesTask", "config_3", "learning_rate: 0.01 - momentum: 0.9 - dropout: 0.5"),
+    ("Exercise 2", "exercise_2", "Task", "config", "empty"),
+    ("Exercise 3", "exercise_3", "Task", "config", "Large All CNN"),
+]
+
+KEYPOINT_NAMES = [
+    'left_eye_center', 'right_eye_center', 'left_eye_inner_corner', 'left_eye_outer_corner',
+    'right_eye_inner_corner', 'right_eye_outer_corner', 'left_eyebrow_inner_end', 'left_eyebrow_outer_end',
+    'right_eyebrow_inner_end', 'right_eyebrow_outer_end', 'nose_tip', 'mouth_left_corner',
+    'mouth_right_corner', 'mouth_center_top_lip', 'mouth_center_bottom_lip'
+]
+
+
+def write_cifar_pickle(path, num_images=50000, seed=0):
+    """
+    Write a pickle with the layout of datasets/cifar10_train.p: 'data' holds
+    num_images rows of 3 * 32 * 32 uint8 pixels, 'labels' a list of ints.
+    The tasks split off 48000 / 1000 / 1000 images, so 50000 are needed.
+    """
+    rng = np.random.RandomState(seed)
+    data = {
+        'data': rng.randint(0, 256, size=(num_images, 3 * 32 * 32)).astype(np.uint8),
+        'labels': rng.randint(0, 10, size=num_images).tolist(),
+    }
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, protocol=2)
+
+
+def write_keypoint_csv(path, num_rows, seed=0):
+    """
+    Write a facial keypoints csv: 15 (x, y) columns in [0, 96) followed by an
+    'Image' column holding 96 * 96 space separated grayscale pixels.
+    """
+    rng = np.random.RandomState(seed)
+    header = []
+    for name in KEYPOINT_NAMES:
+        header += [name + '_x', name + '_y']
+    header.append('Image')
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for _ in range(num_rows):
+            key_pts = ['%.6f' % v for v in rng.uniform(0, 96, size=len(KEYPOINT_NAMES) * 2)]
+            image = ' '.join(map(str, rng.randint(0, 256, size=96 * 96)))
+            writer.writerow(key_pts + [image])
+
+
+def write_segmentation_data(root_dir, num_images, seed=0):
+    """
+    Write a segmentation dataset in the MSRC-v2 layout used by SegmentationData:
+    images/<id>.bmp (240 x 320 RGB), targets/<id>_GT.bmp coloured with the
+    SEG_LABELS_LIST palette and train.txt / val.txt listing the image names.
+    """
+    from PIL import Image
+
+    palette = np.array([
+        [0, 0, 0], [128, 0, 0], [0, 128, 0], [128, 128, 0], [0, 0, 128], [128, 0, 128],
+        [0, 128, 128], [128, 128, 128], [64, 0, 0], [192, 0, 0], [64, 128, 0], [192, 128, 0],
+        [64, 0, 128], [192, 0, 128], [64, 128, 128], [192, 128, 128], [0, 64, 0], [128, 64, 0],
+        [0, 192, 0], [128, 64, 128], [0, 192, 128], [128, 192, 128], [64, 64, 0], [192, 64, 0]
+    ], dtype=np.uint8)
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(root_dir, 'targets'), exist_ok=True)
+
+    names = []
+    for i in range(num_images):
+        name = '%d_%d_s' % (i // 30 + 1, i % 30 + 1)
+        image = rng.randint(0, 256, size=(240, 320, 3)).astype(np.uint8)
+        # Blocky label maps look more like real segmentations than per-pixel noise
+        labels = rng.randint(0, len(palette), size=(15, 20)).repeat(16, axis=0).repeat(16, axis=1)
+        Image.fromarray(image).save(os.path.join(root_dir, 'images', name + '.bmp'))
+        Image.fromarray(palette[labels]).save(os.path.join(root_dir, 'targets', name + '_GT.bmp'))
+        names.append(name + '.bmp')
+
+    num_val = max(num_images // 5, 1)
+    with open(os.path.join(root_dir, 'train.txt'), 'w') as f:
+        f.write('\n'.join(names[num_val:]))
+    with open(os.path.join(root_dir, 'val.txt'), 'w') as f:
+        f.write('\n'.join(names[:num_val]))
+
+
+def generate_datasets(exercise, datasets_dir, num_keypoint_rows=200, num_segmentation_images=20):
+    """
+    Generate the datasets/ directory the tasks of the given exercise read from.
+    """
+    os.makedirs(datasets_dir, exist_ok=True)
+    if exercise == 'exercise_4':
+        write_keypoint_csv(os.path.join(datasets_dir, 'training.csv'), num_keypoint_rows, seed=0)
+        write_keypoint_csv(os.path.join(datasets_dir, 'val.csv'), max(num_keypoint_rows // 5, 40), seed=1)
+        write_segmentation_data(os.path.join(datasets_dir, 'segmentation_data'), num_segmentation_images)
+    else:
+        write_cifar_pickle(os.path.join(datasets_dir, 'cifar10_train.p'))
+
+
+class BenchmarkPreset(object):
+    """
+    Read-only view on a preset of a project's config.json with the getters the
+    tasks use. Abstract presets without a base act as defaults for all presets,
+    like the "Default" preset of every config.
+    """
+
+    def __init__(self, config_file, name, overrides=None):
+        with open(config_file) as f:
+            presets = json.load(f)
+
+        by_uuid = {preset['uuid']: preset for preset in presets}
+        matching = [preset for preset in presets if preset['name'] == name]
+        if len(matching) == 0:
+            raise ValueError('Preset "%s" does not exist in %s' % (name, config_file))
+
+        chain = []
+        preset = matching[0]
+        while preset is not None:
+            chain.insert(0, preset)
+            preset = by_uuid.get(preset.get('base'))
+
+        self.name = name
+        self.config = {}
+        for preset in presets:
+            if preset.get('abstract') and 'base' not in preset:
+                self.config.update(preset['config'])
+        for preset in chain:
+            self.config.update(preset['config'])
+        self.config.update(overrides or {})
+
+    def _get(self, key):
+        if key not in self.config:
+            raise KeyError('Preset "%s" has no value for "%s"' % (self.name, key))
+        return self.config[key]
+
+    def get_int(self, key):
+        return int(self._get(key))
+
+    def get_float(self, key):
+        return float(self._get(key))
+
+    def get_bool(self, key):
+        return bool(self._get(key))
+
+    def get_string(self, key):
+        return str(self._get(key))
+
+    def get_list(self, key):
+        return list(self._get(key))
+
+
+class NullLogger(object):
+
+    def log(self, message):
+        pass
+
+
+class NullSummaryWriter(object):
+
+    def add_summary(self, summary, global_step=None):
+        pass
+
+
+def _import_task_class(exercise_dir, class_name):
+    sys.path.insert(0, exercise_dir)
+    # Like app.py, TaskPlan is expected next to this repository
+    sys.path.append(os.path.dirname(REPO_DIR))
+    try:
+        import TaskPlan
+    except ImportError:
+        # Only the Task base class is needed to construct and step a task
+        TaskPlan = types.ModuleType('TaskPlan')
+
+        class Task(object):
+            def __init__(self, preset, preset_pipe, logger, subtask):
+                self.preset = preset
+                self.preset_pipe = preset_pipe
+                self.logger = logger
+                self.subtask = subtask
+
+        TaskPlan.Task = Task
+        sys.modules['TaskPlan'] = TaskPlan
+
+    module = __import__(class_name)
+    return getattr(module, class_name)
+
+
+def run_project(args):
+    """
+    Construct and step a single task; runs inside the child process.
+    """
+    name, exercise, class_name, config_dir, preset_name = [p for p in PROJECTS if p[0] == args.run_one][0]
+    preset_name = args.preset or preset_name
+    exercise_dir = os.path.join(REPO_DIR, exercise)
+    preset = BenchmarkPreset(os.path.join(exercise_dir, config_dir, 'config.json'), preset_name, args.overrides)
+
+    os.chdir(args.workdir)
+    task_class = _import_task_class(exercise_dir, class_name)
+
+    start = time.perf_counter()
+    task = task_class(preset, None, NullLogger(), None)
+    init_time = time.perf_counter() - start
+
+    writer = NullSummaryWriter()
+    latencies = np.zeros(args.steps)
+    for i in range(args.steps):
+        start = time.perf_counter()
+        task.step(writer, i)
+        latencies[i] = time.perf_counter() - start
+
+    return {
+        'project': name,
+        'task': exercise + '/' + class_name,
+        'preset': preset_name,
+        'steps': args.steps,
+        'init_time_s': init_time,
+        'steps_per_s': args.steps / latencies.sum(),
+        'step_latency_mean_s': latencies.mean(),
+        'step_latency_p50_s': float(np.percentile(latencies, 50)),
+        'step_latency_p95_s': float(np.percentile(latencies, 95)),
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _parse_overrides(items):
+    overrides = {}
+    for item in items:
+        key, value = item.split('=', 1)
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--projects', nargs='+', default=[p[0] for p in PROJECTS],
+                        help='Names of the projects to run, as registered in app.py')
+    parser.add_argument('--steps', type=int, default=100, help='Number of steps per task')
+    parser.add_argument('--preset', default=None, help='Preset name to use instead of the per-project default')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE',
+                        help='Override a preset value; VALUE is parsed as json if possible')
+    parser.add_argument('--output', default=None, help='Write the results as json to this file')
+    parser.add_argument('--generate-only', default=None, metavar='DIR',
+                        help='Only generate the stand-in datasets of every exercise below DIR')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.overrides = _parse_overrides(args.overrides)
+
+    if args.run_one is not None:
+        result = run_project(args)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    if args.generate_only is not None:
+        for exercise in sorted(set(p[1] for p in PROJECTS)):
+            generate_datasets(exercise, os.path.join(args.generate_only, exercise, 'datasets'))
+        return
+
+    unknown = set(args.projects) - set(p[0] for p in PROJECTS)
+    if len(unknown) > 0:
+        parser.error('Unknown projects %s' % ', '.join(sorted(unknown)))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, exercise, class_name, _, _ in PROJECTS:
+            if name not in args.projects:
+                continue
+
+            workdir = os.path.join(tmp_dir, exercise)
+            if not os.path.exists(workdir):
+                print('Generating datasets for %s' % exercise)
+                generate_datasets(exercise, os.path.join(workdir, 'datasets'))
+
+            print('Running %s (%s/%s)' % (name, exercise, class_name))
+            result_file = os.path.join(tmp_dir, 'result.json')
+            command = [sys.executable, os.path.abspath(__file__), '--run-one', name, '--workdir', workdir,
+                       '--result-file', result_file, '--steps', str(args.steps)]
+            if args.preset is not None:
+                command += ['--preset', args.preset]
+            for key, value in args.overrides.items():
+                command += ['--set', '%s=%s' % (key, json.dumps(value))]
+
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                errors = [line for line in process.stderr.split('\n') if re.match(r'^[\w.]+(Error|Exception)\b', line)]
+                results.append({'project': name, 'task': exercise + '/' + class_name,
+                                'error': errors[-1] if len(errors) > 0 else process.stderr.strip().split('\n')[-1]})
+            else:
+                with open(result_file) as f:
+                    results.append(json.load(f))
+                os.remove(result_file)
+
+    print('')
+    print('%-14s %10s %10s %12s %12s' % ('project', 'init [s]', 'steps/s', 'p95 [ms]', 'rss [MB]'))
+    for result in results:
+        if 'error' in result:
+            print('%-14s failed: %s' % (result['project'], result['error']))
+        else:
+            print('%-14s %10.2f %10.2f %12.2f %12.1f' % (result['project'], result['init_time_s'], result['steps_per_s'],
+                                                         result['step_latency_p95_s'] * 1000, result['peak_rss_mb']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'steps': args.steps, 'overrides': args.overrides, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
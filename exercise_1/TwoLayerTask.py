@@ -53,17 +53,28 @@ class TwoLayerTask(TaskPlan.Task):
         self.X_val -= mean_image
         self.X_test -= mean_image
 
+        self.val_acc = None
+        self.val_iteration = 0
+
     def save(self, path):
         pickle.dump({'two_layer_net': self.net}, open(str(path / 'two_layer_net.p'), 'wb'))
 
     def step(self, tensorboard_writer, current_iteration):
-        loss, acc = self.net.step(self.X_train, self.y_train, learning_rate=self.preset.get_float('learning_rate'), reg=self.preset.get_float('reg'), momentum=self.preset.get_float('momentum'), dropout=self.preset.get_float('dropout'), batch_size=self.preset.get_int('batch_size'))
-        tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="loss/training", simple_value=loss)]), current_iteration)
-        tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/training", simple_value=acc)]),
-                                       current_iteration)
+        # Metrics are only computed on logging steps; the validation accuracy
+        # is cached and only re-evaluated every val_interval iterations
+        log_metrics = current_iteration % self.preset.get_int('metrics_interval') == 0
+        loss, acc = self.net.step(self.X_train, self.y_train, learning_rate=self.preset.get_float('learning_rate'), reg=self.preset.get_float('reg'), momentum=self.preset.get_float('momentum'), dropout=self.preset.get_float('dropout'), batch_size=self.preset.get_int('batch_size'), compute_acc=log_metrics)
+        if log_metrics:
+            tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="loss/training", simple_value=loss)]), current_iteration)
+            tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/training", simple_value=acc)]),
+                                           current_iteration)
 
-        y_val_pred = self.net.predict(self.X_val)
-        tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/val", simple_value=np.mean(self.y_val == y_val_pred))]), current_iteration)
+            if self.val_acc is None or current_iteration - self.val_iteration >= self.preset.get_int('val_interval'):
+                y_val_pred = self.net.predict(self.X_val)
+                self.val_acc = np.mean(self.y_val == y_val_pred)
+                self.val_iteration = current_iteration
+            tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/val", simple_value=self.val_acc)]), current_iteration)
 
     def load(self, path):
         self.net = pickle.load(open(str(path / 'two_layer_net.p'), 'rb'))['two_layer_net']
+        self.val_acc = None
@@ -34,13 +34,24 @@ class LinearClassifier(object):
         # Run stochastic gradient descent to optimize W
         loss_history = []
         for it in range(num_iters):
-            loss_history.append(self.step(X, y, learning_rate=learning_rate, reg=reg, batch_size=batch_size)[0])
+            loss_history.append(self.step(X, y, learning_rate=learning_rate, reg=reg, batch_size=batch_size, compute_acc=False)[0])
 
             if verbose and it % 100 == 0:
                 print('iteration %d / %d: loss %f' % (it, num_iters, loss_history[-1]))
         return loss_history
 
-    def step(self, X, y, learning_rate=1e-3, reg=1e-5, batch_size=200):
+    def step(self, X, y, learning_rate=1e-3, reg=1e-5, batch_size=200, compute_acc=True):
+        """
+        Perform a single gradient descent step on a random minibatch.
+
+        Inputs are the same as in train, except:
+        - compute_acc: (boolean) If false, the minibatch accuracy is not
+          computed and None is returned in its place.
+
+        Returns a tuple of:
+        - loss of the minibatch before the update
+        - accuracy on the minibatch before the update, or None
+        """
         num_train, dim = X.shape
         num_classes = np.max(y) + 1  # assume y takes values 0...K-1 where K is number of classes
         if self.W is None:
@@ -70,7 +81,7 @@ class LinearClassifier(object):
         #########################################################################
 
         # evaluate loss and gradient
-        loss, acc, grad = self.loss(X_batch, y_batch, reg)
+        loss, acc, grad = self.loss(X_batch, y_batch, reg, compute_acc=compute_acc)
 
         # perform parameter update
         #########################################################################
@@ -109,7 +120,7 @@ class LinearClassifier(object):
         ###########################################################################
         return y_pred
 
-    def loss(self, X_batch, y_batch, reg):
+    def loss(self, X_batch, y_batch, reg, compute_acc=True):
         """
         Compute the loss function and its derivative.
         Subclasses will override this.
@@ -119,9 +130,11 @@ class LinearClassifier(object):
           data points; each point has dimension D.
         - y_batch: A numpy array of shape (N,) containing labels for the minibatch.
         - reg: (float) regularization strength.
+        - compute_acc: (boolean) If false, the accuracy is not computed.
 
         Returns: A tuple containing:
         - loss as a single float
+        - accuracy on the minibatch, or None if compute_acc is false
         - gradient with respect to self.W; an array of the same shape as W
         """
         raise NotImplementedError
@@ -42,7 +42,7 @@ class TwoLayerNet(object):
         self.params['b2'] = np.zeros(output_size)
         self.last_grads = None
 
-    def loss(self, X, y=None, reg=0.0, dropout=1.0):
+    def loss(self, X, y=None, reg=0.0, dropout=1.0, compute_acc=True):
         """
         Compute the loss and gradients for a two layer fully connected neural
         network.
@@ -54,6 +54,8 @@ class TwoLayerNet(object):
           optional; if it is not passed then we only return scores, and if it is
           passed then we instead return the loss and gradients.
         - reg: Regularization strength.
+        - dropout: Probability of keeping a hidden unit active.
+        - compute_acc: If False, the accuracy on the batch is not computed.
 
         Returns:
         If y is None, return a matrix scores of shape (N, C) where scores[i, c]
@@ -62,6 +64,8 @@ class TwoLayerNet(object):
         If y is not None, instead return a tuple of:
         - loss: Loss (data loss and regularization loss) for this batch of
           training samples.
+        - acc: Accuracy on this batch of training samples, or None if
+          compute_acc is False.
         - grads: Dictionary mapping parameter names to gradients of those
           parameters  with respect to the loss function; has the same keys as
           self.params.
@@ -96,7 +100,9 @@ class TwoLayerNet(object):
         if y is None:
             return scores
 
-        acc = (np.argmax(scores, -1) == y).mean()
+        acc = None
+        if compute_acc:
+            acc = (np.argmax(scores, -1) == y).mean()
         # Compute the loss
         loss = None
         ########################################################################
@@ -170,7 +176,9 @@ class TwoLayerNet(object):
         val_acc_history = []
 
         for it in range(num_iters):
-            loss, acc = self.step(X, y, learning_rate, reg, batch_size)
+            # The training accuracy is only needed once per epoch
+            loss, acc = self.step(X, y, learning_rate, reg, batch_size,
+                                  compute_acc=it % iterations_per_epoch == 0)
             loss_history.append(loss)
 
             if verbose and it % 100 == 0:
@@ -198,7 +206,8 @@ class TwoLayerNet(object):
               reg=1e-5,
               batch_size=200,
              momentum=0,
-             dropout=1):
+             dropout=1,
+             compute_acc=True):
         X_batch = None
         y_batch = None
 
@@ -214,7 +223,7 @@ class TwoLayerNet(object):
         ####################################################################
 
         # Compute loss and gradients using the current minibatch
-        loss, acc, grads = self.loss(X_batch, y=y_batch, reg=reg, dropout=dropout)
+        loss, acc, grads = self.loss(X_batch, y=y_batch, reg=reg, dropout=dropout, compute_acc=compute_acc)
 
         ####################################################################
         # TODO: Use the gradients in the grads dictionary to update the    #
@@ -108,17 +108,18 @@ def cross_entropoy_loss_naive(W, X, y, reg):
     return loss, dW
 
 
-def cross_entropoy_loss_vectorized(W, X, y, reg):
+def cross_entropoy_loss_vectorized(W, X, y, reg, compute_acc=True):
     """
     Cross-entropy loss function, vectorized version.
 
-    Inputs and outputs are the same as in cross_entropoy_loss_naive.
+    Inputs and outputs are the same as in cross_entropoy_loss_naive, with the
+    minibatch accuracy returned in addition. If compute_acc is False the
+    accuracy is not computed and None is returned in its place.
     """
     # Initialize the loss and gradient to zero.
     loss = 0.0
     dW = np.zeros_like(W)
     y_log = np.matmul(X, W)
-    y_pred = np.argmax(y_log, -1)
     y_exp = np.exp(y_log - np.expand_dims(np.max(y_log, -1), -1))
     y_sum = np.expand_dims(np.sum(y_exp, -1), axis=-1)
     y_act = y_exp / y_sum
@@ -138,7 +139,9 @@ def cross_entropoy_loss_vectorized(W, X, y, reg):
     dW = np.matmul(np.transpose(X), dY)
     dW += reg * 2 * W
 
-    acc = np.mean(y == y_pred)
+    acc = None
+    if compute_acc:
+        acc = np.mean(y == np.argmax(y_log, -1))
 
     return loss, acc, dW
 
@@ -146,5 +149,5 @@ def cross_entropoy_loss_vectorized(W, X, y, reg):
 class SoftmaxClassifier(LinearClassifier):
     """The softmax classifier which uses the cross-entropy loss."""
 
-    def loss(self, X_batch, y_batch, reg):
-        return cross_entropoy_loss_vectorized(self.W, X_batch, y_batch, reg)
+    def loss(self, X_batch, y_batch, reg, compute_acc=True):
+        return cross_entropoy_loss_vectorized(self.W, X_batch, y_batch, reg, compute_acc=compute_acc)
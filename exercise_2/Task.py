@@ -1,8 +1,11 @@
 import sys
 sys.path.append('../../')
 import TaskPlan
-from exercise_code.data_utils import get_CIFAR10_data, data_augm, extract_features_initial, extract_features_of_images
+from exercise_code.data_utils import get_CIFAR10_data, augmented_epoch, augment_batch
+from exercise_code.epoch_builder import EpochBuilder
+from exercise_code.features import FeaturePipeline
 import numpy as np
+from functools import partial
 from exercise_code.classifiers.fc_net import FullyConnectedNet
 import tensorflow as tf
 import pickle
@@ -16,22 +19,73 @@ class Task(TaskPlan.Task):
         super().__init__(preset, preset_pipe, logger, subtask)
 
         self.data = get_CIFAR10_data()
-        x_train, y_train = data_augm(self.data['X_train'], self.data['y_train'], 2, self.preset.get_float('scale_min'), self.preset.get_float('scale_max'), self.preset.get_int('translate_max'))
+        # Seed of the augmentation of every epoch, see augmented_epoch
+        self.data_seed = np.random.randint(2 ** 31)
         full_data = {
-            'X_train': x_train,
-            'y_train': y_train,
+            'X_train': self.data['X_train'],
+            'y_train': self.data['y_train'],
             'X_val': self.data['X_val'],
             'y_val': self.data['y_val'],
         }
 
+        self.feature_pipeline = None
         if self.preset.get_bool('extract_features'):
-            full_data, self.mean_feat, self.std_feat = extract_features_initial(full_data)
             self.logger.log("Extracting features")
+            self.feature_pipeline = FeaturePipeline(mean_image=self.data['mean_image'])
+            x_train, _ = augmented_epoch(0, self.data['X_train'], self.data['y_train'], self.data_seed, **self._FLIP_ONLY)
+            full_data['X_train'] = self.feature_pipeline.fit_transform(x_train)
+            del x_train
+            full_data['X_val'] = self.feature_pipeline.transform(full_data['X_val'])
+
+        # With feature extraction, augmented training data is built for every
+        # epoch by a background process while the previous epoch is trained
+        # on. It is started before the solver starts its threads; the first
+        # epoch is requested by step(), after a possible load()
+        self.epoch_builder = None
+        self.refresh_due = False
+        if self.preset.get_bool('data_augmentation') and self.feature_pipeline is not None:
+            self.epoch_builder = EpochBuilder(partial(augmented_epoch, images=self.data['X_train'], labels=self.data['y_train'], **self._augmentation()))
+
+        # A memory budget enables activation checkpointing and a storage dtype
+        # other than float32 (e.g. float16) shrinks the cached activations;
+        # without either, and on the reference backend, the network is compiled
+        # with preallocated buffers
+        memory_budget = None
+        if self.preset.get_float('memory_budget_mb') > 0:
+            memory_budget = int(self.preset.get_float('memory_budget_mb') * 2 ** 20)
+        storage_dtype = None
+        if np.dtype(self.preset.get_string('storage_dtype')) != np.float32:
+            storage_dtype = np.dtype(self.preset.get_string('storage_dtype'))
+        backend = self.preset.get_string('backend')
+
+        self.net = FullyConnectedNet(self.preset.get_list('hidden_size')[:], input_dim=np.prod(full_data['X_train'].shape[1:]), weight_scale=self.preset.get_float('weight_scale'), use_batchnorm=self.preset.get_bool('use_batchnorm'), dropout=self.preset.get_float('dropout'), reg=self.preset.get_float('reg'), compiled=memory_budget is None and storage_dtype is None and backend == 'reference', memory_budget=memory_budget, storage_dtype=storage_dtype, backend=backend)
+
+        self.net.feature_pipeline = self.feature_pipeline
+
+        # The schedule reads the parameters it needs, 'step' uses lr_step_size
+        # and lr_gamma, 'exponential' decays by lr_gamma every lr_step_size
+        # iterations, 'cosine' and 'one_cycle' run over lr_num_iterations
+        lr_schedule = self.preset.get_string('lr_schedule')
+        lr_schedule_config = {
+            'step_size': self.preset.get_int('lr_step_size'),
+            'decay_steps': self.preset.get_int('lr_step_size'),
+            'gamma': self.preset.get_float('lr_gamma'),
+            'num_iterations': self.preset.get_int('lr_num_iterations'),
+        }
+        if self.preset.get_int('lr_warmup_iterations') > 0:
+            lr_schedule_config['warmup_iterations'] = self.preset.get_int('lr_warmup_iterations')
+            lr_schedule_config['after'] = lr_schedule
+            lr_schedule = 'warmup'
 
-        self.net = FullyConnectedNet(self.preset.get_list('hidden_size')[:], input_dim=np.prod(full_data['X_train'].shape[1:]), weight_scale=self.preset.get_float('weight_scale'), use_batchnorm=self.preset.get_bool('use_batchnorm'), dropout=self.preset.get_float('dropout'), reg=self.preset.get_float('reg'))
+        # Images are augmented per minibatch; features can only be extracted
+        # from whole augmented epochs, which step() creates
+        augment = None
+        if self.feature_pipeline is None:
+            augment = partial(augment_batch, **self._augmentation())
 
-        if self.preset.get_bool('extract_features'):
-            self.net.mean_feat, self.net.std_feat = self.mean_feat, self.std_feat
+        # Importance sampling draws every minibatch from the losses of the
+        # last step, which rules out prefetching
+        importance_sampling = self.preset.get_bool('importance_sampling')
 
         self.solver = Solver(self.net, full_data,
                         num_epochs=50, batch_size=self.preset.get_int('batch_size'),
@@ -39,32 +93,69 @@ class Task(TaskPlan.Task):
                         optim_config={
                             'learning_rate': self.preset.get_float('learning_rate')
                         },
+                        lr_schedule=lr_schedule, lr_schedule_config=lr_schedule_config,
+                        num_workers=self.preset.get_int('num_workers'),
+                        prefetch_batches=0 if importance_sampling else self.preset.get_int('prefetch_batches'),
+                        importance_sampling=importance_sampling,
+                        augment=augment,
                         verbose=False, print_every=100000)
 
+    _FLIP_ONLY = {'scale_min': 1.0, 'scale_max': 1.0, 'transl_max': 0}
+
+    def _augmentation(self):
+        # The training images are always flipped at random, per minibatch or,
+        # with features, per epoch; scaled crops and translations are only
+        # added with both data_augmentation and augment_geometric
+        if not (self.preset.get_bool('data_augmentation') and self.preset.get_bool('augment_geometric')):
+            return self._FLIP_ONLY
+        return {'scale_min': self.preset.get_float('scale_min'), 'scale_max': self.preset.get_float('scale_max'), 'transl_max': self.preset.get_int('translate_max')}
+
+    def _training_data(self, generation):
+        # Generation 0 is the original training data, or the features of a
+        # flipped epoch, every later generation an augmented epoch; all of
+        # them can be recreated from the data seed
+        if generation == 0:
+            if self.feature_pipeline is not None:
+                return augmented_epoch(0, self.data['X_train'], self.data['y_train'], self.data_seed, feature_pipeline=self.feature_pipeline, **self._FLIP_ONLY)
+            return self.data['X_train'], self.data['y_train']
+        return augmented_epoch(generation, self.data['X_train'], self.data['y_train'], self.data_seed, feature_pipeline=self.feature_pipeline, **self._augmentation())
+
+    def _set_training_data(self, generation, x_train, y_train):
+        self.solver.set_data({
+            'X_train': x_train,
+            'y_train': y_train,
+            'X_val': self.solver.X_val,
+            'y_val': self.solver.y_val,
+        }, generation)
+
     def save(self, path):
         pickle.dump({'fully_connected_net': self.net}, open(str(path / 'fully_connected_net.p'), 'wb'))
 
-    def step(self, tensorboard_writer, current_iteration):
-        if self.preset.get_bool('data_augmentation') and current_iteration % int(self.data['X_train'].shape[0] / self.preset.get_int('batch_size')) == 0:
-            x_train, y_train = data_augm(self.data['X_train'], self.data['y_train'], 1, self.preset.get_float('scale_min'), self.preset.get_float('scale_max'), self.preset.get_int('translate_max'))
-            if self.preset.get_bool('extract_features'):
-                x_train = extract_features_of_images(x_train, self.mean_feat, self.std_feat)
-                self.logger.log("Extracting features")
-
-            full_data = {
-                'X_train': x_train,
-                'y_train': y_train,
-                'X_val': self.solver.X_val,
-                'y_val': self.solver.y_val,
-            }
-
+        state = self.solver.state_dict()
+        state['task/data_seed'] = np.asarray(self.data_seed)
+        np.savez(str(path / 'solver_state.npz'), **state)
 
-            self.logger.log("Doing data augm")
-            self.solver.set_data(full_data)
-
-            #s = StringIO()
-            #plt.imsave(s, (x_train[0] - x_train[0].min()) / (x_train[0].max() - x_train[0].min()) , format='png')
-            #tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/training", image=tf.Summary.Image(encoded_image_string=s, width=32, height=32))]), current_iteration)
+    def step(self, tensorboard_writer, current_iteration):
+        # At the end of every epoch the next augmented epoch replaces the
+        # training data. If it is not built yet, refresh_policy 'wait' blocks
+        # until it is, 'skip' keeps training on the current data and swaps
+        # as soon as it is ready
+        if self.epoch_builder is not None:
+            if self.epoch_builder.pending is None:
+                self.epoch_builder.request(self.solver.data_generation + 1, seed=self.data_seed, feature_pipeline=self.feature_pipeline)
+            if current_iteration > 0 and current_iteration % int(self.data['X_train'].shape[0] / self.preset.get_int('batch_size')) == 0:
+                self.refresh_due = True
+            if self.refresh_due:
+                epoch = self.epoch_builder.get(block=self.preset.get_string('refresh_policy') == 'wait')
+                if epoch is not None:
+                    generation, x_train, y_train = epoch
+                    self.logger.log("Doing data augm")
+                    self._set_training_data(generation, x_train, y_train)
+                    # The solver drained its prefetch thread when switching,
+                    # so the buffer of the previous epoch can be reused
+                    self.epoch_builder.release()
+                    self.epoch_builder.request(generation + 1, seed=self.data_seed, feature_pipeline=self.feature_pipeline)
+                    self.refresh_due = False
 
         loss = self.solver.step()
         tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="loss/training", simple_value=loss)]), current_iteration)
@@ -76,4 +167,27 @@ class Task(TaskPlan.Task):
 
     def load(self, path):
         self.net = pickle.load(open(str(path / 'fully_connected_net.p'), 'rb'))['fully_connected_net']
+        if self.net.feature_pipeline is not None:
+            self.feature_pipeline = self.net.feature_pipeline
         self.solver.set_model(self.net)
+
+        # Checkpoints written before the solver state was saved only hold the
+        # network
+        state_path = path / 'solver_state.npz'
+        if not state_path.exists():
+            return
+        with np.load(str(state_path), allow_pickle=False) as state:
+            state = dict(state)
+
+        generation = int(state['data_generation'])
+        data_seed = int(state['task/data_seed']) if 'task/data_seed' in state else self.data_seed
+        if generation != self.solver.data_generation or data_seed != self.data_seed:
+            self.logger.log("Recreating training data")
+            self.data_seed = data_seed
+            self._set_training_data(generation, *self._training_data(generation))
+        if self.epoch_builder is not None:
+            self.epoch_builder.release()
+            self.epoch_builder.request(generation + 1, seed=self.data_seed, feature_pipeline=self.feature_pipeline)
+            self.refresh_due = False
+
+        self.solver.load_state_dict(state)
@@ -0,0 +1,375 @@
+"""Registry of interchangeable implementations of the layer functions."""
+import copy
+import json
+import os
+import time
+
+import numpy as np
+
+from exercise_code import layers, layer_utils
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+OPS = (
+    'affine_forward', 'affine_backward',
+    'relu_forward', 'relu_backward',
+    'batchnorm_forward', 'batchnorm_backward',
+    'dropout_forward', 'dropout_backward',
+    'softmax_loss',
+    'affine_relu_forward', 'affine_relu_backward',
+    'affine_bn_relu_forward', 'affine_bn_relu_backward',
+)
+
+
+class Backend(object):
+    """
+    A set of implementations of the layer functions in OPS, available as
+    attributes with the same names and signatures as the functions in
+    exercise_code.layers and exercise_code.layer_utils.
+
+    The caches returned by the forward functions of every backend have the
+    same layout and hold numpy arrays, so a forward pass of one backend can
+    be followed by the backward pass of another.
+    """
+
+    def __init__(self, name, ops):
+        self.name = name
+        for op in OPS:
+            setattr(self, op, ops[op])
+
+
+_BACKENDS = {}
+_default_backend = 'reference'
+
+
+def register_backend(backend):
+    _BACKENDS[backend.name] = backend
+
+
+def available_backends():
+    names = list(_BACKENDS)
+    if 'auto' not in names:
+        names.append('auto')
+    return names
+
+
+def get_backend(name=None):
+    """
+    Return the backend registered under name, or the process-wide default
+    backend (see set_backend) if name is None.
+    """
+    if name is None:
+        name = _default_backend
+    if name == 'auto' and name not in _BACKENDS:
+        register_backend(AutotuneBackend())
+    if name not in _BACKENDS:
+        raise ValueError('Unknown backend "%s"' % name)
+    return _BACKENDS[name]
+
+
+def set_backend(name):
+    """
+    Select the backend used by models that were not given a backend.
+    """
+    global _default_backend
+    get_backend(name)
+    _default_backend = name
+
+
+def _composite_ops(ops):
+    """
+    Build the convenience layers of layer_utils on top of the primitive
+    functions of ops, which are looked up on every call.
+    """
+    def affine_relu_forward(x, w, b):
+        a, fc_cache = ops.affine_forward(x, w, b)
+        out, relu_cache = ops.relu_forward(a)
+        return out, (fc_cache, relu_cache)
+
+    def affine_relu_backward(dout, cache):
+        fc_cache, relu_cache = cache
+        da = ops.relu_backward(dout, relu_cache)
+        return ops.affine_backward(da, fc_cache)
+
+    def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+        a, fc_cache = ops.affine_forward(x, w, b)
+        if bn_param['mode'] == 'train':
+            out, bn_cache = ops.batchnorm_forward(a, gamma, beta, bn_param, x_norm=a)
+        else:
+            out, bn_cache = ops.batchnorm_forward(a, gamma, beta, bn_param, out=a)
+        np.maximum(out, 0, out=out)
+        return out, (fc_cache, bn_cache, out)
+
+    def affine_bn_relu_backward(dout, cache):
+        fc_cache, bn_cache, out = cache
+        x_norm = bn_cache[0]
+        da = np.multiply(dout, out > 0, out=out if out.dtype == dout.dtype else None)
+        dbn, dgamma, dbeta = ops.batchnorm_backward(da, bn_cache, out=x_norm if x_norm.dtype == da.dtype else None)
+        dx, dw, db = ops.affine_backward(dbn, fc_cache)
+        return dx, dw, db, dgamma, dbeta
+
+    return {
+        'affine_relu_forward': affine_relu_forward,
+        'affine_relu_backward': affine_relu_backward,
+        'affine_bn_relu_forward': affine_bn_relu_forward,
+        'affine_bn_relu_backward': affine_bn_relu_backward,
+    }
+
+
+def _reference_ops():
+    ops = {}
+    for op in OPS:
+        ops[op] = getattr(layers, op, None) or getattr(layer_utils, op)
+    return ops
+
+
+register_backend(Backend('reference', _reference_ops()))
+
+
+def _numpy_affine_forward(x, w, b):
+    out = np.matmul(x.reshape(x.shape[0], -1), w)
+    out += b
+    return out, (x, w, b)
+
+
+def _numpy_affine_backward(dout, cache):
+    x, w, b = cache
+    dw = np.matmul(x.reshape(x.shape[0], -1).T, dout)
+    db = np.sum(dout, axis=0)
+    dx = np.matmul(dout, w.T).reshape(x.shape)
+    return dx, dw, db
+
+
+def _numpy_relu_forward(x):
+    return np.maximum(x, 0), x
+
+
+def _numpy_relu_backward(dout, cache):
+    return np.multiply(dout, cache > 0)
+
+
+def _numpy_ops():
+    """
+    The reference functions with the affine and ReLU layers replaced by
+    versions that add the bias in place and avoid the temporaries of the
+    elementwise products.
+    """
+    ops = _reference_ops()
+    ops['affine_forward'] = _numpy_affine_forward
+    ops['affine_backward'] = _numpy_affine_backward
+    ops['relu_forward'] = _numpy_relu_forward
+    ops['relu_backward'] = _numpy_relu_backward
+    return ops
+
+
+_numpy_backend = Backend('numpy', _numpy_ops())
+for op, fn in _composite_ops(_numpy_backend).items():
+    setattr(_numpy_backend, op, fn)
+register_backend(_numpy_backend)
+
+
+def _tensor(x, dtype=None):
+    # torch.from_numpy shares the memory of x, it only copies if x is not
+    # contiguous or has to be cast
+    return torch.from_numpy(np.ascontiguousarray(x, dtype=dtype))
+
+
+def _torch_affine_forward(x, w, b):
+    # Unlike numpy, torch does not promote mixed dtypes in matrix products
+    dtype = np.result_type(x, w, b)
+    out = torch.addmm(_tensor(b, dtype), _tensor(x.reshape(x.shape[0], -1), dtype), _tensor(w, dtype))
+    return out.numpy(), (x, w, b)
+
+
+def _torch_affine_backward(dout, cache):
+    x, w, b = cache
+    dtype = np.result_type(dout, x, w)
+    dout_t = _tensor(dout, dtype)
+    dw = torch.mm(_tensor(x.reshape(x.shape[0], -1), dtype).t(), dout_t)
+    db = dout_t.sum(0)
+    dx = torch.mm(dout_t, _tensor(w, dtype).t())
+    return dx.numpy().reshape(x.shape), dw.numpy(), db.numpy()
+
+
+def _torch_relu_forward(x):
+    return torch.relu(_tensor(x)).numpy(), x
+
+
+def _torch_relu_backward(dout, cache):
+    return (_tensor(dout) * (_tensor(cache) > 0)).numpy()
+
+
+def _torch_batchnorm_forward(x, gamma, beta, bn_param, out=None, x_norm=None):
+    if bn_param['mode'] != 'train':
+        return layers.batchnorm_forward(x, gamma, beta, bn_param, out=out, x_norm=x_norm)
+
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+    N, D = x.shape
+    running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+
+    x_t = _tensor(x)
+    sample_mean = x_t.mean(0)
+    if x_norm is None:
+        x_norm = np.empty_like(x)
+    x_norm_t = torch.from_numpy(x_norm)
+    torch.sub(x_t, sample_mean, out=x_norm_t)
+    var = torch.einsum('ij,ij->j', x_norm_t, x_norm_t) / N
+    inv_std = torch.rsqrt(var + eps)
+    x_norm_t.mul_(inv_std)
+
+    if out is None:
+        out = np.empty_like(x)
+    torch.addcmul(_tensor(beta), x_norm_t, _tensor(gamma), out=torch.from_numpy(out))
+
+    bn_param['running_var'] = momentum * running_var + (1 - momentum) * var.numpy()
+    bn_param['running_mean'] = momentum * running_mean + (1 - momentum) * sample_mean.numpy()
+    return out, (x_norm, gamma, inv_std.numpy())
+
+
+def _torch_batchnorm_backward(dout, cache, out=None):
+    x_norm, gamma, inv_std = cache
+    N = dout.shape[0]
+    dout_t, x_norm_t = _tensor(dout), _tensor(x_norm)
+    dbeta = dout_t.sum(0)
+    dgamma = torch.einsum('ij,ij->j', dout_t, x_norm_t)
+
+    if out is None:
+        out = np.empty_like(dout)
+    dx = torch.from_numpy(out)
+    torch.mul(x_norm_t, dgamma / N, out=dx)
+    dx.add_(dbeta / N)
+    torch.sub(dout_t, dx, out=dx)
+    dx.mul_(_tensor(gamma) * _tensor(inv_std))
+    return out, dgamma.numpy(), dbeta.numpy()
+
+
+def _torch_ops():
+    """
+    The affine, ReLU and training-time batch normalization layers computed
+    with torch on the CPU. Arrays are shared with torch through
+    torch.from_numpy and the results are returned as numpy arrays, so no data
+    is copied at the boundary.
+    """
+    ops = _reference_ops()
+    ops['affine_forward'] = _torch_affine_forward
+    ops['affine_backward'] = _torch_affine_backward
+    ops['relu_forward'] = _torch_relu_forward
+    ops['relu_backward'] = _torch_relu_backward
+    ops['batchnorm_forward'] = _torch_batchnorm_forward
+    ops['batchnorm_backward'] = _torch_batchnorm_backward
+    return ops
+
+
+if torch is not None:
+    _torch_backend = Backend('torch', _torch_ops())
+    for op, fn in _composite_ops(_torch_backend).items():
+        setattr(_torch_backend, op, fn)
+    register_backend(_torch_backend)
+
+
+def _signature(value):
+    """
+    Describe the shapes and dtypes of the arrays in value, the mode of any
+    parameter dictionary and the values of flags (None, booleans, integers
+    and strings), which may select a code path, as a string. Floats such as
+    eps or the dropout probability do not change the timing and are left out.
+    """
+    if isinstance(value, np.ndarray):
+        return '%s%s' % (value.dtype.str, list(value.shape))
+    if value is None or isinstance(value, (bool, int, str, np.bool_, np.integer)):
+        return repr(value)
+    if isinstance(value, dict):
+        return 'mode=%s' % value['mode'] if 'mode' in value else ''
+    if isinstance(value, (tuple, list)):
+        return '(' + ','.join(_signature(v) for v in value) + ')'
+    return ''
+
+
+class AutotuneBackend(Backend):
+    """
+    Dispatches every call to the fastest of the other registered backends.
+
+    The first call of an op with a new signature (shapes and dtypes of the
+    array arguments, the mode of the parameter dictionaries, the values of
+    flags and the names of the keyword arguments) times every backend on
+    copies of the arguments and then runs the fastest one. The
+    choices are kept in a JSON file, so they are only measured once per
+    machine.
+    """
+
+    def __init__(self, cache_path=None, candidates=None, repeats=3):
+        """
+        Inputs:
+        - cache_path: Path of the JSON file the choices are stored in; defaults
+          to ~/.cache/exercise_code_autotune.json
+        - candidates: Names of the backends to choose from; defaults to all
+          other registered backends
+        - repeats: Number of timed runs of every backend
+        """
+        if cache_path is None:
+            cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'exercise_code_autotune.json')
+        self.cache_path = str(cache_path)
+        self.candidates = candidates
+        self.repeats = repeats
+        self.choices = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self.choices = json.load(f)
+
+        ops = {}
+        for op in OPS:
+            ops[op] = self._dispatcher(op)
+        super(AutotuneBackend, self).__init__('auto', ops)
+
+    def _candidates(self):
+        names = self.candidates or [name for name in _BACKENDS if name != self.name]
+        return [_BACKENDS[name] for name in names if name in _BACKENDS]
+
+    def _dispatcher(self, op):
+        def dispatch(*args, **kwargs):
+            key = op + _signature(args) + ''.join(',%s=%s' % (k, _signature(v)) for k, v in sorted(kwargs.items()))
+            name = self.choices.get(key)
+            if name not in _BACKENDS:
+                name = self.tune(op, args, kwargs)
+                self.choices[key] = name
+                self._save()
+            return getattr(_BACKENDS[name], op)(*args, **kwargs)
+        dispatch.__name__ = op
+        return dispatch
+
+    def tune(self, op, args, kwargs):
+        """
+        Return the name of the backend that runs op(*args, **kwargs) fastest.
+        Every run works on a deep copy of the arguments, so buffers that are
+        overwritten in place and the state in parameter dictionaries are left
+        untouched.
+        """
+        best_name, best_time = None, None
+        for backend in self._candidates():
+            fn = getattr(backend, op)
+            timings = []
+            for _ in range(self.repeats + 1):
+                run_args, run_kwargs = copy.deepcopy((args, kwargs))
+                start = time.perf_counter()
+                fn(*run_args, **run_kwargs)
+                timings.append(time.perf_counter() - start)
+            # The first run is a warm-up
+            elapsed = min(timings[1:])
+            if best_time is None or elapsed < best_time:
+                best_name, best_time = backend.name, elapsed
+        return best_name
+
+    def _save(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.choices, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,295 @@
+import numpy as np
+
+from exercise_code.layers import *
+
+
+class Arena(object):
+    """
+    A single preallocated block of memory that is handed out as views.
+
+    Buffers are first requested with request(shape), which returns a handle,
+    and become available through get(handle) once allocate() has been called.
+    Every buffer starts at a multiple of 64 bytes.
+    """
+
+    ALIGNMENT = 64
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.shapes = []
+        self.buffers = None
+        self.memory = None
+
+    def request(self, shape):
+        self.shapes.append(tuple(int(d) for d in shape))
+        return len(self.shapes) - 1
+
+    def allocate(self):
+        step = max(self.ALIGNMENT // self.dtype.itemsize, 1)
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        padded = [-(-size // step) * step for size in sizes]
+        self.memory = np.empty(sum(padded), dtype=self.dtype)
+
+        self.buffers = []
+        offset = 0
+        for shape, size, padded_size in zip(self.shapes, sizes, padded):
+            self.buffers.append(self.memory[offset:offset + size].reshape(shape))
+            offset += padded_size
+
+    def get(self, handle):
+        return self.buffers[handle]
+
+    @property
+    def nbytes(self):
+        return 0 if self.memory is None else self.memory.nbytes
+
+
+class AffineLayer(object):
+    """
+    Affine layer writing its output into a preallocated (N, M) buffer. The
+    gradient with respect to the input is not computed for the first layer.
+    """
+
+    def __init__(self, index, input_dim, output_dim, need_dx=True):
+        self.name = 'affine' + str(index)
+        self.w_key = 'W' + str(index)
+        self.b_key = 'b' + str(index)
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.need_dx = need_dx
+
+    def request(self, arena, batch_size, train, grads):
+        self.out_handle = arena.request((batch_size, self.output_dim))
+        self.dx_handle = self.dw_handle = self.db_handle = None
+        if train:
+            if self.need_dx:
+                self.dx_handle = arena.request((batch_size, self.input_dim))
+            if self.w_key not in grads:
+                self.dw_handle = arena.request((self.input_dim, self.output_dim))
+                self.db_handle = arena.request((self.output_dim,))
+
+    def resolve(self, arena, grads):
+        self.out = arena.get(self.out_handle)
+        self.dx = None if self.dx_handle is None else arena.get(self.dx_handle)
+        if self.dw_handle is not None:
+            grads[self.w_key] = arena.get(self.dw_handle)
+            grads[self.b_key] = arena.get(self.db_handle)
+        if self.w_key in grads:
+            self.dw = grads[self.w_key]
+            self.db = grads[self.b_key]
+
+    def bind(self, params):
+        self.w = params[self.w_key]
+        self.b = params[self.b_key]
+
+    def forward(self, x):
+        self.x = x
+        np.matmul(x, self.w, out=self.out)
+        self.out += self.b
+        return self.out
+
+    def backward(self, dout):
+        np.matmul(self.x.T, dout, out=self.dw)
+        np.sum(dout, axis=0, out=self.db)
+        if self.dx is None:
+            return None
+        np.matmul(dout, self.w.T, out=self.dx)
+        return self.dx
+
+
+class BatchNormLayer(object):
+    """
+    Batch normalization of the output of an affine layer. The gradient with
+    respect to the input is written into the output buffer of that affine
+    layer, which is not needed any more once the normalized input is cached.
+    """
+
+    def __init__(self, index, dim, bn_param, affine):
+        self.name = 'batchnorm' + str(index)
+        self.gamma_key = 'bng' + str(index)
+        self.beta_key = 'bnb' + str(index)
+        self.dim = dim
+        self.bn_param = bn_param
+        self.affine = affine
+
+    def request(self, arena, batch_size, train, grads):
+        self.out_handle = arena.request((batch_size, self.dim))
+        self.x_norm_handle = arena.request((batch_size, self.dim)) if train else None
+        self.dgamma_handle = self.dbeta_handle = None
+        if train and self.gamma_key not in grads:
+            self.dgamma_handle = arena.request((self.dim,))
+            self.dbeta_handle = arena.request((self.dim,))
+
+    def resolve(self, arena, grads):
+        self.out = arena.get(self.out_handle)
+        self.x_norm = None if self.x_norm_handle is None else arena.get(self.x_norm_handle)
+        if self.dgamma_handle is not None:
+            grads[self.gamma_key] = arena.get(self.dgamma_handle)
+            grads[self.beta_key] = arena.get(self.dbeta_handle)
+        if self.gamma_key in grads:
+            self.dgamma = grads[self.gamma_key]
+            self.dbeta = grads[self.beta_key]
+
+    def bind(self, params):
+        self.gamma = params[self.gamma_key]
+        self.beta = params[self.beta_key]
+
+    def forward(self, x):
+        out, self.cache = batchnorm_forward(x, self.gamma, self.beta, self.bn_param, out=self.out, x_norm=self.x_norm)
+        return out
+
+    def backward(self, dout):
+        dx, self.dgamma[...], self.dbeta[...] = batchnorm_backward(dout, self.cache, out=self.affine.out)
+        return dx
+
+
+class ReluLayer(object):
+    """
+    ReLU applied in place. Its output doubles as the cached input; the mask of
+    positive outputs is written into a preallocated boolean buffer in the
+    backward pass.
+    """
+
+    def __init__(self, index, dim):
+        self.name = 'relu' + str(index)
+        self.dim = dim
+
+    def request(self, arena, batch_size, train, grads):
+        self.mask_handle = arena.request((batch_size, self.dim)) if train else None
+
+    def resolve(self, arena, grads):
+        self.mask = None if self.mask_handle is None else arena.get(self.mask_handle)
+
+    def bind(self, params):
+        pass
+
+    def forward(self, x):
+        self.out = np.maximum(x, 0, out=x)
+        return self.out
+
+    def backward(self, dout):
+        # Units zeroed by a following dropout layer already have zero gradient,
+        # so testing the output after dropout gives the same result
+        np.greater(self.out, 0, out=self.mask)
+        dout *= self.mask
+        return dout
+
+
+class DropoutLayer(object):
+    """
+    Dropout applied in place.
+    """
+
+    def __init__(self, index, dropout_param):
+        self.name = 'dropout' + str(index)
+        self.dropout_param = dropout_param
+
+    def request(self, arena, batch_size, train, grads):
+        pass
+
+    def resolve(self, arena, grads):
+        pass
+
+    def bind(self, params):
+        pass
+
+    def forward(self, x):
+        out, self.cache = dropout_forward(x, self.dropout_param, out=x)
+        return out
+
+    def backward(self, dout):
+        return dropout_backward(dout, self.cache)
+
+
+class ExecutionPlan(object):
+    """
+    The layers of a FullyConnectedNet compiled for a fixed batch size, dtype
+    and mode ('train' or 'test').
+
+    All activations and gradients live in one preallocated arena, and the
+    parameter names are resolved once at compile time, so forward() and
+    backward() do not allocate any arrays of the size of a layer. Because
+    optimizers may replace the parameter arrays, bind() has to be called with
+    the current parameters before every forward pass.
+
+    The returned activations and gradients are views of the arena and are
+    overwritten by the next call. If the network keeps its parameters in a
+    ParamBuffer, the gradients are written directly into its gradient views
+    instead.
+    """
+
+    def __init__(self, net, batch_size, mode):
+        self.batch_size = batch_size
+        self.mode = mode
+        self.dtype = np.dtype(net.dtype)
+        train = mode == 'train'
+
+        dims = [net.params['W' + str(i + 1)].shape[0] for i in range(net.num_layers)]
+        dims.append(net.params['W' + str(net.num_layers)].shape[1])
+
+        self.layers = []
+        self.affine_layers = []
+        for i in range(net.num_layers):
+            affine = AffineLayer(i + 1, dims[i], dims[i + 1], need_dx=i > 0)
+            self.layers.append(affine)
+            self.affine_layers.append(affine)
+
+            if i < net.num_layers - 1:
+                if net.use_batchnorm:
+                    self.layers.append(BatchNormLayer(i + 1, dims[i + 1], net.bn_params[i], affine))
+                self.layers.append(ReluLayer(i + 1, dims[i + 1]))
+                if net.use_dropout:
+                    self.layers.append(DropoutLayer(i + 1, net.dropout_param))
+
+        self.grads = {}
+        param_buffer = getattr(net, 'param_buffer', None)
+        if train and param_buffer is not None and param_buffer.dtype == self.dtype:
+            self.grads.update(param_buffer.grads)
+
+        self.arena = Arena(self.dtype)
+        self.mask_arena = Arena(np.bool_)
+        for layer in self.layers:
+            layer.request(self.mask_arena if isinstance(layer, ReluLayer) else self.arena, batch_size, train, self.grads)
+        self.arena.allocate()
+        self.mask_arena.allocate()
+
+        for layer in self.layers:
+            layer.resolve(self.mask_arena if isinstance(layer, ReluLayer) else self.arena, self.grads)
+
+        self.reg_buffer = None
+        if train:
+            size = max(dims[i] * dims[i + 1] for i in range(net.num_layers))
+            self.reg_buffer = np.empty(size, dtype=self.dtype)
+
+    def matches(self, X, mode):
+        return self.mode == mode and self.batch_size == X.shape[0] and self.dtype == X.dtype
+
+    def bind(self, params):
+        for layer in self.layers:
+            layer.bind(params)
+
+    def forward(self, X):
+        out = X.reshape(X.shape[0], -1)
+        for layer in self.layers:
+            out = layer.forward(out)
+        return out
+
+    def backward(self, dscores, reg=0.0):
+        """
+        Backpropagate dscores through the network and add the gradient of the
+        L2 regularization to the weight gradients. Returns a dictionary of
+        gradients with the same keys as the parameters.
+        """
+        dout = dscores.astype(self.dtype, copy=False)
+        for layer in reversed(self.layers):
+            dout = layer.backward(dout)
+
+        if reg != 0:
+            for layer in self.affine_layers:
+                scaled_w = self.reg_buffer[:layer.w.size].reshape(layer.w.shape)
+                np.multiply(layer.w, reg, out=scaled_w)
+                layer.dw += scaled_w
+        return dict(self.grads)
+
+    def regularization_loss(self, reg):
+        return reg * 0.5 * sum(float(np.vdot(layer.w, layer.w)) for layer in self.affine_layers)
@@ -3,6 +3,9 @@ import numpy as np
 from exercise_code.layers import *
 from exercise_code.layer_utils import *
 from exercise_code.features import *
+from exercise_code.backends import get_backend
+from exercise_code.param_buffer import ParamBuffer
+from exercise_code.classifiers.execution_plan import ExecutionPlan
 
 class TwoLayerNet(object):
     """
@@ -21,7 +24,7 @@ class TwoLayerNet(object):
     """
 
     def __init__(self, input_dim=3 * 32 * 32, hidden_dim=100, num_classes=10,
-                 weight_scale=1e-3, reg=0.0):
+                 weight_scale=1e-3, reg=0.0, backend=None):
         """
         Initialize a new network.
     
@@ -33,9 +36,12 @@ class TwoLayerNet(object):
         - weight_scale: Scalar giving the standard deviation for random
           initialization of the weights.
         - reg: Scalar giving L2 regularization strength.
+        - backend: Name of the layer backend (see exercise_code.backends); None
+          uses the process-wide default.
         """
         self.params = {}
         self.reg = reg
+        self.backend = backend
 
         ############################################################################
         # TODO: Initialize the weights and biases of the two-layer net. Weights    #
@@ -53,13 +59,17 @@ class TwoLayerNet(object):
         #                             END OF YOUR CODE                             #
         ############################################################################
 
-    def loss(self, X, y=None):
+    def loss(self, X, y=None, sample_weights=None, sample_losses=None):
         """
         Compute loss and gradient for a minibatch of data.
     
         Inputs:
         - X: Array of input data of shape (N, d_1, ..., d_k)
         - y: Array of labels, of shape (N,). y[i] gives the label for X[i].
+        - sample_weights: Optional array of shape (N,); the data loss is then
+          the mean of the losses of the samples weighted by sample_weights.
+        - sample_losses: Optional float64 array of shape (N,) that receives the
+          unweighted data loss of every sample.
     
         Returns:
         If y is None, then run a test-time forward pass of the model and return:
@@ -77,8 +87,9 @@ class TwoLayerNet(object):
         # TODO: Implement the forward pass for the two-layer net, computing the    #
         # class scores for X and storing them in the scores variable.              #
         ############################################################################
-        out, cache_1 = affine_relu_forward(X, self.params['W1'], self.params['b1'])
-        scores, cache_2 = affine_forward(out, self.params['W2'], self.params['b2'])
+        ops = get_backend(self.backend)
+        out, cache_1 = ops.affine_relu_forward(X, self.params['W1'], self.params['b1'])
+        scores, cache_2 = ops.affine_forward(out, self.params['W2'], self.params['b2'])
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -98,10 +109,10 @@ class TwoLayerNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        loss, dx = softmax_loss(scores, y)
+        loss, dx = ops.softmax_loss(scores, y, sample_weights, sample_losses)
         loss += self.reg * 0.5 * (np.sum(self.params['W1'] ** 2) + np.sum(self.params['W2'] ** 2))
-        dx, grads['W2'], grads['b2'] = affine_backward(dx, cache_2)
-        dx, grads['W1'], grads['b1'] = affine_relu_backward(dx, cache_1)
+        dx, grads['W2'], grads['b2'] = ops.affine_backward(dx, cache_2)
+        dx, grads['W1'], grads['b1'] = ops.affine_relu_backward(dx, cache_1)
         grads['W1'] += self.reg * self.params['W1']
         grads['W2'] += self.reg * self.params['W2']
         ############################################################################
@@ -129,7 +140,9 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3 * 32 * 32, num_classes=10,
                  dropout=0, use_batchnorm=False, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None, compiled=False,
+                 memory_budget=None, storage_dtype=None, backend=None,
+                 flat_params=True):
         """
         Initialize a new FullyConnectedNet.
         
@@ -149,12 +162,43 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - compiled: If True, loss() runs on an ExecutionPlan compiled for the
+          current batch size and mode, which reuses preallocated buffers for all
+          activations and gradients. The returned gradients are then overwritten
+          by the next call to loss(), so leave this off for gradient checking.
+        - memory_budget: If not None, the number of bytes the activations kept
+          for the backward pass may use. If storing the activations of all
+          layers would exceed it, loss() only keeps the inputs of every k-th
+          layer and recomputes the layers in between during the backward pass
+          (see checkpoint_interval). Can not be combined with compiled.
+        - storage_dtype: If not None, the activations cached for the backward
+          pass are stored in this datatype, e.g. np.float16, while all
+          computations are still performed in dtype. The loss is always
+          accumulated in float64. Can not be combined with compiled.
+        - backend: Name of the layer backend (see exercise_code.backends); None
+          uses the process-wide default. A compiled network runs its own
+          execution plan and does not use the backend.
+        - flat_params: If True, all parameters are views into one contiguous
+          ParamBuffer, self.param_buffer, so the Solver can update them with a
+          single call of the update rule.
         """
+        if compiled and memory_budget is not None:
+            raise ValueError('memory_budget can not be used with compiled=True')
+        if compiled and storage_dtype is not None and np.dtype(storage_dtype) != np.dtype(dtype):
+            raise ValueError('storage_dtype can not be used with compiled=True')
+
         self.use_batchnorm = use_batchnorm
         self.use_dropout = dropout > 0
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
+        self.compiled = compiled
+        self.memory_budget = memory_budget
+        self.storage_dtype = storage_dtype
+        self.backend = backend
+        # Optional FeaturePipeline, lets predict() run on raw images
+        self.feature_pipeline = None
+        self._plans = {}
         self.params = {}
         ############################################################################
         # TODO: Initialize the parameters of the network, storing all values in    #
@@ -203,32 +247,50 @@ class FullyConnectedNet(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
-    def loss(self, X, y=None):
+        self.flat_params = flat_params
+        self.param_buffer = ParamBuffer(self.params, dtype) if flat_params else None
+
+    def __getstate__(self):
+        # The compiled plans only hold buffers, they are rebuilt on demand, and
+        # the views of the parameter buffer would be pickled as copies
+        state = self.__dict__.copy()
+        state['_plans'] = {}
+        state['param_buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('compiled', False)
+        state.setdefault('memory_budget', None)
+        state.setdefault('storage_dtype', None)
+        state.setdefault('feature_pipeline', None)
+        state.setdefault('backend', None)
+        state.setdefault('_plans', {})
+        state.setdefault('flat_params', False)
+        self.__dict__.update(state)
+        if self.flat_params:
+            self.param_buffer = ParamBuffer(self.params, self.dtype)
+        else:
+            self.param_buffer = None
+
+    def loss(self, X, y=None, sample_weights=None, sample_losses=None):
         """
         Compute loss and gradient for the fully-connected net.
     
         Input / output: Same as TwoLayerNet above.
         """
-        X = X.astype(self.dtype)
+        X = X.astype(self.dtype, copy=False)
         mode = 'test' if y is None else 'train'
 
-        if np.prod(X.shape[1:]) != self.params['W1'].shape[0]:
-            X = X.reshape([-1, 3, 32, 32])
-            X = X.transpose(0, 2, 3, 1).copy()
-            num_color_bins = 20
-            feature_fns = [flatten, hog_feature, lambda img: color_histogram_hsv(img, nbin=num_color_bins)]
-            X = extract_features(X, feature_fns, verbose=True)
-
-            X -= self.mean_feat
-            X /= self.std_feat
-
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
         if self.dropout_param is not None:
             self.dropout_param['mode'] = mode
         if self.use_batchnorm:
             for bn_param in self.bn_params:
-                bn_param[mode] = mode
+                bn_param['mode'] = mode
+
+        if self.compiled:
+            return self._compiled_loss(X, y, mode, sample_weights, sample_losses)
 
         scores = None
         ############################################################################
@@ -243,19 +305,17 @@ class FullyConnectedNet(object):
         # self.bn_params[1] to the forward pass for the second batch normalization #
         # layer, etc.                                                              #
         ############################################################################
-        out = X
-        cache = {}
-        for i in range(self.num_layers):
-            out, cache['aff' + str(i + 1)] = affine_forward(out, self.params['W' + str(i + 1)], self.params['b' + str(i + 1)])
-
-            if i < self.num_layers - 1:
-                if self.use_batchnorm:
-                    out, cache['bn' + str(i + 1)] = batchnorm_forward(out, self.params['bng' + str(i + 1)], self.params['bnb' + str(i + 1)], self.bn_params[i])
-
-                out, cache['rel' + str(i + 1)] = relu_forward(out)
+        interval = None
+        if mode == 'train' and self.memory_budget is not None:
+            interval = self.checkpoint_interval(X.shape[0])
 
-                if self.use_dropout:
-                    out, cache['d' + str(i + 1)] = dropout_forward(out, self.dropout_param)
+        out = X
+        cache = {} if mode == 'train' else None
+        if interval is None:
+            for i in range(self.num_layers):
+                out = self._layer_forward(i, out, cache)
+        else:
+            out, checkpoints, cache = self._checkpointed_forward(out, interval)
 
         scores = out
         ############################################################################
@@ -280,25 +340,325 @@ class FullyConnectedNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        loss, dx = softmax_loss(scores, y)
+        loss, dx = get_backend(self.backend).softmax_loss(scores, y, sample_weights, sample_losses)
         for i in range(self.num_layers):
-            loss += self.reg * 0.5 * (np.sum(self.params['W' + str(i + 1)] ** 2))
+            W = self.params['W' + str(i + 1)]
+            loss += self.reg * 0.5 * float(np.vdot(W, W))
+
+        if interval is None:
+            for i in reversed(range(self.num_layers)):
+                dx = self._layer_backward(i, dx, cache, grads)
+        else:
+            self._checkpointed_backward(dx, interval, checkpoints, cache, grads)
 
-        for i in reversed(range(self.num_layers)):
+        ############################################################################
+        #                             END OF YOUR CODE                             #
+        ############################################################################
+
+        return loss, grads
+
+    def _features(self, X):
+        """
+        Run the attached feature pipeline if X holds raw images instead of the
+        features the network was trained on.
+        """
+        if self.feature_pipeline is not None and np.prod(X.shape[1:]) != self.params['W1'].shape[0]:
+            X = self.feature_pipeline.transform(X)
+        return X
+
+    def fold_params(self):
+        """
+        Fold the test-time batch normalization and dropout into the weights of
+        the affine layers.
+
+        Batch normalization with the running averages is an affine transform
+        of its input and is folded into the preceding affine layer. Test-time
+        dropout scales the activations by (1 - p), which is folded into the
+        following affine layer.
+
+        Returns a list of tuples (W, b), one per layer, such that the test-time
+        network is {affine - relu} x (L - 1) - affine with these parameters.
+        """
+        folded = []
+        for i in range(self.num_layers):
+            W = self.params['W' + str(i + 1)]
+            b = self.params['b' + str(i + 1)]
+
+            if i > 0 and self.use_dropout:
+                W = W * (1 - self.dropout_param['p'])
+
+            if i < self.num_layers - 1 and self.use_batchnorm:
+                bn_param = self.bn_params[i]
+                running_mean = bn_param.get('running_mean', np.zeros_like(b))
+                running_var = bn_param.get('running_var', np.zeros_like(b))
+                scale = self.params['bng' + str(i + 1)] / np.sqrt(running_var + bn_param.get('eps', 1e-5))
+                W = W * scale
+                b = (b - running_mean) * scale + self.params['bnb' + str(i + 1)]
+
+            folded.append((W.astype(self.dtype, copy=False), b.astype(self.dtype, copy=False)))
+
+        return folded
+
+    def predict_scores(self, X, chunk_size=1000):
+        """
+        Compute test-time class scores with the folded parameters of
+        fold_params(). X is processed in chunks of chunk_size samples, reusing
+        the same activation buffers for every chunk. If a feature_pipeline is
+        attached, X may also hold raw images, whose features are extracted
+        chunk by chunk.
+
+        Inputs:
+        - X: Array of data, of shape (N, d_1, ..., d_k)
+        - chunk_size: Number of samples processed at once
+
+        Returns:
+        - scores: Array of shape (N, C) giving the class scores
+        """
+        layers = self.fold_params()
+        N = X.shape[0]
+        chunk_size = max(min(chunk_size, N), 1)
+
+        buffers = [np.empty((chunk_size, W.shape[1]), dtype=self.dtype) for W, b in layers[:-1]]
+        scores = np.empty((N, layers[-1][0].shape[1]), dtype=self.dtype)
+        input_buffer = None
+
+        for start in range(0, N, chunk_size):
+            x = self._features(X[start:start + chunk_size])
+            x = x.reshape(x.shape[0], -1)
+            n = x.shape[0]
+
+            # Cast into a fixed buffer instead of allocating a copy per chunk
+            if x.dtype != self.dtype:
+                if input_buffer is None:
+                    input_buffer = np.empty((chunk_size, x.shape[1]), dtype=self.dtype)
+                np.copyto(input_buffer[:n], x)
+                x = input_buffer[:n]
+
+            for i, (W, b) in enumerate(layers):
+                out = scores[start:start + n] if i == self.num_layers - 1 else buffers[i][:n]
+                np.matmul(x, W, out=out)
+                out += b
+                if i < self.num_layers - 1:
+                    np.maximum(out, 0, out=out)
+                x = out
+
+        return scores
+
+    def predict(self, X, chunk_size=1000, out=None):
+        """
+        Predict labels for X, see predict_scores.
+
+        Inputs:
+        - out: Optional array of shape (N,) and dtype np.intp the predicted
+          labels are written to
+
+        Returns:
+        - y_pred: Array of shape (N,) giving the predicted labels
+        """
+        return np.argmax(self.predict_scores(X, chunk_size), axis=1, out=out)
+
+    def _layer_forward(self, i, out, cache):
+        """
+        Forward pass of layer i: affine - [batch norm] - relu - [dropout], or
+        only the affine transform for the last layer. The caches of the layer
+        are stored in cache, with the cached activations converted to
+        self.storage_dtype; if cache is None they are dropped.
+        """
+        ops = get_backend(self.backend)
+        W, b = self.params['W' + str(i + 1)], self.params['b' + str(i + 1)]
+        affine_cache = fused_cache = relu_cache = dropout_cache = None
+
+        if i == self.num_layers - 1:
+            out, affine_cache = ops.affine_forward(out, W, b)
+        elif self.use_batchnorm:
+            out, fused_cache = ops.affine_bn_relu_forward(out, W, b, self.params['bng' + str(i + 1)], self.params['bnb' + str(i + 1)], self.bn_params[i])
+        else:
+            out, affine_cache = ops.affine_forward(out, W, b)
+            out, relu_cache = ops.relu_forward(out)
+
+        if i < self.num_layers - 1 and self.use_dropout:
+            out, dropout_cache = ops.dropout_forward(out, self.dropout_param)
+
+        if cache is not None:
+            if affine_cache is not None:
+                x, w, b = affine_cache
+                cache['aff' + str(i + 1)] = (self._stored(x), w, b)
+            if fused_cache is not None:
+                (x, w, b), (x_norm, gamma, inv_std), relu_out = fused_cache
+                cache['abr' + str(i + 1)] = ((self._stored(x), w, b), (self._stored(x_norm), gamma, inv_std), self._stored(relu_out))
+            if relu_cache is not None:
+                cache['rel' + str(i + 1)] = self._stored(relu_cache)
+            if dropout_cache is not None:
+                cache['d' + str(i + 1)] = dropout_cache
+
+        return out
+
+    def _stored(self, x):
+        # The backward passes promote activations stored in a smaller dtype
+        # back to the compute dtype
+        if self.storage_dtype is None or x.dtype == self.storage_dtype:
+            return x
+        return x.astype(self.storage_dtype)
+
+    def _layer_backward(self, i, dx, cache, grads):
+        """
+        Backward pass of layer i using the caches stored by _layer_forward.
+        The gradients of the parameters of the layer are stored in grads.
+        """
+        ops = get_backend(self.backend)
+        if i < self.num_layers - 1 and self.use_dropout:
+            dx = ops.dropout_backward(dx, cache['d' + str(i + 1)])
+
+        if i < self.num_layers - 1 and self.use_batchnorm:
+            dx, grads['W' + str(i + 1)], grads['b' + str(i + 1)], grads['bng' + str(i + 1)], grads['bnb' + str(i + 1)] = ops.affine_bn_relu_backward(dx, cache['abr' + str(i + 1)])
+        else:
             if i < self.num_layers - 1:
-                if self.use_dropout:
-                    dx = dropout_backward(dx, cache['d' + str(i + 1)])
+                dx = ops.relu_backward(dx, cache['rel' + str(i + 1)])
+            dx, grads['W' + str(i + 1)], grads['b' + str(i + 1)] = ops.affine_backward(dx, cache['aff' + str(i + 1)])
+        grads['W' + str(i + 1)] += self.reg * self.params['W' + str(i + 1)]
 
-                dx = relu_backward(dx, cache['rel' + str(i + 1)])
+        return dx
 
-                if self.use_batchnorm:
-                    dx, grads['bng' + str(i + 1)], grads['bnb' + str(i + 1)] = batchnorm_backward(dx, cache['bn' + str(i + 1)])
+    def activation_bytes(self, batch_size):
+        """
+        Estimate the memory used by the caches of every layer at training-time.
 
-            dx, grads['W' + str(i + 1)], grads['b' + str(i + 1)] = affine_backward(dx, cache['aff' + str(i + 1)])
-            grads['W' + str(i + 1)] += self.reg * self.params['W' + str(i + 1)]
+        Returns a tuple of:
+        - layer_bytes: List giving the number of bytes cached by each layer
+        - input_bytes: List giving the size in bytes of the input of each layer
+        """
+        itemsize = np.dtype(self.dtype).itemsize
+        layer_bytes, input_bytes = [], []
+        for i in range(self.num_layers):
+            D, M = self.params['W' + str(i + 1)].shape
+            input_bytes.append(batch_size * D * itemsize)
+            if i == self.num_layers - 1:
+                layer_bytes.append(batch_size * M * itemsize)
+                continue
 
-        ############################################################################
-        #                             END OF YOUR CODE                             #
-        ############################################################################
+            # relu input and output (x_norm and the relu output with batch
+            # normalization), dropout output and its bit-packed mask
+            arrays = 2 + self.use_dropout
+            layer_bytes.append(batch_size * M * (arrays * itemsize + self.use_dropout / 8.))
+
+        return layer_bytes, input_bytes
+
+    def checkpoint_interval(self, batch_size):
+        """
+        Choose the number of layers k between two activation checkpoints for
+        the given batch size.
+
+        With checkpoints, the input of every k-th layer is kept and the caches
+        of a segment of k layers only exist while that segment is processed;
+        the caches of the last segment are kept from the forward pass, all
+        other segments are recomputed once. The largest k whose estimated
+        memory fits into self.memory_budget is used, since larger segments
+        leave fewer layers to recompute. If no k fits, the one using the least
+        memory is used.
+
+        Returns None if the caches of all layers fit into the budget, in which
+        case no checkpointing is needed.
+        """
+        layer_bytes, input_bytes = self.activation_bytes(batch_size)
+        if self.memory_budget is None or sum(layer_bytes) <= self.memory_budget:
+            return None
+
+        def memory(k):
+            starts = range(0, self.num_layers, k)
+            checkpoints = sum(input_bytes[start] for start in starts if start > 0)
+            return checkpoints + max(sum(layer_bytes[start:start + k]) for start in starts)
+
+        intervals = range(1, self.num_layers)
+        if len(intervals) == 0:
+            return None
+        fitting = [k for k in intervals if memory(k) <= self.memory_budget]
+        if fitting:
+            return max(fitting)
+        return min(intervals, key=memory)
+
+    def _checkpointed_forward(self, X, interval):
+        """
+        Forward pass that keeps the input of every interval-th layer, together
+        with the state of the dropout random number generator at that point.
+        Only the caches of the last segment are returned.
+
+        Returns a tuple of:
+        - scores: Class scores of shape (N, C)
+        - checkpoints: List of tuples (first layer, input, generator state)
+        - cache: Caches of the layers of the last segment
+        """
+        last_start = (self.num_layers - 1) // interval * interval
+        checkpoints = []
+        cache = {}
+        out = X
+        for i in range(self.num_layers):
+            if i % interval == 0:
+                checkpoints.append((i, out, self._dropout_state()))
+            out = self._layer_forward(i, out, cache if i >= last_start else None)
+
+        return out, checkpoints, cache
+
+    def _checkpointed_backward(self, dx, interval, checkpoints, cache, grads):
+        """
+        Backward pass for _checkpointed_forward. Every segment but the last is
+        recomputed from its checkpoint before backpropagating through it. The
+        dropout masks are replayed by restoring the generator state of the
+        checkpoint, and the running averages of the batch normalization layers
+        are restored after the recomputation so they are only updated once.
+        """
+        for start, x, dropout_state in reversed(checkpoints):
+            end = min(start + interval, self.num_layers)
+
+            if start != checkpoints[-1][0]:
+                current_state = self._dropout_state()
+                running = [(bn_param['running_mean'], bn_param['running_var']) for bn_param in self.bn_params]
+                self._set_dropout_state(dropout_state)
+
+                cache = {}
+                out = x
+                for i in range(start, end):
+                    out = self._layer_forward(i, out, cache)
+
+                self._set_dropout_state(current_state)
+                for bn_param, (running_mean, running_var) in zip(self.bn_params, running):
+                    bn_param['running_mean'], bn_param['running_var'] = running_mean, running_var
+
+            for i in reversed(range(start, end)):
+                dx = self._layer_backward(i, dx, cache, grads)
+                # Free the caches of the layer as soon as they have been used
+                for name in ('aff', 'abr', 'rel', 'd'):
+                    cache.pop(name + str(i + 1), None)
+
+        return dx
+
+    def _dropout_state(self):
+        # With a seed every mask is the same, there is no state to replay
+        if not self.use_dropout or 'seed' in self.dropout_param:
+            return None
+        return dropout_generator(self.dropout_param).bit_generator.state
+
+    def _set_dropout_state(self, state):
+        if state is not None:
+            dropout_generator(self.dropout_param).bit_generator.state = state
+
+    def _compiled_loss(self, X, y, mode, sample_weights=None, sample_losses=None):
+        """
+        Same as loss(), using an ExecutionPlan for the batch size of X. There is
+        one plan per mode, which is recompiled whenever the batch size or dtype
+        changes.
+        """
+        X = X.astype(self.dtype, copy=False)
+        plan = self._plans.get(mode)
+        if plan is None or not plan.matches(X, mode):
+            plan = self._plans[mode] = ExecutionPlan(self, X.shape[0], mode)
+        plan.bind(self.params)
+
+        scores = plan.forward(X)
+        if mode == 'test':
+            return scores.copy()
+
+        loss, dscores = softmax_loss(scores, y, sample_weights, sample_losses)
+        loss += plan.regularization_loss(self.reg)
+        grads = plan.backward(dscores, self.reg)
 
         return loss, grads
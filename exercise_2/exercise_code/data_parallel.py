@@ -0,0 +1,373 @@
+import multiprocessing
+import traceback
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _create_shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_shared(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _layout(params):
+    # Parameters are laid out in the order of their sorted names, like in a
+    # ParamBuffer, so that a ParamBuffer can be copied in one pass
+    layout, offset = [], 0
+    for k in sorted(params):
+        size = int(np.prod(np.shape(params[k])))
+        layout.append((k, slice(offset, offset + size), np.shape(params[k])))
+        offset += size
+    return layout, offset
+
+
+def _split_dropout_stream(model, rank):
+    # The pickled model carries the dropout generator of the parent; every
+    # worker continues on its own jumped copy so the shards get different masks
+    dropout_param = getattr(model, 'dropout_param', None)
+    if isinstance(dropout_param, dict) and 'rng' in dropout_param:
+        bit_generator = dropout_param['rng'].bit_generator
+        if hasattr(bit_generator, 'jumped'):
+            dropout_param['rng'] = np.random.Generator(bit_generator.jumped(rank))
+
+
+def _worker(rank, conn, seed):
+    """
+    Main loop of a worker process. Commands are received on conn:
+
+    - ('model', model, augment): replace the model and the augmentation
+      function
+    - ('attach', specs): attach to the shared arrays described by specs, a
+      dictionary mapping names to (segment name, shape, dtype)
+    - ('step', start, stop, weight, weighted): compute the loss and gradients
+      on the training samples indices[start:stop] with the shared parameters
+      and write them, multiplied by weight, into row rank - 1 of the shared
+      gradients and losses. If weighted is True, the samples are weighted by
+      sample_weights[start:stop] and their losses are written into
+      sample_losses[start:stop].
+    - ('stop',)
+
+    Every command except stop is acknowledged with ('ok', None) or
+    ('error', traceback).
+    """
+    np.random.seed(None if seed is None else seed + rank)
+    model, layout, augment = None, None, None
+    segments, arrays = {}, {}
+    try:
+        while True:
+            message = conn.recv()
+            command = message[0]
+            if command == 'stop':
+                break
+            try:
+                if command == 'model':
+                    model, augment = message[1], message[2]
+                    _split_dropout_stream(model, rank)
+                    layout, _ = _layout(model.params)
+                elif command == 'attach':
+                    for name, spec in message[1].items():
+                        if name in segments:
+                            del arrays[name]
+                            segments.pop(name).close()
+                        segments[name], arrays[name] = _attach_shared(spec)
+                elif command == 'step':
+                    _, start, stop, weight, weighted = message
+                    params = arrays['params']
+                    for k, s, shape in layout:
+                        np.copyto(model.params[k], params[s].reshape(shape), casting='unsafe')
+
+                    indices = arrays['indices'][start:stop]
+                    X = arrays['X'][indices]
+                    if augment is not None:
+                        X = augment(X)
+                    if weighted:
+                        loss, grads = model.loss(X, arrays['y'][indices], sample_weights=arrays['sample_weights'][start:stop],
+                                                 sample_losses=arrays['sample_losses'][start:stop])
+                    else:
+                        loss, grads = model.loss(X, arrays['y'][indices])
+
+                    row = arrays['grads'][rank - 1]
+                    for k, s, shape in layout:
+                        np.multiply(grads[k], weight, out=row[s].reshape(shape), casting='unsafe')
+                    arrays['losses'][rank - 1] = weight * loss
+                else:
+                    raise ValueError('Unknown command "%s"' % command)
+                conn.send(('ok', None))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        arrays.clear()
+        for shm in segments.values():
+            shm.close()
+        conn.close()
+
+
+def _shutdown(processes, conns, segments, retired):
+    for conn in conns:
+        try:
+            conn.send(('stop',))
+        except (OSError, ValueError):
+            pass
+        conn.close()
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    for shm in segments.values():
+        shm.unlink()
+    for shm in list(segments.values()) + retired:
+        try:
+            shm.close()
+        except BufferError:
+            # Arrays handed out by set_data still use the segment; its memory
+            # is released together with them
+            pass
+    segments.clear()
+    del retired[:]
+
+
+class DataParallel(object):
+    """
+    Computes the loss and gradients of a minibatch on several processes of one
+    machine.
+
+    The minibatch is split into num_workers contiguous shards. The calling
+    process computes the first shard with its own model while num_workers - 1
+    worker processes, each holding a copy of the model, compute the others.
+    Parameters, training data, minibatch indices and gradients are exchanged
+    through shared memory: before every step the parameters are copied into
+    a shared array that the workers copy into their models, and every worker
+    writes its gradients, scaled by the fraction of the minibatch in its
+    shard, into its own row of a shared reduction array that the calling
+    process sums up. Only the model itself is pickled, when it is replaced.
+
+    Since the data loss of softmax_loss is a mean over the minibatch and the
+    regularization is added to every shard, the weighted sum of the shard
+    losses and gradients equals those of the whole minibatch for models
+    without batch normalization and dropout, also with sample weights.
+
+    Batch normalization normalizes every shard with its own statistics and
+    is not synchronized across the workers, as in "ghost" batch
+    normalization; with small shards this changes the gradients. The running
+    averages used at test time are those of the model of the calling
+    process, updated from the first shard only. Dropout draws independent
+    masks on every process. An augmentation function is applied by every
+    process to its own shard, with its own random state.
+
+    Example usage:
+
+    data_parallel = DataParallel(model, num_workers=4)
+    X_train, y_train = data_parallel.set_data(X_train, y_train)
+    batch_mask = np.random.choice(X_train.shape[0], 200)
+    loss, grads = data_parallel.loss(batch_mask)
+    data_parallel.close()
+    """
+
+    def __init__(self, model, num_workers, seed=None, start_method=None, augment=None):
+        """
+        Inputs:
+        - model: A model object conforming to the API of the Solver; it must
+          be picklable.
+        - num_workers: Number of processes computing a shard, including the
+          calling process.
+        - seed: If not None, the global random number generator of worker
+          rank is seeded with seed + rank.
+        - start_method: Start method of the worker processes, see
+          multiprocessing.get_context. Default is None, the platform default.
+        - augment: Optional function augment(X_batch) applied to the samples
+          of every shard, e.g. augment_batch in data_utils.py; it must be
+          picklable.
+        """
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1')
+        self.num_workers = num_workers
+        self.augment = augment
+        self.model = None
+        self._segments = {}
+        self._retired = []
+        self.arrays = {}
+        self._processes = []
+        self._conns = []
+
+        # Workers that started without the resource tracker of this process
+        # would start their own, which unlinks the shared memory they attached
+        # to when they exit
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context(start_method)
+        for rank in range(1, num_workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, args=(rank, child_conn, seed), daemon=True)
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._conns.append(conn)
+        self._finalizer = weakref.finalize(self, _shutdown, self._processes, self._conns, self._segments, self._retired)
+
+        self.set_model(model)
+
+    def close(self):
+        """
+        Stop the worker processes and free the shared memory.
+        """
+        self._finalizer()
+
+    def _broadcast(self, message, conns=None):
+        conns = self._conns if conns is None else conns
+        for conn in conns:
+            conn.send(message)
+        self._wait(conns)
+
+    def _wait(self, conns):
+        errors = []
+        for conn in conns:
+            try:
+                status, error = conn.recv()
+            except EOFError:
+                status, error = 'error', 'The worker process exited'
+            if status != 'ok':
+                errors.append(error)
+        if errors:
+            raise RuntimeError('Data parallel worker failed:\n' + errors[0])
+
+    def _allocate(self, name, shape, dtype):
+        """
+        Create the shared array name and attach the workers to it, replacing
+        an existing array of the same name.
+        """
+        if name in self._segments:
+            self.arrays.pop(name)
+            old = self._segments.pop(name)
+            old.unlink()
+            self._retired.append(old)
+
+        # Arrays of retired segments may still be in use
+        for shm in self._retired[:]:
+            try:
+                shm.close()
+                self._retired.remove(shm)
+            except BufferError:
+                pass
+
+        shm, array = _create_shared(shape, dtype)
+        self._segments[name], self.arrays[name] = shm, array
+        self._broadcast(('attach', {name: (shm.name, array.shape, array.dtype.str)}))
+        return array
+
+    def set_model(self, model):
+        """
+        Send model to the workers and allocate the shared parameters and
+        gradients for its parameters.
+        """
+        self.model = model
+        self.layout, size = _layout(model.params)
+        self.dtype = np.result_type(*[model.params[k] for k, _, _ in self.layout])
+
+        self._broadcast(('model', model, self.augment))
+        self._allocate('params', (size,), self.dtype)
+        self._allocate('grads', (max(self.num_workers - 1, 1), size), self.dtype)
+        self._allocate('losses', (max(self.num_workers - 1, 1),), np.float64)
+
+        # The reduced gradients, returned by loss()
+        self.grad = np.empty(size, dtype=self.dtype)
+        self.grads = {k: self.grad[s].reshape(shape) for k, s, shape in self.layout}
+
+    def set_data(self, X, y):
+        """
+        Copy the training data into shared memory.
+
+        Returns a tuple of:
+        - X, y: The shared copies, which should be used instead of the inputs
+          so that the data is only held once; loss() samples from them.
+        """
+        if X is self.arrays.get('X') and y is self.arrays.get('y'):
+            return X, y
+        X_shared = self._allocate('X', X.shape, X.dtype)
+        X_shared[...] = X
+        y_shared = self._allocate('y', np.shape(y), np.asarray(y).dtype)
+        y_shared[...] = y
+        return X_shared, y_shared
+
+    def _share_params(self):
+        params = self.arrays['params']
+        param_buffer = getattr(self.model, 'param_buffer', None)
+        if param_buffer is not None and param_buffer.keys == [k for k, _, _ in self.layout] and \
+                all(self.model.params[k] is param_buffer.views[k] for k in param_buffer.keys):
+            np.copyto(params, param_buffer.data, casting='unsafe')
+            return
+        for k, s, shape in self.layout:
+            np.copyto(params[s].reshape(shape), self.model.params[k], casting='unsafe')
+
+    def loss(self, batch_mask, sample_weights=None, sample_losses=None):
+        """
+        Compute the loss and gradients of the model on a minibatch of the
+        shared training data.
+
+        Inputs:
+        - batch_mask: Array of shape (N,) giving the indices of the minibatch
+          in the training data; N must be at least num_workers.
+        - sample_weights: Optional array of shape (N,) of weights of the
+          samples, passed on to model.loss, which must then accept the
+          sample_weights and sample_losses arguments of FullyConnectedNet.
+        - sample_losses: Optional float64 array of shape (N,) that receives
+          the unweighted loss of every sample if sample_weights is given.
+
+        Returns a tuple of:
+        - loss: Scalar giving the loss of the minibatch
+        - grads: Dictionary mapping parameter names to gradients. The arrays
+          are reused by the next call.
+        """
+        if 'X' not in self.arrays:
+            raise ValueError('set_data must be called before loss')
+        N = len(batch_mask)
+        if N < self.num_workers:
+            raise ValueError('The batch size must be at least the number of workers')
+        if 'indices' not in self.arrays or self.arrays['indices'].shape[0] < N:
+            self._allocate('indices', (N,), np.intp)
+            self._allocate('sample_weights', (N,), np.float64)
+            self._allocate('sample_losses', (N,), np.float64)
+        indices = self.arrays['indices']
+        indices[:N] = batch_mask
+        weighted = sample_weights is not None
+        if weighted:
+            self.arrays['sample_weights'][:N] = sample_weights
+        self._share_params()
+
+        bounds = [N * rank // self.num_workers for rank in range(self.num_workers + 1)]
+        for rank, conn in enumerate(self._conns, 1):
+            conn.send(('step', bounds[rank], bounds[rank + 1], (bounds[rank + 1] - bounds[rank]) / N, weighted))
+
+        # The first shard is computed here while the workers run
+        try:
+            shard = indices[:bounds[1]]
+            X = self.arrays['X'][shard]
+            if self.augment is not None:
+                X = self.augment(X)
+            if weighted:
+                loss, grads = self.model.loss(X, self.arrays['y'][shard], sample_weights=sample_weights[:bounds[1]],
+                                              sample_losses=self.arrays['sample_losses'][:bounds[1]])
+            else:
+                loss, grads = self.model.loss(X, self.arrays['y'][shard])
+            weight = bounds[1] / N
+            for k, _, _ in self.layout:
+                np.multiply(grads[k], weight, out=self.grads[k], casting='unsafe')
+            loss = weight * loss
+        finally:
+            self._wait(self._conns)
+
+        for row in self.arrays['grads'][:self.num_workers - 1]:
+            self.grad += row
+        loss += self.arrays['losses'][:self.num_workers - 1].sum()
+        if weighted and sample_losses is not None:
+            sample_losses[...] = self.arrays['sample_losses'][:N]
+        return loss, self.grads
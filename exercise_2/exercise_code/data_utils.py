@@ -2,35 +2,41 @@ import pickle as pickle
 import numpy as np
 import os
 from exercise_code.features import *
-import cv2
 
 
-def load_CIFAR_batch(filename):
-    """ load single batch of cifar """
+def load_CIFAR_batch(filename, dtype=np.float64):
+    """ load single batch of cifar, with the images in dtype """
     with open(filename, 'rb') as f:
         datadict = pickle.load(f, encoding='latin1')
-        X = np.array(datadict['data'])
+        X = np.asarray(datadict['data'])
         Y = np.array(datadict['labels'])
-        X = X.reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1).astype("float")
+        # Cast the raw pixels while copying the transposed images into C
+        # order, so that no intermediate copy is made and gathering samples
+        # reads whole images
+        X = np.ascontiguousarray(X.reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1), dtype=dtype)
         return X, Y
 
 
-def load_CIFAR10(ROOT):
+def load_CIFAR10(ROOT, dtype=np.float64):
     """ load all of cifar """
     f = os.path.join(ROOT, 'cifar10_train.p')
-    Xtr, Ytr = load_CIFAR_batch(f)
+    Xtr, Ytr = load_CIFAR_batch(f, dtype)
     return Xtr, Ytr
 
 
-def get_CIFAR10_data(num_training=48000, num_validation=1000, num_test=1000):
+def get_CIFAR10_data(num_training=48000, num_validation=1000, num_test=1000, dtype=np.float32):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The images are returned in dtype, which should match the dtype of the
+    network so that no casts are needed during training, with the mean
+    training image, which is returned as 'mean_image', subtracted.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'datasets/'
-    X, y = load_CIFAR10(cifar10_dir)
+    X, y = load_CIFAR10(cifar10_dir, dtype)
 
     # Subsample the data
     # Our training set will be the first num_train points from the original
@@ -51,7 +57,7 @@ def get_CIFAR10_data(num_training=48000, num_validation=1000, num_test=1000):
     y_test = y[mask]
 
     # Normalize the data: subtract the mean image
-    mean_image = np.mean(X_train, axis=0)
+    mean_image = np.mean(X_train, axis=0, dtype=np.float64).astype(dtype)
     X_train -= mean_image
     X_val -= mean_image
     X_test -= mean_image
@@ -66,85 +72,131 @@ def get_CIFAR10_data(num_training=48000, num_validation=1000, num_test=1000):
         'X_train': X_train, 'y_train': y_train,
         'X_val': X_val, 'y_val': y_val,
         'X_test': X_test, 'y_test': y_test,
+        'mean_image': mean_image,
     }
 
-def data_augm(images, labels, factor, scale_min, scale_max, transl_max):
-    new_images = np.zeros([images.shape[0] * factor, images.shape[1], images.shape[2], images.shape[3]])
-    new_labels = np.zeros([labels.shape[0] * factor], dtype=np.int)
-
-    index = 0
-    next_new_index = 0
-    for image in images:
-        for i in range(factor):
-            new_images[next_new_index] = data_augm_image(np.array(image), scale_min, scale_max, transl_max)
-            new_labels[next_new_index] = labels[index]
-            next_new_index += 1
-        index += 1
-    return new_images, new_labels
-
-def data_augm_image(image, scale_min, scale_max, transl_max):
-    #crop_image(image, scale_min, scale_max)
-    #return translate_image(image, transl_max)
-    return flip_image(image)
-
-def flip_image(image):
-    if np.random.rand() < .5:
-        image = image[:, ::-1, :]
-    return image
-
-def crop_image(image, scale_min, scale_max):
-    img_size = image.shape[0]
-    scale_size = np.random.randint(img_size * scale_min, img_size * scale_max)
-    image = cv2.resize(image, dsize=(scale_size, scale_size), interpolation=cv2.INTER_CUBIC)
-
-    top = np.random.randint(0, scale_size - img_size)
-    left = np.random.randint(0, scale_size - img_size)
-    image = image[top:top + img_size, left:left + img_size, :]
-    return image
-
-def translate_image(image, transl_max):
-    new_image = np.zeros_like(image)
-    x = np.random.randint(-transl_max, transl_max)
-    y = np.random.randint(-transl_max, transl_max)
-    width = image.shape[0] - abs(x)
-    height = image.shape[1] - abs(y)
-
-    new_image[max(0, -x):max(0, -x) + width, max(0, -y):max(0, -y) + height, :] = image[max(0, x):max(0, x) + width, max(0, y):max(0, y) + height, :]
-
-    return new_image
-
-
-def extract_features_initial(data):
-    num_color_bins = 20  # Number of bins in the color histogram
-    feature_fns = [flatten, hog_feature, lambda img: color_histogram_hsv(img, nbin=num_color_bins)]
-    X_train_feats = extract_features(data['X_train'], feature_fns, verbose=True)
-    X_val_feats = extract_features(data['X_val'], feature_fns)
-
-    # Preprocessing: Subtract the mean feature
-    mean_feat = np.mean(X_train_feats, axis=0, keepdims=True)
-    X_train_feats -= mean_feat
-    X_val_feats -= mean_feat
-
-    # Preprocessing: Divide by standard deviation. This ensures that each feature
-    # has roughly the same scale.
-    std_feat = np.std(X_train_feats, axis=0, keepdims=True)
-    X_train_feats /= std_feat
-    X_val_feats /= std_feat
+def augment_batch(images, scale_min=1.0, scale_max=1.0, transl_max=0, flip=True, rng=None, out=None):
+    """
+    Randomly augment a minibatch of images with vectorized operations over the
+    whole batch. In this order, every image is
+
+    - scaled by a factor drawn uniformly from [scale_min, scale_max) and
+      cropped back to its size at a random position, with bilinear
+      interpolation; skipped if scale_max <= 1
+    - translated by up to transl_max pixels along both axes, padding with
+      zeros (the mean image); skipped if transl_max is 0
+    - flipped horizontally with probability 0.5 if flip is True
+
+    Inputs:
+    - images: Array of shape (N, H, W, C)
+    - rng: np.random.RandomState the transformations are drawn from; default
+      is the global np.random state
+    - out: Optional array of the shape and dtype of images the augmented
+      images are written to; it must not overlap with images
+
+    Returns:
+    - out: Array of shape (N, H, W, C) with the augmented images
+    """
+    rng = np.random if rng is None else rng
+    if out is None:
+        out = np.empty_like(images)
+
+    x = images
+    if scale_max > 1.0:
+        x = _scale_crop_batch(x, scale_min, scale_max, rng)
+    if transl_max > 0:
+        x = _translate_batch(x, transl_max, rng)
+
+    np.copyto(out, x, casting='unsafe')
+    if flip:
+        flips = np.flatnonzero(rng.rand(x.shape[0]) < .5)
+        out[flips] = x[flips, :, ::-1]
+    return out
+
+
+def _scale_crop_batch(images, scale_min, scale_max, rng):
+    N, H, W, C = images.shape
+    scale = rng.uniform(scale_min, scale_max, size=N)
+
+    # Every image is resampled from a window of size / scale pixels at a
+    # random offset. Linear interpolation along an axis is a matrix with two
+    # nonzero weights per row, so the batch is resampled with two batched
+    # matrix products, first along the rows and then along the columns
+    def interpolation(size):
+        window = size / scale
+        start = rng.uniform(size=N) * np.maximum(size - window, 0)
+        coords = start[:, None] + (np.arange(size) + 0.5) / scale[:, None] - 0.5
+        coords = np.clip(coords, 0, size - 1)
+        lower = np.floor(coords).astype(np.intp)
+        upper = np.minimum(lower + 1, size - 1)
+        weight = coords - lower
+
+        # At the border lower == upper with weight 0, so lower is set last
+        matrix = np.zeros((N, size, size), dtype=images.dtype)
+        n, i = np.arange(N)[:, None], np.arange(size)[None, :]
+        matrix[n, i, upper] = weight
+        matrix[n, i, lower] = 1 - weight
+        return matrix
+
+    rows = np.matmul(interpolation(H), images.reshape(N, H, W * C)).reshape(N, H, W, C)
+    return np.matmul(interpolation(W)[:, None], rows)
+
+
+def _translate_batch(images, transl_max, rng):
+    N, H, W, C = images.shape
+    t = transl_max
+    padded = np.zeros((N, H + 2 * t, W + 2 * t, C), dtype=images.dtype)
+    padded[:, t:t + H, t:t + W] = images
+
+    # View of all (2t + 1)^2 translated windows of every image; image n is
+    # translated by (x[n], y[n]), i.e. out[n, i, j] = images[n, i + x, j + y]
+    s = padded.strides
+    windows = np.lib.stride_tricks.as_strided(padded, shape=(N, 2 * t + 1, 2 * t + 1, H, W, C),
+                                              strides=(s[0], s[1], s[2], s[1], s[2], s[3]), writeable=False)
+    x = rng.randint(-t, t, size=N)
+    y = rng.randint(-t, t, size=N)
+    return windows[np.arange(N), x + t, y + t]
+
+
+def data_augm(images, labels, factor, scale_min, scale_max, transl_max, chunk_size=1000, rng=None, geometric=False):
+    """
+    Return factor randomly augmented copies of every image, see augment_batch,
+    and their labels. The images are augmented in chunks of chunk_size with
+    rng, by default the global np.random state.
 
-    return {
-        'X_train': X_train_feats, 'y_train': data['y_train'],
-        'X_val': X_val_feats, 'y_val': data['y_val']
-    }, mean_feat, std_feat
+    The images are only flipped unless geometric is True; then they are also
+    scaled and cropped by scale_min and scale_max and translated by up to
+    transl_max pixels.
+    """
+    if not geometric:
+        scale_min, scale_max, transl_max = 1.0, 1.0, 0
+    new_images = np.empty((images.shape[0] * factor,) + images.shape[1:], dtype=images.dtype)
+    new_labels = np.repeat(labels, factor)
+
+    for i in range(factor):
+        # Copy i of image n is stored at n * factor + i
+        augmented = new_images[i::factor]
+        for start in range(0, images.shape[0], chunk_size):
+            augment_batch(images[start:start + chunk_size], scale_min, scale_max, transl_max,
+                          rng=rng, out=augmented[start:start + chunk_size])
+    return new_images, new_labels
 
-def extract_features_of_images(images, mean_feat, std_feat):
-    num_color_bins = 10  # Number of bins in the color histogram
-    feature_fns = [hog_feature, lambda img: color_histogram_hsv(img, nbin=num_color_bins)]
-    feats = extract_features(images, feature_fns, verbose=True)
 
-    feats -= mean_feat
-    feats /= std_feat
+def augmented_epoch(generation, images, labels, seed, scale_min, scale_max, transl_max, feature_pipeline=None):
+    """
+    Return the training data of the epoch numbered generation: one augmented
+    copy of every image and, if a fitted feature_pipeline is given, their
+    features instead of the pixels, and the labels. The augmentation is drawn
+    from a random state seeded with (seed, generation), so every epoch can be
+    recreated. scale_min, scale_max and transl_max are applied as given, 1.0,
+    1.0 and 0 only flip the images.
+    """
+    rng = np.random.RandomState([seed, generation])
+    X, y = data_augm(images, labels, 1, scale_min, scale_max, transl_max, rng=rng, geometric=True)
+    if feature_pipeline is not None:
+        X = feature_pipeline.transform(X)
+    return X, y
 
-    return feats
 
 def scoring_function(x, lin_exp_boundary, doubling_rate):
     assert np.all([x >= 0, x <= 1])
@@ -0,0 +1,266 @@
+import multiprocessing
+import traceback
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _build_epochs(conn, build):
+    """
+    Main loop of the builder process. For every ('build', generation, slot,
+    kwargs) received on conn, X, y = build(generation, **kwargs) is computed,
+    X is copied into the shared memory segment of slot and ('ok', generation,
+    (slot, segment name, shape, dtype), y) is sent back. The segment of a slot
+    is kept for the following builds and only replaced by a new one if X does
+    not fit; the receiver unlinks every segment once it attached to it.
+    Errors are sent as ('error', generation, traceback, None).
+    """
+    segments = {}
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'stop':
+                break
+            _, generation, slot, kwargs = message
+            try:
+                X, y = build(generation, **kwargs)
+                shm = segments.get(slot)
+                if shm is None or shm.size < X.nbytes:
+                    if shm is not None:
+                        shm.close()
+                    shm = segments[slot] = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+                spec = (slot, shm.name, X.shape, X.dtype.str)
+                view = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+                view[...] = X
+                del view, X
+                conn.send(('ok', generation, spec, np.asarray(y)))
+            except Exception:
+                conn.send(('error', generation, traceback.format_exc(), None))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        for shm in segments.values():
+            shm.close()
+        conn.close()
+
+
+class _Segment(shared_memory.SharedMemory):
+    """
+    Shared memory segment attached by EpochBuilder. The arrays returned by
+    get() are created with np.frombuffer and keep the mapping exported, so
+    while one of them exists close() leaves the mapping to be unmapped when
+    the last of them is freed instead of raising BufferError.
+    """
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+def _shutdown(process, conn):
+    try:
+        conn.send(('stop',))
+    except (OSError, ValueError):
+        pass
+    conn.close()
+    process.join(timeout=1)
+    if process.is_alive():
+        # Abandon an epoch that is still being built
+        process.terminate()
+        process.join()
+
+
+class EpochBuilder(object):
+    """
+    Builds the training data of the next epoch in a background process while
+    the current epoch is trained on.
+
+    The data of an epoch is computed by build(generation, **kwargs), with the
+    keyword arguments given to request(), which returns a tuple X, y, e.g. the
+    features of the augmented training images and their labels. It runs in a
+    separate process because feature extraction is mostly Python code that
+    would compete with training for the interpreter lock.
+
+    X is double buffered in two shared memory segments that live as long as
+    the builder: get() returns a view of the segment the epoch was written
+    to, without copying it, and the next epoch is written to the other one.
+    A segment is only handed back to the process by release(), which must be
+    called once the caller stopped using the arrays of every get() but the
+    last one, e.g. after the Solver switched to the new epoch and its prefetch
+    thread was drained; request() fails while both segments are in use.
+
+    At most one epoch is pending at a time: a new request() supersedes the
+    previous one without waiting for it, and the result of the superseded
+    request is dropped when it arrives. If the builder falls behind,
+    get(block=True) waits for the epoch and get(block=False) returns None so
+    that training can continue on the current data.
+
+    Example usage:
+
+    builder = EpochBuilder(partial(augmented_epoch, images=X, labels=y, ...))
+    builder.request(1, seed=0)
+    ...
+    generation, X_train, y_train = builder.get()
+    solver.set_data({'X_train': X_train, 'y_train': y_train, ...}, generation)
+    builder.release()
+    builder.request(generation + 1, seed=0)
+    builder.close()
+    """
+
+    def __init__(self, build, start_method=None):
+        """
+        Inputs:
+        - build: Function build(generation, **kwargs) returning the tuple X, y
+          of the epoch numbered generation; it must be picklable unless the
+          start method is 'fork'.
+        - start_method: Start method of the process, see
+          multiprocessing.get_context. Default is None, the platform default.
+          The process is started by the constructor, which should be called
+          before any threads are started if the start method is 'fork'.
+        """
+        # A process started without the resource tracker of this process
+        # would start its own, which unlinks its segments when it exits
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context(start_method)
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_build_epochs, args=(child_conn, build), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._finalizer = weakref.finalize(self, _shutdown, self._process, self._conn)
+
+        # The generation of the last request, the number of requests whose
+        # result has not been received and the received result of the last
+        # request
+        self.pending = None
+        self._outstanding = 0
+        self._result = None
+
+        # The segment attached for each of the two slots, the slot of the last
+        # request, the slots whose arrays may still be used and the slot of the
+        # last get(), which release() keeps
+        self._segments = {}
+        self._slot = None
+        self._held = set()
+        self._current = None
+
+    def close(self):
+        """
+        Stop the process; an epoch that is still being built is abandoned.
+        Arrays returned by get() stay valid.
+        """
+        self._result = None
+        while self._outstanding > 0 and self._conn.poll():
+            self._discard(self._conn.recv())
+            self._outstanding -= 1
+        self.pending = None
+        self._finalizer()
+
+        for shm in self._segments.values():
+            shm.close()
+        self._segments = {}
+        self._held = set()
+        self._current = None
+
+    def _attach(self, slot, name):
+        shm = self._segments.get(slot)
+        if shm is not None and shm.name == name:
+            return shm
+        if shm is not None:
+            # The process outgrew the old segment of the slot
+            shm.close()
+        shm = _Segment(name=name)
+        shm.unlink()
+        self._segments[slot] = shm
+        return shm
+
+    def _discard(self, message):
+        if message[0] == 'ok':
+            # Attach anyway so that a new segment is unlinked
+            slot, name, _, _ = message[2]
+            self._attach(slot, name)
+
+    def _poll(self, block):
+        """
+        Receive the results of the process until the one of the last request
+        arrived, or without block until no result is ready. Results of
+        superseded requests are discarded. Returns True if the result of the
+        last request was received.
+        """
+        while self._result is None and self._outstanding > 0 and (block or self._conn.poll()):
+            try:
+                message = self._conn.recv()
+            except EOFError:
+                self._outstanding = 0
+                raise RuntimeError('The epoch builder process exited')
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._result = message
+            else:
+                self._discard(message)
+        return self._result is not None
+
+    def request(self, generation, **kwargs):
+        """
+        Start building the epoch numbered generation; kwargs are pickled and
+        passed on to build. An epoch that was requested before and not taken
+        by get() is discarded without waiting for it, and its segment is
+        reused; otherwise the epoch is written to the segment that is not
+        held, see release().
+        """
+        if self._result is not None:
+            self._discard(self._result)
+            self._result = None
+        if self.pending is None:
+            free = [slot for slot in (0, 1) if slot not in self._held]
+            if not free:
+                raise RuntimeError('Both epoch buffers are in use, call release() first')
+            self._slot = free[0]
+        self._conn.send(('build', generation, self._slot, kwargs))
+        self._outstanding += 1
+        self.pending = generation
+
+    def ready(self):
+        """
+        Return True if the requested epoch is built.
+        """
+        return self.pending is not None and self._poll(block=False)
+
+    def get(self, block=True):
+        """
+        Return the requested epoch as a tuple (generation, X, y), or None if
+        block is False and it is not built yet.
+
+        X is a view of a shared memory segment, not a copy; it stays
+        valid until release() is called after a later get(), after which the
+        next epoch may be written to it.
+        """
+        if self.pending is None:
+            raise ValueError('No epoch was requested')
+        if not self._poll(block):
+            return None
+
+        status, generation, spec, y = self._result
+        self._result = None
+        self.pending = None
+        if status != 'ok':
+            raise RuntimeError('Building epoch %d failed:\n%s' % (generation, spec))
+
+        slot, name, shape, dtype = spec
+        shm = self._attach(slot, name)
+        # np.frombuffer keeps the mapping exported for as long as X is alive,
+        # so the segment cannot be unmapped under it
+        X = np.frombuffer(shm.buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        self._held.add(slot)
+        self._current = slot
+        return generation, X, y
+
+    def release(self):
+        """
+        Hand the segments of all epochs but the one returned by the last get()
+        back to the process. Must only be called once their arrays, and any
+        views of them, are no longer read.
+        """
+        self._held = {self._current} if self._current is not None else set()
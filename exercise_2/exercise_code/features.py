@@ -1,5 +1,8 @@
 """Feature Extraction Helper Functions."""
 # pylint: disable=invalid-name
+import pickle
+from functools import partial
+
 import matplotlib
 import numpy as np
 from scipy.ndimage import uniform_filter
@@ -150,3 +153,116 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
 
     # return histogram
     return im_hist
+
+
+class FeaturePipeline(object):
+    """
+    Feature extraction followed by standardization, fitted once on the
+    training images and then applied unchanged to every other set of images.
+
+    The features of an image are its raw pixels (optional), its HOG features
+    and a color histogram over the hue. fit() learns the mean and standard
+    deviation of every feature on the training set; transform() extracts and
+    standardizes features in chunks of chunk_size images. If the images are
+    mean-subtracted, the mean image is added back before the features are
+    extracted, since the color histogram expects pixel values in [0, 255].
+
+    Example usage:
+
+    pipeline = FeaturePipeline()
+    X_train_feats = pipeline.fit_transform(X_train)
+    X_val_feats = pipeline.transform(X_val)
+    pipeline.save('feature_pipeline.p')
+    ...
+    pipeline = FeaturePipeline.load('feature_pipeline.p')
+    """
+
+    def __init__(self, num_color_bins=20, use_pixels=True, chunk_size=1000, mean_image=None):
+        """
+        Inputs:
+        - num_color_bins: Number of bins of the color histogram
+        - use_pixels: If True, the flattened pixels are part of the features
+        - chunk_size: Number of images processed at once by transform()
+        - mean_image: Optional array of shape (H, W, C) that was subtracted
+          from the images, e.g. the 'mean_image' of get_CIFAR10_data
+        """
+        self.num_color_bins = num_color_bins
+        self.use_pixels = use_pixels
+        self.chunk_size = chunk_size
+        self.mean_image = mean_image
+        self.image_shape = None
+        self.mean = None
+        self.std = None
+
+    def feature_fns(self):
+        feature_fns = [hog_feature, partial(color_histogram_hsv, nbin=self.num_color_bins)]
+        if self.use_pixels:
+            feature_fns.insert(0, flatten)
+        return feature_fns
+
+    def extract(self, images):
+        """
+        Extract the features of images without standardizing them.
+
+        Inputs:
+        - images: Array of shape (N, H, W, C), or (N, H * W * C) once the
+          pipeline has been fitted
+
+        Returns:
+        - features: Array of shape (N, F) in the dtype of images
+        """
+        if self.image_shape is not None:
+            images = images.reshape((-1,) + self.image_shape)
+        feature_fns = self.feature_fns()
+
+        # Pipelines pickled before mean_image was added have no such attribute
+        mean_image = getattr(self, 'mean_image', None)
+        features = None
+        for start in range(0, images.shape[0], self.chunk_size):
+            chunk = images[start:start + self.chunk_size]
+            if mean_image is not None:
+                chunk = np.clip(chunk + mean_image, 0, 255)
+            chunk = extract_features(chunk, feature_fns)
+            if features is None:
+                features = np.empty((images.shape[0], chunk.shape[1]), dtype=images.dtype)
+            features[start:start + chunk.shape[0]] = chunk
+        return features
+
+    def fit(self, images):
+        """
+        Learn the mean and standard deviation of the features of images.
+        """
+        self.fit_transform(images)
+        return self
+
+    def fit_transform(self, images):
+        """
+        Fit the pipeline on images and return their standardized features.
+        """
+        self.image_shape = images.shape[1:]
+        features = self.extract(images)
+        self.mean = np.mean(features, axis=0, keepdims=True, dtype=np.float64)
+        self.std = np.std(features, axis=0, keepdims=True, dtype=np.float64)
+        return self._standardize(features)
+
+    def transform(self, images):
+        """
+        Return the standardized features of images.
+        """
+        if self.mean is None:
+            raise ValueError('FeaturePipeline has to be fitted before transform')
+        return self._standardize(self.extract(images))
+
+    def _standardize(self, features):
+        features -= self.mean.astype(features.dtype)
+        features /= self.std.astype(features.dtype)
+        return features
+
+    def save(self, path):
+        with open(str(path), 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(str(path), 'rb') as f:
+            return pickle.load(f)
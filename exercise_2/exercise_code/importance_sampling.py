@@ -0,0 +1,184 @@
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Binary tree over a fixed number of nonnegative priorities in which every
+    inner node holds the sum of its children, so that indices can be sampled
+    with probability proportional to their priority.
+
+    The tree is stored in one array: node 1 is the root, the children of node
+    k are 2k and 2k + 1 and the priorities are the leaves, starting at
+    self.capacity. Updating or sampling k indices costs O(k log N) and is
+    vectorized over the k indices.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.depth = max(int(np.ceil(np.log2(max(size, 1)))), 0)
+        self.capacity = 2 ** self.depth
+        self.tree = np.zeros(2 * self.capacity)
+
+    @property
+    def total(self):
+        return self.tree[1] if self.depth > 0 else self.tree[self.capacity]
+
+    def get(self, indices):
+        return self.tree[self.capacity + np.asarray(indices)]
+
+    def set_all(self, priorities):
+        """
+        Replace all priorities, rebuilding the tree level by level in O(N).
+        """
+        self.tree[self.capacity:self.capacity + self.size] = priorities
+        for level in reversed(range(self.depth)):
+            start = 2 ** level
+            self.tree[start:2 * start] = self.tree[2 * start:4 * start:2] + self.tree[2 * start + 1:4 * start:2]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of indices; for repeated indices the last priority
+        is kept. The sums along the paths to the root are recomputed rather
+        than adjusted, so rounding errors do not accumulate.
+        """
+        nodes = self.capacity + np.asarray(indices)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, u):
+        """
+        Return the indices at the positions u in the cumulative sum of the
+        priorities, where u is an array of values in [0, total).
+        """
+        u = np.array(u, dtype=np.float64)
+        nodes = np.ones(u.shape, dtype=np.intp)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = u >= self.tree[left]
+            u -= np.where(right, self.tree[left], 0.0)
+            nodes = left + right
+        # Rounding can step onto an empty leaf past the end
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class ImportanceSampler(object):
+    """
+    Samples minibatches with probability increasing with the loss of the
+    samples, so that well learned samples are drawn less often.
+
+    The sampler keeps an estimate of the loss of every training sample, an
+    exponential moving average of the losses observed when the sample was
+    part of a minibatch. Until the first losses are observed all estimates
+    are equal; then the samples that have not been seen are set to the mean
+    observed loss. Sample i is drawn with probability
+
+      p_i = uniform / N + (1 - uniform) * q_i / sum_j q_j,  q_i = (l_i + eps)^alpha
+
+    from a SumTree of the q_i, mixed with uniform sampling so that no sample
+    is starved. The importance weight of sample i is w_i = 1 / (N p_i), which
+    makes the weighted mean loss and its gradient unbiased estimates of the
+    mean over the whole training set; uniform bounds the weights by
+    1 / uniform.
+
+    config format:
+    - alpha: Exponent applied to the loss estimates; 0 samples uniformly.
+    - uniform: Fraction of every minibatch that is sampled uniformly.
+    - smoothing: Weight of the previous estimate in the moving average.
+    - eps: Added to the loss estimates before the exponent.
+    - refresh_interval: The Solver recomputes the loss of the refresh_size
+      samples with the oldest estimates every refresh_interval iterations;
+      0 disables refreshing.
+    - refresh_size: Number of samples refreshed at once.
+    """
+
+    def __init__(self, num_samples, config=None):
+        self.config = {} if config is None else config
+        self.config.setdefault('alpha', 1.0)
+        self.config.setdefault('uniform', 0.1)
+        self.config.setdefault('smoothing', 0.5)
+        self.config.setdefault('eps', 1e-3)
+        self.config.setdefault('refresh_interval', 1000)
+        self.config.setdefault('refresh_size', 1000)
+        if not 0 < self.config['uniform'] <= 1:
+            raise ValueError('uniform must be in (0, 1]')
+        self.reset(num_samples)
+
+    def reset(self, num_samples):
+        """
+        Forget all loss estimates, e.g. when the training data changes.
+        """
+        self.num_samples = num_samples
+        self.estimates = np.zeros(num_samples)
+        self.last_update = np.zeros(num_samples, dtype=np.int64)
+        self.seen = False
+        self.tree = SumTree(num_samples)
+        self.tree.set_all(np.ones(num_samples))
+
+    def _priorities(self, losses):
+        return (np.maximum(losses, 0) + self.config['eps']) ** self.config['alpha']
+
+    def probabilities(self, indices):
+        """
+        Return the probabilities p_i of indices.
+        """
+        uniform = self.config['uniform']
+        return uniform / self.num_samples + (1 - uniform) * self.tree.get(indices) / self.tree.total
+
+    def sample(self, batch_size, rng=None):
+        """
+        Draw a minibatch with replacement.
+
+        Returns a tuple of:
+        - indices: Array of shape (batch_size,) of sample indices
+        - weights: Array of shape (batch_size,) of importance weights
+        """
+        rng = np.random if rng is None else rng
+        num_uniform = rng.binomial(batch_size, self.config['uniform'])
+        uniform_indices = rng.randint(self.num_samples, size=num_uniform)
+
+        # The rest is stratified over the cumulative sum of the priorities,
+        # which lowers the variance compared to independent draws
+        num_tree = batch_size - num_uniform
+        u = (np.arange(num_tree) + rng.uniform(size=num_tree)) * (self.tree.total / max(num_tree, 1))
+        indices = np.concatenate([uniform_indices, self.tree.sample(u)])
+
+        weights = 1.0 / (self.num_samples * self.probabilities(indices))
+        return indices, weights
+
+    def update(self, indices, losses, iteration, smooth=True):
+        """
+        Update the loss estimates of indices with the observed losses at the
+        given iteration. If smooth is False, the estimates are replaced, e.g.
+        by losses recomputed without dropout.
+        """
+        if not self.seen:
+            # Samples that have not been seen start at the mean observed loss
+            self.estimates[...] = np.mean(losses)
+            self.estimates[indices] = losses
+            self.seen = True
+            self.tree.set_all(self._priorities(self.estimates))
+        else:
+            smoothing = self.config['smoothing'] if smooth else 0.0
+            self.estimates[indices] = smoothing * self.estimates[indices] + (1 - smoothing) * losses
+            self.tree.update(indices, self._priorities(self.estimates[indices]))
+        self.last_update[indices] = iteration
+
+    def stale(self, count):
+        """
+        Return the indices of the count samples with the oldest estimates.
+        """
+        count = min(count, self.num_samples)
+        return np.argpartition(self.last_update, count - 1)[:count]
+
+    def state_dict(self):
+        return {'estimates': self.estimates, 'last_update': self.last_update, 'seen': np.asarray(self.seen)}
+
+    def load_state_dict(self, state):
+        if len(state['estimates']) != self.num_samples:
+            raise ValueError('The saved loss estimates do not match the training data')
+        self.estimates[...] = state['estimates']
+        self.last_update[...] = state['last_update']
+        self.seen = bool(state['seen'])
+        self.tree.set_all(self._priorities(self.estimates) if self.seen else np.ones(self.num_samples))
@@ -29,29 +29,48 @@ def affine_relu_backward(dout, cache):
     return dx, dw, db
 
 
-def affine_bn_relu_forward(x, w, b):
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
     """
-    Convenience layer that perorms an affine transform followed by a ReLU
+    Convenience layer that performs an affine transform followed by batch
+    normalization and a ReLU.
+
+    The layers share their temporaries: the affine output is normalized in
+    place and becomes the cached x_norm, and the ReLU is applied in place to
+    the batch normalization output, whose sign gives the ReLU mask in the
+    backward pass.
 
     Inputs:
     - x: Input to the affine layer
     - w, b: Weights for the affine layer
+    - gamma, beta: Scale and shift parameters of the batch normalization
+    - bn_param: Dictionary of parameters of the batch normalization, see
+      batchnorm_forward
 
     Returns a tuple of:
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
     a, fc_cache = affine_forward(x, w, b)
-    out, relu_cache = relu_forward(a)
-    cache = (fc_cache, relu_cache)
+    if bn_param['mode'] == 'train':
+        out, bn_cache = batchnorm_forward(a, gamma, beta, bn_param, x_norm=a)
+    else:
+        out, bn_cache = batchnorm_forward(a, gamma, beta, bn_param, out=a)
+    np.maximum(out, 0, out=out)
+    cache = (fc_cache, bn_cache, out)
     return out, cache
 
 
 def affine_bn_relu_backward(dout, cache):
     """
-    Backward pass for the affine-relu convenience layer
+    Backward pass for the affine-batchnorm-relu convenience layer. The cached
+    activations are overwritten, so the backward pass can only be run once
+    per forward pass.
     """
-    fc_cache, relu_cache = cache
-    da = relu_backward(dout, relu_cache)
-    dx, dw, db = affine_backward(da, fc_cache)
-    return dx, dw, db
+    fc_cache, bn_cache, out = cache
+    x_norm = bn_cache[0]
+
+    # Reuse the cached arrays for the gradients when they have the right dtype
+    da = np.multiply(dout, out > 0, out=out if out.dtype == dout.dtype else None)
+    dbn, dgamma, dbeta = batchnorm_backward(da, bn_cache, out=x_norm if x_norm.dtype == da.dtype else None)
+    dx, dw, db = affine_backward(dbn, fc_cache)
+    return dx, dw, db, dgamma, dbeta
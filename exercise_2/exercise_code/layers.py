@@ -109,7 +109,7 @@ def relu_backward(dout, cache):
     return dx
 
 
-def batchnorm_forward(x, gamma, beta, bn_param):
+def batchnorm_forward(x, gamma, beta, bn_param, out=None, x_norm=None):
     """
     Forward pass for batch normalization.
 
@@ -132,6 +132,9 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     they do not require an additional estimation step; the torch7 implementation
     of batch normalization also uses running averages.
 
+    At test-time the normalization is folded into a single scale and shift,
+    out = x * scale + shift, which costs O(D) to compute on every call.
+
     Input:
     - x: Data of shape (N, D)
     - gamma: Scale parameter of shape (D,)
@@ -142,10 +145,15 @@ def batchnorm_forward(x, gamma, beta, bn_param):
       - momentum: Constant for running mean / variance.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+    - out: Optional array of shape (N, D) the output is written to; must not
+      be x
+    - x_norm: Optional array of shape (N, D) the normalized input is written
+      to at training-time; it is kept in the cache, so it must not be reused
+      before the backward pass
 
     Returns a tuple of:
     - out: of shape (N, D)
-    - cache: A tuple of values needed in the backward pass
+    - cache: A tuple (x_norm, gamma, inv_std) needed in the backward pass
     """
     mode = bn_param['mode']
     eps = bn_param.get('eps', 1e-5)
@@ -155,7 +163,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
     running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
 
-    out, cache = None, None
+    cache = None
     if mode == 'train':
         #############################################################################
         # TODO: Look at the training-time forward pass implementation for batch     #
@@ -166,27 +174,21 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         #############################################################################
         sample_mean = np.mean(x, axis=0)
 
-        x_minus_mean = x - sample_mean
-
-        sq = x_minus_mean ** 2
-
-        var = 1. / N * np.sum(sq, axis=0)
-
-        sqrtvar = np.sqrt(var + eps)
+        # x_norm is the only (N, D) array that is kept for the backward pass;
+        # it holds x - mean until it is scaled in place
+        x_norm = np.subtract(x, sample_mean, out=x_norm)
+        var = np.einsum('ij,ij->j', x_norm, x_norm) / N
 
-        ivar = 1. / sqrtvar
+        inv_std = 1. / np.sqrt(var + eps)
+        x_norm *= inv_std
 
-        x_norm = x_minus_mean * ivar
-
-        gammax = gamma * x_norm
-
-        out = gammax + beta
+        out = np.multiply(x_norm, gamma, out=out)
+        out += beta
 
         running_var = momentum * running_var + (1 - momentum) * var
         running_mean = momentum * running_mean + (1 - momentum) * sample_mean
 
-        cache = (out, x_norm, beta, gamma, x_minus_mean, ivar, sqrtvar, var, eps, N, D)
-
+        cache = (x_norm, gamma, inv_std)
         #############################################################################
         #                             END OF CODE                                   #
         #############################################################################
@@ -194,8 +196,9 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         #############################################################################
         # TODO: Look at the test-time forward pass for batch normalization.         #
         #############################################################################
-        x = (x - running_mean) / np.sqrt(running_var)
-        out = x * gamma + beta
+        scale = gamma / np.sqrt(running_var + eps)
+        out = np.multiply(x, scale, out=out)
+        out += beta - running_mean * scale
         #############################################################################
         #                             END OF YOUR CODE                              #
         #############################################################################
@@ -209,17 +212,20 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     return out, cache
 
 
-def batchnorm_backward(dout, cache):
+def batchnorm_backward(dout, cache, out=None):
     """
     Backward pass for batch normalization.
 
-    For this implementation, you should write out a computation graph for
-    batch normalization on paper and propagate gradients backward through
-    intermediate nodes.
+    Uses the closed form of the gradient of the normalization,
+
+    dx = gamma * inv_std / N * (N * dout - dbeta - x_norm * dgamma)
+
+    instead of propagating through every node of the computation graph.
 
     Inputs:
     - dout: Upstream derivatives, of shape (N, D)
     - cache: Variable of intermediates from batchnorm_forward.
+    - out: Optional array of shape (N, D) dx is written to; must not be dout
 
     Returns a tuple of:
     - dx: Gradient with respect to inputs x, of shape (N, D)
@@ -227,26 +233,19 @@ def batchnorm_backward(dout, cache):
     - dbeta: Gradient with respect to shift parameter beta, of shape (D,)
     """
     dx, dgamma, dbeta = None, None, None
-    out, x_norm, beta, gamma, x_minus_mean, ivar, sqrtvar, var, eps, N, D = cache
+    x_norm, gamma, inv_std = cache
+    N = dout.shape[0]
     #############################################################################
     # TODO: Implement the backward pass for batch normalization. Store the      #
     # results in the dx, dgamma, and dbeta variables.                           #
     #############################################################################
     dbeta = np.sum(dout, axis=0)
-    dgamma = np.sum(dout * x_norm, axis=0)
-    dxnorm = dout * gamma
-
-    dx_minus_mean_1 = dxnorm * ivar
-    divar = np.sum(dxnorm * x_minus_mean, axis=0)
-
-    dsqrtvar = -1 / (sqrtvar ** 2) * divar
+    dgamma = np.einsum('ij,ij->j', dout, x_norm)
 
-    dvar = 0.5 * 1 / sqrtvar * dsqrtvar
-    dsq = 1 / N  * dvar
-    dx_minus_mean_2 = 2 * x_minus_mean * dsq
-
-    dx_minus_mean = dx_minus_mean_1 + dx_minus_mean_2
-    dx = dx_minus_mean + 1 / N  * -1 * np.sum(dx_minus_mean, axis=0)
+    dx = np.multiply(x_norm, dgamma / N, out=out)
+    dx += dbeta / N
+    np.subtract(dout, dx, out=dx)
+    dx *= gamma * inv_std
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -254,7 +253,35 @@ def batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
-def dropout_forward(x, dropout_param):
+def dropout_generator(dropout_param):
+    """
+    Return the random number generator the dropout masks are drawn from.
+
+    This is a Philox generator stored in dropout_param, so every dropout layer
+    with its own dropout_param has an independent stream that does not touch
+    the global np.random state. If dropout_param contains a seed, the generator
+    is recreated from it on every call and the same mask is drawn every time.
+    """
+    if 'seed' in dropout_param:
+        return np.random.Generator(np.random.Philox(dropout_param['seed']))
+    if 'rng' not in dropout_param:
+        dropout_param['rng'] = np.random.Generator(np.random.Philox(np.random.randint(2 ** 31)))
+    return dropout_param['rng']
+
+
+def _dropout_keep_mask(x, dropout_param):
+    """
+    Draw the mask of the units of x that are kept by dropout. One random byte
+    is drawn per unit, so the dropout probability is rounded to a multiple of
+    1/256.
+    """
+    rng = dropout_generator(dropout_param)
+    threshold = int(round(dropout_param['p'] * 256))
+    draws = np.frombuffer(rng.bytes(x.size), dtype=np.uint8).reshape(x.shape)
+    return draws >= threshold
+
+
+def dropout_forward(x, dropout_param, out=None):
     """
     Performs the forward pass for (inverted) dropout.
 
@@ -267,27 +294,28 @@ def dropout_forward(x, dropout_param):
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not in
         real networks.
+      Without a seed, the random number generator of the layer is stored in
+      dropout_param under the key 'rng'.
+    - out: Optional array of the same shape as x the output is written to;
+      may be x itself to apply dropout in place.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: A tuple (dropout_param, mask). In training mode, mask is the mask
+      of the kept units, bit-packed with np.packbits; in test mode, mask is None.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
     mask = None
-    out = None
 
     if mode == 'train':
         ###########################################################################
         # TODO: Implement the training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                            #
         ###########################################################################
-        mask = np.random.rand(*x.shape) < p
-        out = np.array(x)
-        out[mask] = 0
+        keep = _dropout_keep_mask(x, dropout_param)
+        out = np.multiply(x, keep, out=out)
+        mask = np.packbits(keep)
         ###########################################################################
         #                            END OF YOUR CODE                             #
         ###########################################################################
@@ -295,8 +323,7 @@ def dropout_forward(x, dropout_param):
         ###########################################################################
         # TODO: Implement the test phase forward pass for inverted dropout.       #
         ###########################################################################
-        mask = np.ones_like(x)
-        out = x * (1 - p)
+        out = np.multiply(x, 1 - p, out=out)
         ###########################################################################
         #                            END OF YOUR CODE                             #
         ###########################################################################
@@ -308,7 +335,8 @@ def dropout_forward(x, dropout_param):
 
 def dropout_backward(dout, cache):
     """
-    Perform the backward pass for (inverted) dropout.
+    Perform the backward pass for (inverted) dropout. The dropout mask is
+    applied to dout in place.
 
     Inputs:
     - dout: Upstream derivatives, of any shape
@@ -322,8 +350,9 @@ def dropout_backward(dout, cache):
         ###########################################################################
         # TODO: Implement the training phase backward pass for inverted dropout.  #
         ###########################################################################
+        keep = np.unpackbits(mask, count=dout.size).view(np.bool_).reshape(dout.shape)
         dx = dout
-        dx[mask] = 0
+        dx *= keep
         ###########################################################################
         #                            END OF YOUR CODE                             #
         ###########################################################################
@@ -332,7 +361,7 @@ def dropout_backward(dout, cache):
     return dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, weights=None, losses=None):
     """
     Computes the loss and gradient for softmax classification.
 
@@ -341,16 +370,37 @@ def softmax_loss(x, y):
       for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - weights: Optional array of shape (N,) giving a weight for every input;
+      the loss is then the weighted mean of the losses of the inputs.
+    - losses: Optional float64 array of shape (N,) that receives the
+      unweighted loss of every input.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
+
+    The probabilities and dx are computed in the dtype of x, the loss is
+    accumulated in float64.
     """
-    probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-    probs /= np.sum(probs, axis=1, keepdims=True)
+    shifted = x - np.max(x, axis=1, keepdims=True)
+    probs = np.exp(shifted)
+    sums = np.sum(probs, axis=1, keepdims=True)
+    probs /= sums
     N = x.shape[0]
-    loss = -np.sum(np.log(probs[np.arange(N), y])) / N
+
+    if weights is None and losses is None:
+        loss = -np.sum(np.log(probs[np.arange(N), y]), dtype=np.float64) / N
+    else:
+        # log p = shifted - log(sum), which stays finite for tiny
+        # probabilities
+        if losses is None:
+            losses = np.empty(N)
+        np.subtract(np.log(sums[:, 0]), shifted[np.arange(N), y], out=losses, casting='unsafe')
+        loss = float(np.dot(losses, weights) if weights is not None else np.sum(losses)) / N
+
     dx = probs.copy()
     dx[np.arange(N), y] -= 1
     dx /= N
+    if weights is not None:
+        dx *= np.asarray(weights, dtype=dx.dtype)[:, None]
     return loss, dx
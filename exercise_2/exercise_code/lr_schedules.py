@@ -0,0 +1,116 @@
+import math
+
+"""
+This file implements learning rate schedules for the Solver. Each schedule
+maps the number of completed iterations to a learning rate and has the same
+interface:
+
+def schedule(t, base_lr, config):
+
+Inputs:
+  - t: Number of iterations completed so far, counted from 0.
+  - base_lr: The learning rate given in the optim_config of the Solver.
+  - config: A dictionary containing the parameters of the schedule; missing
+    parameters are set to their defaults.
+
+Returns:
+  - lr: The learning rate of iteration t.
+
+Schedules that depend on the length of training (cosine, one_cycle) need the
+total number of iterations in config['num_iterations'].
+"""
+
+
+def constant(t, base_lr, config):
+    """
+    Keeps the learning rate at base_lr.
+    """
+    return base_lr
+
+
+def step(t, base_lr, config):
+    """
+    Multiplies the learning rate by gamma every step_size iterations.
+
+    config format:
+    - step_size: Number of iterations between two decays.
+    - gamma: Factor applied at every decay.
+    """
+    config.setdefault('step_size', 1000)
+    config.setdefault('gamma', 0.5)
+    return base_lr * config['gamma'] ** (t // config['step_size'])
+
+
+def exponential(t, base_lr, config):
+    """
+    Decays the learning rate smoothly by a factor of gamma every decay_steps
+    iterations.
+
+    config format:
+    - gamma: Decay factor per decay_steps iterations.
+    - decay_steps: Number of iterations over which the learning rate decays by
+      gamma.
+    """
+    config.setdefault('gamma', 0.5)
+    config.setdefault('decay_steps', 1000)
+    return base_lr * config['gamma'] ** (t / config['decay_steps'])
+
+
+def cosine(t, base_lr, config):
+    """
+    Anneals the learning rate from base_lr to min_lr along half a cosine
+    period over num_iterations iterations and keeps it at min_lr afterwards.
+
+    config format:
+    - num_iterations: Total number of iterations; required.
+    - min_lr: Final learning rate.
+    """
+    config.setdefault('min_lr', 0.0)
+    progress = min(t / config['num_iterations'], 1.0)
+    return config['min_lr'] + 0.5 * (base_lr - config['min_lr']) * (1 + math.cos(math.pi * progress))
+
+
+def one_cycle(t, base_lr, config):
+    """
+    The one-cycle policy: the learning rate rises from base_lr / div_factor to
+    base_lr during the first pct_start of training and then anneals to
+    base_lr / (div_factor * final_div_factor), both along cosine curves.
+
+    config format:
+    - num_iterations: Total number of iterations; required.
+    - pct_start: Fraction of the iterations spent increasing the learning rate.
+    - div_factor: Ratio of base_lr and the initial learning rate.
+    - final_div_factor: Ratio of the initial and the final learning rate.
+    """
+    config.setdefault('pct_start', 0.3)
+    config.setdefault('div_factor', 25.0)
+    config.setdefault('final_div_factor', 1e4)
+    initial_lr = base_lr / config['div_factor']
+    final_lr = initial_lr / config['final_div_factor']
+
+    rise = max(int(config['pct_start'] * config['num_iterations']), 1)
+    if t < rise:
+        start, end, progress = initial_lr, base_lr, t / rise
+    else:
+        fall = max(config['num_iterations'] - rise, 1)
+        start, end, progress = base_lr, final_lr, min((t - rise) / fall, 1.0)
+    return end + 0.5 * (start - end) * (1 + math.cos(math.pi * progress))
+
+
+def warmup(t, base_lr, config):
+    """
+    Linear warmup in front of another schedule: during the first
+    warmup_iterations iterations the learning rate of the schedule named by
+    after is scaled linearly from 1 / warmup_iterations to 1.
+
+    config format:
+    - warmup_iterations: Length of the warmup.
+    - after: Name of the schedule in this file that is warmed up; its
+      parameters are read from the same config.
+    """
+    config.setdefault('warmup_iterations', 1000)
+    config.setdefault('after', 'constant')
+    lr = globals()[config['after']](t, base_lr, config)
+    if t < config['warmup_iterations']:
+        lr *= (t + 1) / config['warmup_iterations']
+    return lr
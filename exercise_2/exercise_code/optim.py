@@ -25,11 +25,25 @@ NOTE: For most update rules, the default learning rate will probably not perform
 well; however the default values of the other hyperparameters should work well
 for a variety of different problems.
 
+The optimizer state (velocity, moments) has the dtype of w, and next_w keeps
+the dtype of w, so float32 models stay in float32.
+
 For efficiency, update rules may perform in-place updates, mutating w and
-setting next_w equal to w.
+setting next_w equal to w. sgd_momentum and adam update w and their state in
+place and keep a scratch array in config, so after the first call they do
+not allocate any memory; the update of a whole flat parameter buffer (see
+param_buffer.py) is then a handful of vectorized passes.
 """
 
 
+def _scratch(config, w):
+    # Temporary array of the shape and dtype of w that is reused across calls
+    scratch = config.get('scratch')
+    if scratch is None or scratch.shape != w.shape or scratch.dtype != w.dtype:
+        scratch = config['scratch'] = np.empty_like(w)
+    return scratch
+
+
 def sgd(w, dw, config=None):
     """
     Performs vanilla stochastic gradient descent.
@@ -58,15 +72,20 @@ def sgd_momentum(w, dw, config=None):
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
     config.setdefault('momentum', 0.9)
-    v = config.get('velocity', np.zeros_like(w))
+    if 'velocity' not in config:
+        config['velocity'] = np.zeros_like(w)
+    v = config['velocity']
 
     next_w = None
     #############################################################################
     # TODO: Implement the momentum update formula. Store the updated value in   #
     # the next_w variable. You should also use and update the velocity v.       #
     #############################################################################
-    v = config['momentum'] * v + dw
-    next_w = w - config['learning_rate'] * v
+    v *= config['momentum']
+    v += dw
+    step = np.multiply(v, config['learning_rate'], out=_scratch(config, w))
+    w -= step
+    next_w = w
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -94,8 +113,10 @@ def adam(x, dx, config=None):
     config.setdefault('beta1', 0.9)
     config.setdefault('beta2', 0.999)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('m', np.zeros_like(x))
-    config.setdefault('v', np.zeros_like(x))
+    if 'm' not in config:
+        config['m'] = np.zeros_like(x)
+    if 'v' not in config:
+        config['v'] = np.zeros_like(x)
     config.setdefault('t', 0)
 
     next_x = None
@@ -110,11 +131,25 @@ def adam(x, dx, config=None):
     learning_rate = config['learning_rate']
     eps = config['epsilon']
 
-    m = beta1 * m + (1 - beta1) * dx
-    m_hat = m / (1 - np.power(beta1, t + 1))
-    v = beta2 * v + (1 - beta2) * (dx ** 2)
-    v_hat = v / (1 - np.power(beta2, t + 1))
-    next_x = x - learning_rate * m_hat / (np.sqrt(v_hat) + eps)
+    # All coefficients are python floats so that they do not promote float32
+    # moments to float64. The moments and x are updated in place, the scratch
+    # array holds (dx ** 2) and then the step
+    # learning_rate * m_hat / (sqrt(v_hat) + eps).
+    scratch = _scratch(config, x)
+    m *= beta1
+    m += np.multiply(dx, 1 - beta1, out=scratch)
+    v *= beta2
+    np.multiply(dx, dx, out=scratch)
+    scratch *= 1 - beta2
+    v += scratch
+
+    np.multiply(v, 1.0 / (1 - float(beta2) ** (t + 1)), out=scratch)
+    np.sqrt(scratch, out=scratch)
+    scratch += eps
+    np.divide(m, scratch, out=scratch)
+    scratch *= learning_rate / (1 - float(beta1) ** (t + 1))
+    x -= scratch
+    next_x = x
 
     config['t'] = t + 1
     config['m'] = m
@@ -0,0 +1,196 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+
+
+class ParamBuffer(object):
+    """
+    Stores the parameters of a model as views into one contiguous array, with
+    a gradient array of the same layout, so that an update rule can update all
+    parameters in a single vectorized pass.
+
+    The parameters are laid out in the order of their sorted names. After
+    construction, params[k] is a view of self.data and self.grads[k] the
+    matching view of self.grad.
+
+    Example usage:
+
+    buffer = ParamBuffer(model.params)
+    loss, grads = model.loss(X, y)
+    buffer.bind(model.params)
+    buffer.set_grads(grads)
+    next_data, config = optim.adam(buffer.data, buffer.grad, config)
+    """
+
+    def __init__(self, params, dtype=None):
+        """
+        Inputs:
+        - params: Dictionary mapping parameter names to arrays; its values are
+          replaced by views of the buffer.
+        - dtype: dtype of the buffer; defaults to the common dtype of params.
+        """
+        self.keys = sorted(params)
+        if dtype is None:
+            dtype = np.result_type(*[params[k] for k in self.keys])
+        self.dtype = np.dtype(dtype)
+        self.shapes = [np.shape(params[k]) for k in self.keys]
+        self.data = np.empty(sum(int(np.prod(shape)) for shape in self.shapes), dtype=self.dtype)
+        self.grad = np.zeros_like(self.data)
+        self._make_views()
+        self.bind(params)
+
+    def __getstate__(self):
+        # Views would be pickled as copies, they are recreated on unpickling
+        state = self.__dict__.copy()
+        del state['views'], state['grads']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def _make_views(self):
+        self.views, self.grads = {}, {}
+        offset = 0
+        for k, shape in zip(self.keys, self.shapes):
+            size = int(np.prod(shape))
+            self.views[k] = self.data[offset:offset + size].reshape(shape)
+            self.grads[k] = self.grad[offset:offset + size].reshape(shape)
+            offset += size
+
+    @property
+    def size(self):
+        return self.data.size
+
+    def bind(self, params):
+        """
+        Make every entry of params a view of the buffer again. Arrays that were
+        put into params since the last call, e.g. restored best parameters,
+        are copied into the buffer first.
+        """
+        if len(params) != len(self.keys):
+            raise ValueError('The parameters do not match the layout of the buffer')
+        for k in self.keys:
+            view = self.views[k]
+            if params[k] is not view:
+                view[...] = params[k]
+                params[k] = view
+
+    def set_grads(self, grads):
+        """
+        Copy the gradients in grads into self.grad. Gradients that already are
+        views of self.grad, as returned by compiled models, are not copied.
+        """
+        for k in self.keys:
+            if grads[k] is not self.grads[k]:
+                self.grads[k][...] = grads[k]
+
+
+class ParamSnapshot(object):
+    """
+    Double-buffered copy of a set of parameters, e.g. the best parameters seen
+    during training.
+
+    Two flat arrays are allocated on the first save(); every save copies the
+    parameters into the spare array and swaps it with the current one, so
+    taking a snapshot does not allocate memory and self.best always holds a
+    complete snapshot. A snapshot can also be written to disk by a background
+    thread, which only reads the array it was started on; a later save waits
+    for it before overwriting that array.
+    """
+
+    def __init__(self):
+        self.keys = None
+        self._buffers = None
+        self._views = None
+        self._current = 0
+        self._thread = None
+        self._writing = None
+        self._error = None
+
+    @property
+    def best(self):
+        """
+        Dictionary of views of the current snapshot; empty before the first
+        save().
+        """
+        return {} if self._views is None else self._views[self._current]
+
+    def _allocate(self, params):
+        self.keys = sorted(params)
+        dtype = np.result_type(*[params[k] for k in self.keys])
+        size = sum(params[k].size for k in self.keys)
+        self._buffers = [np.empty(size, dtype=dtype) for _ in range(2)]
+        self._views = []
+        for buffer in self._buffers:
+            views, offset = {}, 0
+            for k in self.keys:
+                views[k] = buffer[offset:offset + params[k].size].reshape(params[k].shape)
+                offset += params[k].size
+            self._views.append(views)
+
+    def save(self, params, param_buffer=None, path=None):
+        """
+        Take a snapshot of params.
+
+        Inputs:
+        - params: Dictionary mapping parameter names to arrays
+        - param_buffer: Optional ParamBuffer holding params, which is then
+          copied in a single pass
+        - path: If not None, the snapshot is also pickled to this path by a
+          background thread
+        """
+        if self._buffers is None or sorted(params) != self.keys:
+            self.wait()
+            self._allocate(params)
+
+        spare = 1 - self._current
+        if self._writing == spare:
+            self.wait()
+
+        if param_buffer is not None and param_buffer.keys == self.keys and \
+                all(params[k] is param_buffer.views[k] for k in self.keys):
+            np.copyto(self._buffers[spare], param_buffer.data, casting='unsafe')
+        else:
+            for k in self.keys:
+                np.copyto(self._views[spare][k], params[k], casting='unsafe')
+        self._current = spare
+
+        if path is not None:
+            self.wait()
+            self._writing = spare
+            self._thread = threading.Thread(target=self._write, args=(str(path), self._views[spare]))
+            self._thread.start()
+
+    def restore(self, params):
+        """
+        Copy the current snapshot into the arrays of params in place, so that
+        views of a ParamBuffer stay valid.
+        """
+        for k in self.keys:
+            np.copyto(params[k], self.best[k], casting='unsafe')
+
+    def wait(self):
+        """
+        Block until the pending snapshot is on disk. Errors raised by the
+        writer thread are re-raised here.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._writing = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, path, views):
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(views, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self._error = e
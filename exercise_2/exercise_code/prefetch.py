@@ -0,0 +1,157 @@
+import queue
+import threading
+
+import numpy as np
+
+
+class MinibatchPrefetcher(object):
+    """
+    Samples minibatches of the training data on a background thread.
+
+    While the training thread computes a step, the prefetcher draws the
+    indices of the next minibatches and gathers their samples into a ring of
+    num_batches preallocated buffers. get() returns the oldest prepared
+    minibatch; its buffers are handed back to the thread on the next call, so
+    a minibatch is only valid until then. If an augmentation function is
+    given, the minibatches are also augmented on the thread.
+
+    The indices are drawn with replacement from a RandomState of their own,
+    so the sequence of minibatches only depends on the seed, the number of
+    minibatches taken so far and the calls of set_data, not on the timing of
+    the thread. set_data discards the minibatches prepared from the old data
+    and draws the next ones from the new data with the random state of the
+    first discarded one.
+
+    Example usage:
+
+    prefetcher = MinibatchPrefetcher(X_train, y_train, batch_size=200, seed=0)
+    batch_mask, X_batch, y_batch = prefetcher.get()
+    prefetcher.close()
+    """
+
+    def __init__(self, X, y, batch_size, num_batches=2, seed=None, gather=True, augment=None):
+        """
+        Inputs:
+        - X, y: Training data and labels
+        - batch_size: Number of samples per minibatch
+        - num_batches: Number of minibatches prepared ahead
+        - seed: Seed of the random state drawing the indices. Default is None,
+          which draws a seed from the global np.random state.
+        - gather: If False, only the indices are prepared and get() returns
+          None for X_batch and y_batch, e.g. if the samples are gathered by
+          the workers of a DataParallel.
+        - augment: Optional function augment(X_batch, rng=None, out=None) like
+          augment_batch in data_utils.py, which is applied to every gathered
+          minibatch with the random state of the prefetcher.
+        """
+        if num_batches < 1:
+            raise ValueError('num_batches must be at least 1')
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.gather = gather
+        self.augment = augment
+        self.rng = np.random.RandomState(seed)
+        self._thread = None
+        self._current = None
+        self._start(X, y, self.rng.get_state())
+
+    def _start(self, X, y, rng_state):
+        self.X, self.y = X, y
+        # The state of the random state after the last minibatch returned by
+        # get(), from which the thread is restarted
+        self.rng_state = rng_state
+        self.rng.set_state(rng_state)
+
+        self._masks = [np.empty(self.batch_size, dtype=np.intp) for _ in range(self.num_batches)]
+        if self.gather:
+            self._X = [np.empty((self.batch_size,) + X.shape[1:], dtype=X.dtype) for _ in range(self.num_batches)]
+            self._y = [np.empty((self.batch_size,) + np.shape(y)[1:], dtype=np.asarray(y).dtype) for _ in range(self.num_batches)]
+            if self.augment is not None:
+                self._X_augmented = [np.empty_like(X_batch) for X_batch in self._X]
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for slot in range(self.num_batches):
+            self._free.put(slot)
+        self._current = None
+
+        self._thread = threading.Thread(target=self._run, args=(self._free, self._ready), daemon=True)
+        self._thread.start()
+
+    def _run(self, free, ready):
+        try:
+            while True:
+                slot = free.get()
+                if slot is None:
+                    return
+                mask = self._masks[slot]
+                mask[...] = self.rng.randint(self.X.shape[0], size=self.batch_size)
+                if self.gather:
+                    # With mode='raise' np.take buffers out, the indices are
+                    # always valid
+                    np.take(self.X, mask, axis=0, out=self._X[slot], mode='clip')
+                    np.take(self.y, mask, axis=0, out=self._y[slot], mode='clip')
+                    if self.augment is not None:
+                        self.augment(self._X[slot], rng=self.rng, out=self._X_augmented[slot])
+                ready.put((slot, self.rng.get_state(), None))
+        except Exception as e:
+            ready.put((None, None, e))
+
+    def _stop(self):
+        if self._thread is None:
+            return
+        self._free.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def get(self):
+        """
+        Return the next minibatch as a tuple of:
+        - batch_mask: Array of shape (batch_size,) giving the indices of the
+          minibatch in X
+        - X_batch, y_batch: X[batch_mask], augmented if augment is given, and
+          y[batch_mask], or None if gather is False
+        """
+        if self._thread is None:
+            raise ValueError('The prefetcher is closed')
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+
+        slot, rng_state, error = self._ready.get()
+        if error is not None:
+            self._thread.join()
+            self._thread = None
+            raise error
+        self._current = slot
+        self.rng_state = rng_state
+        if not self.gather:
+            return self._masks[slot], None, None
+        if self.augment is not None:
+            return self._masks[slot], self._X_augmented[slot], self._y[slot]
+        return self._masks[slot], self._X[slot], self._y[slot]
+
+    def set_data(self, X, y):
+        """
+        Replace the training data; minibatches prepared from the old data are
+        discarded.
+        """
+        if X is self.X and y is self.y:
+            return
+        self.set_state(self.rng_state, X, y)
+
+    def set_state(self, rng_state, X=None, y=None):
+        """
+        Restart the prefetcher from rng_state, the state of its random state
+        in the form returned by np.random.RandomState.get_state, optionally
+        with new data.
+        """
+        self._stop()
+        self._start(self.X if X is None else X, self.y if y is None else y, rng_state)
+
+    def close(self):
+        """
+        Stop the background thread.
+        """
+        self._stop()
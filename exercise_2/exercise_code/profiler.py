@@ -0,0 +1,258 @@
+"""Layer-level profiling of the numpy networks."""
+import functools
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+
+_LAYER_MODULES = (
+    'exercise_code.layer_utils',
+    'exercise_code.classifiers.fc_net',
+    'exercise_code.classifiers.execution_plan',
+)
+
+
+def _is_layer_function(name, value):
+    return callable(value) and getattr(value, '__module__', None) in ('exercise_code.layers', 'exercise_code.layer_utils') \
+        and (name.endswith('_forward') or name.endswith('_backward') or name == 'softmax_loss')
+
+
+def _output_shape(result):
+    # Layer functions return either an array or a tuple whose first entry is
+    # the output (out, cache) or the input gradient (dx, dw, db)
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    if isinstance(result, np.ndarray):
+        return result.shape
+    return None
+
+
+def _plan_layer_label(layer, args):
+    return layer.name
+
+
+def _net_layer_label(net, args):
+    return 'layer' + str(args[0] + 1)
+
+
+class LayerProfiler(object):
+    """
+    Records the wall time, the allocated bytes and the output shape of every
+    call of a layer function while it is active.
+
+    Entering the profiler replaces the layer functions (affine_forward,
+    batchnorm_backward, dropout_forward, ...) of every registered backend and
+    in the namespaces of the modules that call them, as well as the per-layer
+    methods of FullyConnectedNet and of the layers of compiled execution
+    plans, by timing wrappers; leaving it restores the originals. Outside of
+    the with block the networks therefore run without any overhead.
+
+    Calls are nested: the time of layer1.forward includes the time of the
+    affine_forward and dropout_forward calls it makes. The table reports both
+    the total time and the self time without nested calls.
+
+    Example usage:
+
+    with LayerProfiler() as profiler:
+        for t in range(20):
+            solver._step()
+            profiler.step()
+    print(profiler.table())
+    profiler.save_chrome_trace('trace.json')
+    """
+
+    def __init__(self, track_memory=True):
+        """
+        Inputs:
+        - track_memory: If True, the bytes allocated by each call are measured
+          with tracemalloc. This slows down all allocations while profiling.
+        """
+        self.track_memory = track_memory
+        self.events = []
+        self.current_step = 0
+        self._patches = []
+        self._stack = []
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self._patches:
+            return
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._t0 = time.perf_counter()
+
+        for module_name in _LAYER_MODULES:
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            for name, value in list(vars(module).items()):
+                if _is_layer_function(name, value):
+                    self._patch(module, name, self._wrap_function(value, name))
+
+        # The dispatchers of the autotuning backend only forward to the other
+        # backends, which are wrapped themselves
+        backends = sys.modules.get('exercise_code.backends')
+        if backends is not None:
+            for backend in list(backends._BACKENDS.values()):
+                if isinstance(backend, backends.AutotuneBackend):
+                    continue
+                for op in backends.OPS:
+                    self._patch(backend, op, self._wrap_function(getattr(backend, op), op))
+
+        fc_net = sys.modules.get('exercise_code.classifiers.fc_net')
+        if fc_net is not None:
+            for name, phase in (('_layer_forward', 'forward'), ('_layer_backward', 'backward')):
+                method = getattr(fc_net.FullyConnectedNet, name)
+                self._patch(fc_net.FullyConnectedNet, name, self._wrap_method(method, _net_layer_label, phase))
+
+        execution_plan = sys.modules.get('exercise_code.classifiers.execution_plan')
+        if execution_plan is not None:
+            for cls in (execution_plan.AffineLayer, execution_plan.BatchNormLayer, execution_plan.ReluLayer, execution_plan.DropoutLayer):
+                for phase in ('forward', 'backward'):
+                    self._patch(cls, phase, self._wrap_method(getattr(cls, phase), _plan_layer_label, phase))
+
+    def stop(self):
+        while self._patches:
+            owner, name, original = self._patches.pop()
+            setattr(owner, name, original)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def step(self):
+        """
+        Mark the end of a training step.
+        """
+        self.current_step += 1
+
+    def reset(self):
+        self.events = []
+        self.current_step = 0
+
+    def _patch(self, owner, name, wrapper):
+        self._patches.append((owner, name, vars(owner)[name]))
+        setattr(owner, name, wrapper)
+
+    def _wrap_function(self, fn, label):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self._record(label, fn, args, kwargs)
+        return wrapper
+
+    def _wrap_method(self, fn, label_fn, phase):
+        @functools.wraps(fn)
+        def wrapper(obj, *args, **kwargs):
+            return self._record(label_fn(obj, args) + '.' + phase, fn, (obj,) + args, kwargs)
+        return wrapper
+
+    def _record(self, label, fn, args, kwargs):
+        parent = self._stack[-1] if self._stack else None
+        frame = {'children': 0.0}
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent['peak'] = max(parent['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start_memory'] = frame['peak'] = current
+        self._stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            self._stack.pop()
+
+        allocated = 0
+        if self.track_memory:
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            allocated = frame['peak'] - frame['start_memory']
+            if parent is not None:
+                parent['peak'] = max(parent['peak'], frame['peak'])
+            tracemalloc.reset_peak()
+        if parent is not None:
+            parent['children'] += end - start
+
+        self.events.append({
+            'name': label,
+            'step': self.current_step,
+            'start': start - self._t0,
+            'duration': end - start,
+            'self_time': end - start - frame['children'],
+            'depth': len(self._stack),
+            'bytes': allocated,
+            'shape': _output_shape(result),
+        })
+        return result
+
+    def summary(self):
+        """
+        Aggregate the recorded calls per layer.
+
+        Returns a list of dictionaries, sorted by decreasing self time, with
+        the keys name, calls, total_time, self_time, time_per_step (seconds),
+        bytes_per_call (peak bytes allocated during a call, averaged) and
+        shape (output shape of the last call).
+        """
+        num_steps = max(self.current_step, 1)
+        rows = {}
+        for event in self.events:
+            row = rows.setdefault(event['name'], {'name': event['name'], 'calls': 0, 'total_time': 0.0, 'self_time': 0.0, 'bytes': 0})
+            row['calls'] += 1
+            row['total_time'] += event['duration']
+            row['self_time'] += event['self_time']
+            row['bytes'] += event['bytes']
+            row['shape'] = event['shape']
+
+        summary = []
+        for row in rows.values():
+            row['time_per_step'] = row['total_time'] / num_steps
+            row['bytes_per_call'] = row.pop('bytes') / row['calls']
+            summary.append(row)
+        return sorted(summary, key=lambda row: -row['self_time'])
+
+    def table(self):
+        """
+        Return the summary as a printable table.
+        """
+        summary = self.summary()
+        total_self = sum(row['self_time'] for row in summary) or 1.0
+        lines = ['%-28s %7s %11s %11s %7s %11s  %s' % ('layer', 'calls', 'total [ms]', 'self [ms]', 'self %', 'KiB/call', 'output shape')]
+        for row in summary:
+            lines.append('%-28s %7d %11.3f %11.3f %6.1f%% %11.1f  %s' % (
+                row['name'], row['calls'], 1e3 * row['total_time'], 1e3 * row['self_time'],
+                100.0 * row['self_time'] / total_self, row['bytes_per_call'] / 1024.0, row['shape']))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """
+        Return the recorded calls in the Chrome trace event format, which can
+        be opened in chrome://tracing or Perfetto.
+        """
+        events = []
+        for event in self.events:
+            events.append({
+                'name': event['name'],
+                'ph': 'X',
+                'pid': 0,
+                'tid': 0,
+                'ts': 1e6 * event['start'],
+                'dur': 1e6 * event['duration'],
+                'args': {'step': event['step'], 'bytes': event['bytes'], 'shape': str(event['shape'])},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(str(path), 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -1,6 +1,13 @@
+import time
+
 import numpy as np
 
-from exercise_code import optim
+from exercise_code import optim, lr_schedules
+from exercise_code.data_parallel import DataParallel
+from exercise_code.importance_sampling import ImportanceSampler
+from exercise_code.layers import softmax_loss
+from exercise_code.param_buffer import ParamSnapshot
+from exercise_code.prefetch import MinibatchPrefetcher
 
 
 class Solver(object):
@@ -50,6 +57,10 @@ class Solver(object):
     - model.params must be a dictionary mapping string parameter names to numpy
       arrays containing parameter values.
 
+    - Optionally, model.param_buffer may be a ParamBuffer holding the values of
+      model.params. The update rule is then applied once to the whole buffer
+      instead of once per parameter.
+
     - model.loss(X, y) must be a function that computes training-time loss and
       gradients, and test-time classification scores, with the following inputs
       and outputs:
@@ -69,6 +80,11 @@ class Solver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+    - For importance sampling, model.loss(X, y, sample_weights, sample_losses)
+      must also accept an array of shape (N,) of weights of the samples, by
+      which the softmax losses are weighted, and a float64 array of shape (N,)
+      that receives their unweighted losses, like FullyConnectedNet.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -91,7 +107,16 @@ class Solver(object):
           hyperparameters (see optim.py) but all update rules require a
           'learning_rate' parameter so that should always be present.
         - lr_decay: A scalar for learning rate decay; after each epoch the learning
-          rate is multiplied by this value.
+          rate is multiplied by this value. Shorthand for the 'step' schedule
+          with a step size of one epoch; ignored if lr_schedule is given.
+        - lr_schedule: A string giving the name of a learning rate schedule in
+          lr_schedules.py. It is evaluated before every iteration, in train()
+          as well as in step(), from the number of completed iterations and
+          the 'learning_rate' of optim_config. Default is None, which keeps
+          the learning rate constant.
+        - lr_schedule_config: A dictionary containing the parameters of the
+          schedule (see lr_schedules.py). 'num_iterations' defaults to the
+          length of train().
         - batch_size: Size of minibatches used to compute loss and gradient during
           training.
         - num_epochs: The number of epochs to run for during training.
@@ -99,19 +124,58 @@ class Solver(object):
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - eval_batch_size: Number of samples evaluated at once by
+          check_accuracy. Default is None, which picks the fastest of a few
+          batch sizes on the first evaluation.
+        - best_params_path: If not None, train() also pickles the best
+          parameters to this path from a background thread whenever they
+          improve.
+        - num_workers: Number of processes the gradient of every minibatch is
+          computed on, see DataParallel in data_parallel.py. Default is 1,
+          which computes it in this process. Call close() to stop the workers.
+        - prefetch_batches: Number of minibatches a background thread samples
+          ahead of the training step, see MinibatchPrefetcher in prefetch.py.
+          Default is 0, which samples every minibatch in the step from the
+          global np.random state.
+        - batch_seed: Seed of the minibatch sampling of the prefetcher; if
+          None it is drawn from the global np.random state.
+        - augment: Optional function augment(X_batch, rng=None, out=None)
+          applied to every training minibatch, e.g. a functools.partial of
+          augment_batch in data_utils.py. It runs on the prefetching thread
+          or the data parallel workers if they are used.
+        - importance_sampling: If True, minibatches are sampled with
+          probabilities increasing with the loss of the samples and the losses
+          are weighted to keep the gradient unbiased, see ImportanceSampler in
+          importance_sampling.py. Cannot be combined with prefetch_batches.
+        - importance_sampling_config: A dictionary containing the parameters
+          of the ImportanceSampler.
         """
         self.model = model
+        self.data_generation = 0
+        self.data_parallel = None
+        self.prefetcher = None
+        self.sampler = None
         self.set_data(data)
 
         # Unpack keyword arguments
         self.update_rule = kwargs.pop('update_rule', 'sgd')
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
+        self.lr_schedule = kwargs.pop('lr_schedule', None)
+        self.lr_schedule_config = dict(kwargs.pop('lr_schedule_config', {}))
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
 
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.eval_batch_size = kwargs.pop('eval_batch_size', None)
+        self.best_params_path = kwargs.pop('best_params_path', None)
+        self.num_workers = kwargs.pop('num_workers', 1)
+        self.prefetch_batches = kwargs.pop('prefetch_batches', 0)
+        self.batch_seed = kwargs.pop('batch_seed', None)
+        self.augment = kwargs.pop('augment', None)
+        self.importance_sampling = kwargs.pop('importance_sampling', False)
+        self.importance_sampling_config = dict(kwargs.pop('importance_sampling_config', {}))
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -124,16 +188,72 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        # The importance sampler draws the minibatches from the loss estimates
+        # of the last step, so they cannot be prepared ahead
+        if self.importance_sampling:
+            if self.prefetch_batches > 0:
+                raise ValueError('importance_sampling cannot be combined with prefetch_batches')
+            self.sampler = ImportanceSampler(self.X_train.shape[0], self.importance_sampling_config)
+            self._sample_losses = np.empty(self.batch_size)
+
+        # The workers share the training data with this process
+        if self.num_workers > 1:
+            self.data_parallel = DataParallel(self.model, self.num_workers, augment=self.augment)
+            self.X_train, self.y_train = self.data_parallel.set_data(self.X_train, self.y_train)
+
+        # The workers of data parallel training gather their samples
+        # themselves, the prefetcher then only draws the indices
+        if self.prefetch_batches > 0:
+            self.prefetcher = MinibatchPrefetcher(self.X_train, self.y_train, self.batch_size, self.prefetch_batches,
+                                                  self.batch_seed, gather=self.data_parallel is None, augment=self.augment)
+
+        iterations_per_epoch = max(self.X_train.shape[0] // self.batch_size, 1)
+        if self.lr_schedule is None and self.lr_decay != 1.0:
+            self.lr_schedule = 'step'
+            self.lr_schedule_config = {'step_size': iterations_per_epoch, 'gamma': self.lr_decay}
+
+        if self.lr_schedule is not None:
+            if not hasattr(lr_schedules, self.lr_schedule):
+                raise ValueError('Invalid lr_schedule "%s"' % self.lr_schedule)
+            if 'learning_rate' not in self.optim_config:
+                raise ValueError('lr_schedule requires a learning_rate in optim_config')
+            self.lr_schedule_config.setdefault('num_iterations', self.num_epochs * iterations_per_epoch)
+            self.lr_schedule = getattr(lr_schedules, self.lr_schedule)
+
         self._reset()
 
-    def set_data(self, data):
-        self.X_train = data['X_train']
+    def set_data(self, data, generation=None):
+        """
+        Replace the training and validation data. generation optionally
+        numbers the data, e.g. the epochs of freshly augmented training data;
+        it is part of the state_dict.
+        """
+        if generation is not None:
+            self.data_generation = generation
+
+        # Store the data in the dtype of the model once instead of casting
+        # every minibatch, and in C order so that minibatches are gathered
+        # from contiguous samples
+        dtype = getattr(self.model, 'dtype', None)
+        self.X_train = np.ascontiguousarray(data['X_train'], dtype=dtype)
         self.y_train = data['y_train']
-        self.X_val = data['X_val']
+        self.X_val = np.asarray(data['X_val'], dtype=dtype)
         self.y_val = data['y_val']
+        if self.data_parallel is not None:
+            self.X_train, self.y_train = self.data_parallel.set_data(self.X_train, self.y_train)
+        if self.prefetcher is not None:
+            self.prefetcher.set_data(self.X_train, self.y_train)
+        if self.sampler is not None and self.sampler.num_samples != self.X_train.shape[0]:
+            self.sampler.reset(self.X_train.shape[0])
+
+        # A subsample of the old data is drawn anew on the next evaluation
+        self._subsample = (None, None, None, None)
 
     def set_model(self, model):
         self.model = model
+        if self.data_parallel is not None:
+            self.data_parallel.set_model(model)
+        self.set_data({'X_train': self.X_train, 'y_train': self.y_train, 'X_val': self.X_val, 'y_val': self.y_val})
         self._reset()
 
     def _reset(self):
@@ -143,34 +263,201 @@ class Solver(object):
         """
         # Set up some variables for book-keeping
         self.epoch = 0
+        self.iteration = 0
+        self.learning_rate = self.optim_config.get('learning_rate')
         self.best_val_acc = 0
-        self.best_params = {}
+        self.best_snapshot = ParamSnapshot()
+        self.best_params = self.best_snapshot.best
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
 
-        # Make a deep copy of the optim_config for each parameter
+        # Evaluation state: the tuned batch size, the label buffer and the
+        # cached subsample (key, indices, X[indices], y[indices]) of
+        # check_all_accuracies. The key identifies the data by id, shape and
+        # data generation, so that the cache does not keep old data alive
+        self._tuned_batch_size = None
+        self._pred_buffer = np.empty(0, dtype=np.intp)
+        self._subsample = (None, None, None, None)
+
+        # Make a deep copy of the optim_config for each parameter, or a single
+        # one for all parameters if they are stored in one flat buffer
+        self.param_buffer = getattr(self.model, 'param_buffer', None)
         self.optim_configs = {}
-        for p in self.model.params:
+        for p in (['flat'] if self.param_buffer is not None else self.model.params):
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+    def state_dict(self):
+        """
+        Return the training state as a flat dictionary of numpy arrays, which
+        can be saved with np.savez and restored with load_state_dict:
+
+        - params/<name>: the model parameters
+        - optim/<name>/<key>: the optimizer state of every parameter, or of the
+          flat parameter buffer under the name 'flat'
+        - best/<name>: the best parameters, if any
+        - epoch, iteration, data_generation, best_val_acc, learning_rate
+        - loss_history, train_acc_history, val_acc_history
+        - rng/<key>: the state of the global numpy random number generator,
+          which draws the minibatches
+        - sampler/<key>: the state of the random state of the prefetcher, if
+          minibatches are prefetched
+        - importance/<key>: the loss estimates of the importance sampler, if
+          importance sampling is used
+
+        State of the model that is not in model.params, such as the running
+        averages of batch normalization, is not included.
+        """
+        state = {}
+        for k, v in self.model.params.items():
+            state['params/' + k] = v
+        for p, config in self.optim_configs.items():
+            for k, v in config.items():
+                if k != 'scratch':
+                    state['optim/%s/%s' % (p, k)] = np.asarray(v)
+        for k, v in self.best_params.items():
+            state['best/' + k] = v
+
+        state['epoch'] = np.asarray(self.epoch)
+        state['iteration'] = np.asarray(self.iteration)
+        state['data_generation'] = np.asarray(self.data_generation)
+        state['best_val_acc'] = np.asarray(self.best_val_acc, dtype=np.float64)
+        state['learning_rate'] = np.asarray(np.nan if self.learning_rate is None else self.learning_rate, dtype=np.float64)
+        state['loss_history'] = np.asarray(self.loss_history, dtype=np.float64)
+        state['train_acc_history'] = np.asarray(self.train_acc_history, dtype=np.float64)
+        state['val_acc_history'] = np.asarray(self.val_acc_history, dtype=np.float64)
+
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state['rng/keys'] = keys
+        state['rng/pos'] = np.asarray(pos)
+        state['rng/has_gauss'] = np.asarray(has_gauss)
+        state['rng/cached_gaussian'] = np.asarray(cached_gaussian)
+
+        if self.prefetcher is not None:
+            name, keys, pos, has_gauss, cached_gaussian = self.prefetcher.rng_state
+            state['sampler/keys'] = keys
+            state['sampler/pos'] = np.asarray(pos)
+            state['sampler/has_gauss'] = np.asarray(has_gauss)
+            state['sampler/cached_gaussian'] = np.asarray(cached_gaussian)
+
+        if self.sampler is not None:
+            for k, v in self.sampler.state_dict().items():
+                state['importance/' + k] = v
+        return state
+
+    def load_state_dict(self, state):
+        """
+        Restore the training state from a dictionary returned by state_dict()
+        (or an NpzFile of it). The parameters are copied into model.params in
+        place, so the model must have the same architecture.
+        """
+        groups = {'params': {}, 'optim': {}, 'best': {}, 'rng': {}, 'sampler': {}, 'importance': {}}
+        for key in state:
+            group, _, name = key.partition('/')
+            if group in groups:
+                groups[group][name] = state[key]
+
+        if sorted(groups['params']) != sorted(self.model.params):
+            raise ValueError('The saved parameters do not match the parameters of the model')
+        for k, v in groups['params'].items():
+            np.copyto(self.model.params[k], v, casting='unsafe')
+
+        optim_configs = {p: {} for p in self.optim_configs}
+        for name, v in groups['optim'].items():
+            p, _, k = name.rpartition('/')
+            if p not in optim_configs:
+                raise ValueError('The saved optimizer state does not match the parameters of the model')
+            # Scalars like t and learning_rate are stored as 0-d arrays
+            optim_configs[p][k] = v.item() if v.ndim == 0 else np.array(v)
+        self.optim_configs = optim_configs
+
+        self.best_snapshot = ParamSnapshot()
+        if groups['best']:
+            self.best_snapshot.save(groups['best'])
+        self.best_params = self.best_snapshot.best
+
+        self.epoch = int(state['epoch'])
+        self.iteration = int(state['iteration'])
+        self.data_generation = int(state['data_generation'])
+        self.best_val_acc = float(state['best_val_acc'])
+        learning_rate = float(state['learning_rate'])
+        self.learning_rate = None if np.isnan(learning_rate) else learning_rate
+        self.loss_history = np.asarray(state['loss_history']).tolist()
+        self.train_acc_history = np.asarray(state['train_acc_history']).tolist()
+        self.val_acc_history = np.asarray(state['val_acc_history']).tolist()
+
+        rng = groups['rng']
+        np.random.set_state(('MT19937', rng['keys'], int(rng['pos']), int(rng['has_gauss']), float(rng['cached_gaussian'])))
+
+        sampler = groups['sampler']
+        if self.prefetcher is not None and sampler:
+            self.prefetcher.set_state(('MT19937', sampler['keys'], int(sampler['pos']), int(sampler['has_gauss']), float(sampler['cached_gaussian'])))
+
+        if self.sampler is not None and groups['importance']:
+            self.sampler.load_state_dict(groups['importance'])
+
     def _step(self):
         """
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
-
-        # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.lr_schedule is not None:
+            self._set_learning_rate(self.lr_schedule(self.iteration, self.optim_config['learning_rate'], self.lr_schedule_config))
+        self.iteration += 1
+
+        # Make a minibatch of training data, or take the one the prefetcher
+        # prepared during the last step
+        sample_weights = None
+        if self.prefetcher is not None:
+            batch_mask, X_batch, y_batch = self.prefetcher.get()
+        elif self.sampler is not None:
+            batch_mask, sample_weights = self.sampler.sample(self.batch_size)
+            X_batch, y_batch = None, None
+        else:
+            num_train = self.X_train.shape[0]
+            batch_mask = np.random.choice(num_train, self.batch_size)
+            X_batch, y_batch = None, None
+
+        # Parameters replaced since the last step, e.g. by the best parameters
+        # at the end of train(), are copied back into the flat buffer
+        if self.param_buffer is not None:
+            self.param_buffer.bind(self.model.params)
+
+        # Compute loss and gradient, the workers gather their shards of the
+        # minibatch themselves
+        if self.data_parallel is not None:
+            if sample_weights is not None:
+                loss, grads = self.data_parallel.loss(batch_mask, sample_weights, self._sample_losses)
+            else:
+                loss, grads = self.data_parallel.loss(batch_mask)
+        else:
+            if X_batch is None:
+                X_batch = self.X_train[batch_mask]
+                y_batch = self.y_train[batch_mask]
+                if self.augment is not None:
+                    X_batch = self.augment(X_batch)
+            if sample_weights is not None:
+                loss, grads = self.model.loss(X_batch, y_batch, sample_weights=sample_weights, sample_losses=self._sample_losses)
+            else:
+                loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
+        if self.sampler is not None:
+            self.sampler.update(batch_mask, self._sample_losses, self.iteration)
+            refresh_interval = self.sampler.config['refresh_interval']
+            if refresh_interval and self.iteration % refresh_interval == 0:
+                self._refresh_losses()
+
         # Perform a parameter update
+        if self.param_buffer is not None:
+            self.param_buffer.set_grads(grads)
+            data = self.param_buffer.data
+            next_data, self.optim_configs['flat'] = self.update_rule(data, self.param_buffer.grad, self.optim_configs['flat'])
+            if next_data is not data:
+                data[...] = next_data
+            return
+
         for p, w in self.model.params.items():
             dw = grads[p]
             config = self.optim_configs[p]
@@ -178,7 +465,42 @@ class Solver(object):
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def _refresh_losses(self):
+        """
+        Recompute the losses of the samples with the oldest estimates of the
+        importance sampler in test mode, without augmentation, and replace
+        their estimates.
+        """
+        indices = self.sampler.stale(self.sampler.config['refresh_size'])
+        losses = np.empty(len(indices))
+        for start in range(0, len(indices), self.batch_size):
+            chunk = indices[start:start + self.batch_size]
+            scores = self.model.loss(self.X_train[chunk])
+            softmax_loss(scores, self.y_train[chunk], losses=losses[start:start + self.batch_size])
+        self.sampler.update(indices, losses, self.iteration, smooth=False)
+
+    def close(self):
+        """
+        Stop the worker processes of data parallel training and the
+        prefetching thread, if any.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.data_parallel is not None:
+            self.data_parallel.close()
+            self.data_parallel = None
+
+    def _set_learning_rate(self, learning_rate):
+        # With a flat parameter buffer there is a single optimizer config
+        if learning_rate != self.learning_rate:
+            for config in self.optim_configs.values():
+                config['learning_rate'] = learning_rate
+            self.learning_rate = learning_rate
+
+    EVAL_BATCH_SIZES = (100, 250, 500, 1000, 2000)
+
+    def check_accuracy(self, X, y, num_samples=None, batch_size=None, fixed_subsample=False):
         """
         Check accuracy of the model on the provided data.
 
@@ -188,35 +510,96 @@ class Solver(object):
         - num_samples: If not None, subsample the data and only test the model
           on num_samples datapoints.
         - batch_size: Split X and y into batches of this size to avoid using too
-          much memory.
+          much memory. Default is None, which uses eval_batch_size.
+        - fixed_subsample: If True, the subsample drawn for X is kept and
+          reused as long as the same X and y are passed.
 
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
         """
+        return self.evaluate(X, y, num_samples, batch_size, fixed_subsample)[0]
 
-        # Maybe subsample the data
+    def evaluate(self, X, y, num_samples=None, batch_size=None, fixed_subsample=False,
+                 num_classes=None):
+        """
+        Evaluate the model on the provided data without building training-time
+        caches, see check_accuracy for the inputs.
+
+        Returns a tuple of:
+        - acc: Fraction of instances that were correctly classified
+        - class_correct: Array of shape (C,) counting the correctly classified
+          instances of every class
+        - class_total: Array of shape (C,) counting the instances of every
+          class; C is num_classes or the largest label plus one
+        """
+        # Maybe subsample the data, without replacement
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
+            key = (id(X), X.shape, self.data_generation)
+            cached_key, mask, X_sub, y_sub = self._subsample
+            if not (fixed_subsample and cached_key == key and len(mask) == num_samples and len(y_sub) == len(mask)):
+                mask = np.sort(np.random.choice(N, num_samples, replace=False))
+                X_sub, y_sub = X[mask], y[mask]
+                if fixed_subsample:
+                    self._subsample = (key, mask, X_sub, y_sub)
             N = num_samples
-            X = X[mask]
-            y = y[mask]
+            X, y = X_sub, y_sub
+
+        if batch_size is None:
+            batch_size = self._get_eval_batch_size(X)
+
+        y_pred = self._predict(X, batch_size)
+        correct = y_pred == y
+        num_classes = max(num_classes or 0, int(y.max()) + 1 if N else 0)
+        class_correct = np.bincount(y, weights=correct, minlength=num_classes).astype(np.int64)
+        class_total = np.bincount(y, minlength=num_classes)
+        acc = float(np.count_nonzero(correct)) / max(N, 1)
+
+        return acc, class_correct, class_total
+
+    def _predict(self, X, batch_size):
+        """
+        Predict the labels of X in batches of batch_size. The labels are written
+        into a buffer that is reused across calls, so the result is only valid
+        until the next call.
+        """
+        N = X.shape[0]
+        if self._pred_buffer.shape[0] < N:
+            self._pred_buffer = np.empty(N, dtype=np.intp)
+        y_pred = self._pred_buffer[:N]
+
+        # Models with an inference path predict in chunks on their own
+        if hasattr(self.model, 'predict'):
+            self.model.predict(X, chunk_size=batch_size, out=y_pred)
+            return y_pred
 
         # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
-
-        return acc
+        for start in range(0, N, batch_size):
+            scores = self.model.loss(X[start:start + batch_size])
+            np.argmax(scores, axis=1, out=y_pred[start:start + batch_size])
+        return y_pred
+
+    def _get_eval_batch_size(self, X):
+        """
+        Return eval_batch_size, or time the prediction of up to 2000 samples of
+        X with every batch size in EVAL_BATCH_SIZES and keep the fastest.
+        """
+        if self.eval_batch_size is not None:
+            return self.eval_batch_size
+        if self._tuned_batch_size is None:
+            sample = X[:max(self.EVAL_BATCH_SIZES)]
+            best_time = None
+            for batch_size in self.EVAL_BATCH_SIZES:
+                if batch_size > sample.shape[0] and best_time is not None:
+                    break
+                self._predict(sample, batch_size)
+                start = time.perf_counter()
+                self._predict(sample, batch_size)
+                elapsed = time.perf_counter() - start
+                if best_time is None or elapsed < best_time:
+                    self._tuned_batch_size, best_time = batch_size, elapsed
+        return self._tuned_batch_size
 
     def step(self):
         self._step()
@@ -224,7 +607,7 @@ class Solver(object):
         return self.loss_history[-1]
 
     def check_all_accuracies(self):
-        train_acc = self.check_accuracy(self.X_train, self.y_train, num_samples=1000)
+        train_acc = self.check_accuracy(self.X_train, self.y_train, num_samples=1000, fixed_subsample=True)
         val_acc = self.check_accuracy(self.X_val, self.y_val)
 
         return train_acc, val_acc
@@ -245,13 +628,11 @@ class Solver(object):
                 print('(Iteration %d / %d) loss: %f' % (
                     t + 1, num_iterations, self.loss_history[-1]))
 
-            # At the end of every epoch, increment the epoch counter and decay the
-            # learning rate.
+            # At the end of every epoch, increment the epoch counter; the
+            # learning rate is set by the schedule in _step
             epoch_end = (t + 1) % iterations_per_epoch == 0
             if epoch_end:
                 self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
             # Check train and val accuracy on the first iteration, the last
             # iteration, and at the end of each epoch.
@@ -268,12 +649,15 @@ class Solver(object):
                     print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
                         self.epoch, self.num_epochs, train_acc, val_acc))
 
-                # Keep track of the best model
+                # Keep track of the best model; the snapshot reuses two
+                # preallocated copies of the parameters
                 if val_acc > self.best_val_acc:
                     self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
-
-        # At the end of training swap the best params into the model
-        self.model.params = self.best_params
+                    self.best_snapshot.save(self.model.params, self.param_buffer, self.best_params_path)
+                    self.best_params = self.best_snapshot.best
+
+        # At the end of training copy the best params into the model, in place
+        # so that the model keeps its parameter buffer
+        self.best_snapshot.wait()
+        if self.best_params:
+            self.best_snapshot.restore(self.model.params)
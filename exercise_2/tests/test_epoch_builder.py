@@ -0,0 +1,64 @@
+"""Tests of EpochBuilder; run with python -m pytest tests from exercise_2."""
+import os
+import time
+
+import numpy as np
+import pytest
+
+from exercise_code.epoch_builder import EpochBuilder
+
+
+def _build(generation, delay=0.0, size=1000):
+    time.sleep(delay)
+    return np.full((size, 50), generation, dtype=np.float32), np.arange(size) + generation
+
+
+def test_held_epoch_stays_valid_until_release():
+    builder = EpochBuilder(_build)
+    try:
+        builder.request(1)
+        _, X1, _ = builder.get()
+        builder.request(2)
+        _, X2, _ = builder.get()
+        assert X1[0, 0] == 1 and np.all(X1 == 1)
+        assert X2[0, 0] == 2
+        with pytest.raises(RuntimeError):
+            builder.request(3)
+
+        # The buffers alternate, epoch 3 reuses the one of epoch 1
+        builder.release()
+        builder.request(3)
+        _, X3, _ = builder.get()
+        assert np.shares_memory(X1, X3) and not np.shares_memory(X2, X3)
+        assert np.all(X2 == 2) and np.all(X3 == 3)
+    finally:
+        builder.close()
+
+
+def test_superseded_request_does_not_block():
+    builder = EpochBuilder(_build)
+    try:
+        builder.request(1, delay=2.0)
+        start = time.time()
+        builder.request(2)
+        assert time.time() - start < 1.0
+        generation, X, _ = builder.get()
+        assert generation == 2 and X[0, 0] == 2
+        assert not builder.ready()
+    finally:
+        builder.close()
+
+
+def test_segments_are_unlinked():
+    before = set(os.listdir('/dev/shm'))
+    builder = EpochBuilder(_build)
+    try:
+        for generation, size in enumerate((1000, 1000, 3000, 500, 3000), 1):
+            builder.request(generation, size=size)
+            _, X, _ = builder.get()
+            assert X.shape == (size, 50) and np.all(X == generation)
+            builder.release()
+        assert set(os.listdir('/dev/shm')) == before
+    finally:
+        builder.close()
+    assert set(os.listdir('/dev/shm')) == before
@@ -4,6 +4,7 @@ import TaskPlan
 from exercise_code.classifiers.classification_cnn import ClassificationCNN
 from exercise_code.solver import Solver
 from exercise_code.data_utils import get_CIFAR10_datasets
+from exercise_code.checkpoint import CheckpointManager, ResumableRandomSampler, get_rng_state, set_rng_state
 import torch
 from torch.autograd import Variable
 from torchvision import transforms
@@ -34,7 +35,8 @@ class Task(TaskPlan.Task):
             transform_arr.append(transforms.Compose(filter))
 
         train_data, val_data, test_data, self.mean_image = get_CIFAR10_datasets(transform_train=transform_arr[0], transform_val=transform_arr[1])
-        self.train_loader = torch.utils.data.DataLoader(train_data, batch_size=self.preset.get_int('batch_size'), shuffle=True, num_workers=4)
+        self.train_sampler = ResumableRandomSampler(train_data)
+        self.train_loader = torch.utils.data.DataLoader(train_data, batch_size=self.preset.get_int('batch_size'), sampler=self.train_sampler, num_workers=4)
         self.val_loader = torch.utils.data.DataLoader(val_data, batch_size=self.preset.get_int('batch_size'), shuffle=False, num_workers=4)
 
         self.model = ClassificationCNN(num_filters=self.preset.get_list("num_filters"), kernel_size=self.preset.get_list("kernel_size"), hidden_dims=self.preset.get_list('hidden_dims'), pool_toggle=self.preset.get_list('pool_toggle'), dropout=self.preset.get_list('dropout'), strides=self.preset.get_list('strides'), mean_image=self.mean_image)
@@ -42,16 +44,33 @@ class Task(TaskPlan.Task):
         self.solver = Solver(optim_args={'lr': self.preset.get_float("learning_rate"), 'weight_decay': self.preset.get_float("weight_decay")})
         self.solver.set_model(self.model)
         self.train_iterator = iter(self.train_loader)
+        self.epoch = 0
+        self.batches_done = 0
+        # TaskPlan saves every checkpoint into a directory of its own
+        self.checkpoints = CheckpointManager(keep_last=None)
 
     def save(self, path):
-        self.model.save(str(path / "classification_cnn.model"))
+        self.checkpoints.save(path / "checkpoint.pth", {
+            'model': self.model.state_dict(),
+            'optim': self.solver.optim.state_dict(),
+            'rng': get_rng_state(),
+            'epoch': self.epoch,
+            'batches_done': self.batches_done,
+        }, modules={
+            # The pickled model is still written for the notebooks
+            path / "classification_cnn.model": self.model,
+        })
 
     def step(self, tensorboard_writer, current_iteration):
         try:
             acc, loss = self.solver.step(self.model, self.train_iterator)
         except StopIteration:
+            self.epoch += 1
+            self.batches_done = 0
+            self.train_sampler.set_epoch(self.epoch)
             self.train_iterator = iter(self.train_loader)
             acc, loss = self.solver.step(self.model, self.train_iterator)
+        self.batches_done += 1
 
         tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="loss/training", simple_value=loss)]), current_iteration)
         tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/training", simple_value=acc)]), current_iteration)
@@ -62,6 +81,21 @@ class Task(TaskPlan.Task):
             tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="accuracy/val", simple_value=val_acc)]), current_iteration)
 
     def load(self, path):
-        self.model = torch.load(str(path / "classification_cnn.model"))
-        self.model.mean_image = self.mean_image
+        if not (path / "checkpoint.pth").exists():
+            # Checkpoints written before full-state checkpointing only contain the pickled model
+            if not (path / "classification_cnn.model").exists():
+                raise FileNotFoundError('No checkpoint.pth or classification_cnn.model in %s' % path)
+            self.model = torch.load(str(path / "classification_cnn.model"))
+            self.model.mean_image = self.mean_image
+            self.solver.set_model(self.model)
+            return
+
+        state = self.checkpoints.load(path / "checkpoint.pth")
+        self.model.load_state_dict(state['model'])
         self.solver.set_model(self.model)
+        self.solver.optim.load_state_dict(state['optim'])
+        set_rng_state(state['rng'])
+
+        self.epoch, self.batches_done = state['epoch'], state['batches_done']
+        self.train_sampler.set_epoch(self.epoch, self.batches_done * self.preset.get_int('batch_size'))
+        self.train_iterator = iter(self.train_loader)
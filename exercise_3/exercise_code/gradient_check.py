@@ -1,12 +1,17 @@
+import multiprocessing
 import numpy as np
 from random import randrange
 
-def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
+def eval_numerical_gradient(f, x, verbose=True, h=0.00001, num_workers=None):
   """
   a naive implementation of numerical gradient of f at x
   - f should be a function that takes a single argument
   - x is the point (numpy array) to evaluate the gradient at
+  - num_workers: if given, the elements of x are split across this many
+    forked worker processes (see eval_numerical_gradient_parallel)
   """
+  if num_workers is not None:
+    return eval_numerical_gradient_parallel(f, x, h=h, num_workers=num_workers)
 
   fx = f(x) # evaluate function value at original point
   grad = np.zeros_like(x)
@@ -32,11 +37,14 @@ def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
   return grad
 
 
-def eval_numerical_gradient_array(f, x, df, h=1e-5):
+def eval_numerical_gradient_array(f, x, df, h=1e-5, num_workers=None):
   """
   Evaluate a numeric gradient for a function that accepts a numpy
   array and returns a numpy array.
   """
+  if num_workers is not None:
+    return eval_numerical_gradient_parallel(f, x, df=df, h=h, num_workers=num_workers)
+
   grad = np.zeros_like(x)
   it = np.nditer(x, flags=['multi_index'], op_flags=['readwrite'])
   while not it.finished:
@@ -54,6 +62,127 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
   return grad
 
 
+# Function and point of eval_numerical_gradient_parallel; set before the
+# workers are forked so that f does not need to be picklable
+_parallel_args = None
+
+
+def _eval_numerical_gradient_chunk(indices):
+  f, x, df, h = _parallel_args
+  grad = np.zeros(len(indices))
+  for i, flat_ix in enumerate(indices):
+    ix = np.unravel_index(flat_ix, x.shape)
+
+    oldval = x[ix]
+    x[ix] = oldval + h
+    pos = np.copy(f(x))
+    x[ix] = oldval - h
+    neg = np.copy(f(x))
+    x[ix] = oldval
+
+    if df is None:
+      grad[i] = (pos - neg) / (2 * h)
+    else:
+      grad[i] = np.sum((pos - neg) * df) / (2 * h)
+  return grad
+
+
+def eval_numerical_gradient_parallel(f, x, df=None, h=1e-5, num_workers=4):
+  """
+  Elementwise centered differences like eval_numerical_gradient (df=None)
+  and eval_numerical_gradient_array (df given), with the elements of x split
+  across a pool of worker processes.
+
+  The workers are forked, so f may be a lambda and may also read x through
+  a closure instead of its argument; every worker perturbs its own copy of
+  x. Requires a platform that supports fork.
+  """
+  global _parallel_args
+  _parallel_args = (f, x, df, h)
+  chunks = np.array_split(np.arange(x.size), num_workers * 4)
+  try:
+    with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+      grads = pool.map(_eval_numerical_gradient_chunk, chunks)
+  finally:
+    _parallel_args = None
+
+  return np.concatenate(grads).reshape(x.shape).astype(x.dtype)
+
+
+def eval_numerical_gradient_blocked(f, x, df=None, h=1e-5, block_size=64):
+  """
+  Elementwise centered differences evaluated in blocks: the +h and -h
+  perturbations of block_size elements are stacked and passed to f in a
+  single call.
+
+  - f should accept an array of shape (B,) + x.shape holding B stacked
+   inputs and return an array of shape (B,) (scalar functions) or
+   (B,) + df.shape (array functions)
+  - x is the point (numpy array) to evaluate the gradient at
+  - df: upstream derivative for array functions, as in
+   eval_numerical_gradient_array
+
+  Returns the same gradient as eval_numerical_gradient (df=None) or
+  eval_numerical_gradient_array (df given) with 2 * x.size / block_size
+  instead of 2 * x.size calls of f.
+  """
+  grad = np.zeros(x.size, dtype=x.dtype)
+  x_flat = x.reshape(1, -1)
+  for start in range(0, x.size, block_size):
+    indices = np.arange(start, min(start + block_size, x.size))
+    B = len(indices)
+
+    stacked = np.repeat(x_flat, 2 * B, axis=0)
+    stacked[np.arange(B), indices] = x_flat[0, indices] + h
+    stacked[np.arange(B, 2 * B), indices] = x_flat[0, indices] - h
+    out = f(stacked.reshape((2 * B,) + x.shape))
+
+    diff = out[:B] - out[B:]
+    if df is not None:
+      diff = np.sum((diff * df).reshape(B, -1), axis=1)
+    grad[indices] = diff / (2 * h)
+
+  return grad.reshape(x.shape)
+
+
+def grad_check_directional(f, x, analytic_grad, df=None, num_checks=10, h=1e-5):
+  """
+  Check the analytic gradient along random directions instead of single
+  elements (SPSA-style). Every check perturbs all elements of x at once by
+  h * v for a random +-1 direction v and compares the centered difference
+  with the directional derivative analytic_grad . v, so a check costs two
+  calls of f independent of the size of x.
+
+  Like eval_numerical_gradient, x is perturbed in place, so f may also read
+  x through a closure. If df is given, f returns an array and the
+  derivative of np.sum(f(x) * df) is checked, as in
+  eval_numerical_gradient_array.
+
+  Returns the largest relative error over all checks.
+  """
+  x_orig = x.copy()
+  max_error = 0
+  for i in range(num_checks):
+    v = np.random.choice([-1.0, 1.0], size=x.shape)
+
+    np.copyto(x, x_orig + h * v)
+    pos = np.copy(f(x))
+    np.copyto(x, x_orig - h * v)
+    neg = np.copy(f(x))
+    np.copyto(x, x_orig)
+
+    if df is None:
+      grad_numerical = (pos - neg) / (2 * h)
+    else:
+      grad_numerical = np.sum((pos - neg) * df) / (2 * h)
+    grad_analytic = np.sum(analytic_grad * v)
+    rel_error = abs(grad_numerical - grad_analytic) / max(abs(grad_numerical) + abs(grad_analytic), 1e-12)
+    max_error = max(max_error, rel_error)
+    print('numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error))
+
+  return max_error
+
+
 def eval_numerical_gradient_blobs(f, inputs, output, h=1e-5):
   """
   Compute numeric gradients for a function that operates on input
@@ -1,6 +1,7 @@
 import sys
 
 from exercise_code.solver_keypoint import SolverKeyPoint
+from exercise_code.checkpoint import CheckpointManager, ResumableRandomSampler, get_rng_state, set_rng_state
 
 sys.path.append('../../')
 import TaskPlan
@@ -67,11 +68,22 @@ class KeyPointTask(TaskPlan.Task):
         #self.optimizer = optim.SGD(self.model.parameters(), lr=0.01, momentum=0.9, weight_decay=1e-6, nesterov=True)
         self.train_loaders = []
         for transformed_dataset in transformed_datasets:
-            self.train_loaders.append(DataLoader(transformed_dataset, batch_size=self.preset.get_int("batch_size"), shuffle=True, num_workers=0, drop_last=True))
+            self.train_loaders.append(DataLoader(transformed_dataset, batch_size=self.preset.get_int("batch_size"), sampler=ResumableRandomSampler(transformed_dataset), num_workers=0, drop_last=True))
         self.train_iterators = [iter(train_loader) for train_loader in self.train_loaders]
+        # TaskPlan saves every checkpoint into a directory of its own
+        self.checkpoints = CheckpointManager(keep_last=None)
 
     def save(self, path):
-        self.model.save(str(path / "keypoints_nn.model"))
+        self.checkpoints.save(path / "checkpoint.pth", {
+            'model': self.model.state_dict(),
+            'optim': [optimizer.state_dict() for optimizer in self.solver.optim],
+            'rng': get_rng_state(),
+            'epochs': self.solver.epochs,
+            'batches_done': self.solver.batches_done,
+        }, modules={
+            # The pickled model is still written for the notebooks
+            path / "keypoints_nn.model": self.model,
+        })
 
     def step(self, tensorboard_writer, current_iteration):
         loss, metric, losses = self.solver.step(self.model, self.train_iterators, self.train_loaders)
@@ -88,5 +100,22 @@ class KeyPointTask(TaskPlan.Task):
             tensorboard_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="metric/val", simple_value=val_metric)]), current_iteration)
 
     def load(self, path):
-        self.model = torch.load(str(path / "keypoints_nn.model"))
+        if not (path / "checkpoint.pth").exists():
+            # Checkpoints written before full-state checkpointing only contain the pickled model
+            if not (path / "keypoints_nn.model").exists():
+                raise FileNotFoundError('No checkpoint.pth or keypoints_nn.model in %s' % path)
+            self.model = torch.load(str(path / "keypoints_nn.model"))
+            self.solver.set_model(self.model)
+            return
+
+        state = self.checkpoints.load(path / "checkpoint.pth")
+        self.model.load_state_dict(state['model'])
         self.solver.set_model(self.model)
+        for optimizer, optimizer_state in zip(self.solver.optim, state['optim']):
+            optimizer.load_state_dict(optimizer_state)
+        set_rng_state(state['rng'])
+
+        self.solver.epochs, self.solver.batches_done = state['epochs'], state['batches_done']
+        for i, train_loader in enumerate(self.train_loaders):
+            train_loader.sampler.set_epoch(self.solver.epochs[i], self.solver.batches_done[i] * self.preset.get_int("batch_size"))
+        self.train_iterators = [iter(train_loader) for train_loader in self.train_loaders]
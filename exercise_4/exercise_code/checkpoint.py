@@ -0,0 +1,221 @@
+"""Asynchronous full-state checkpointing for the PyTorch tasks."""
+import collections
+import copy
+import itertools
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+def _snapshot(obj):
+    """
+    Recursively copy every tensor in obj to host memory so that training can
+    keep mutating the originals.
+
+    CUDA tensors are copied with non_blocking=True; the copy is ordered on the
+    current stream, so later kernels cannot overwrite the values before they
+    have been read, and the writer thread synchronizes on a CUDA event before
+    serializing. CPU tensors are cloned.
+    """
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            return obj.detach().to('cpu', non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return obj.__class__((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_snapshot(v) for v in obj)
+    return obj
+
+
+def _snapshot_module(module):
+    """
+    Copy an nn.Module for pickling it whole, with its parameters and buffers
+    replaced by host snapshots as in _snapshot. Only the python structure of
+    the module is deep-copied; the live tensors are never read again, so the
+    copy can be pickled while training continues.
+    """
+    memo = {}
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        if id(tensor) in memo:
+            continue
+        snapshot = _snapshot(tensor)
+        if isinstance(tensor, torch.nn.Parameter):
+            snapshot = torch.nn.Parameter(snapshot, requires_grad=tensor.requires_grad)
+        memo[id(tensor)] = snapshot
+    return copy.deepcopy(module, memo)
+
+
+def get_rng_state():
+    """
+    Capture the state of the python, numpy and torch random number generators.
+    The numpy state is stored as a tensor so the checkpoint only contains torch
+    and python builtin types.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    Restore the random number generators from a state created by
+    get_rng_state().
+    """
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler whose permutation only depends on (seed, epoch), so the
+    position of a data iterator can be checkpointed as (epoch, start) and
+    replayed without touching the samples that were already consumed.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        Select the permutation used by the next iterator and the index inside
+        that permutation to start from.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+class CheckpointManager(object):
+    """
+    Writes checkpoints of state_dicts from a background thread.
+
+    save() takes a consistent host-side snapshot of the given state and returns
+    immediately; pickling and disk I/O happen on a writer thread. Every file is
+    first written to a temporary file and then moved into place, so a crash
+    never leaves a truncated checkpoint behind. In every directory, only the
+    last keep_last checkpoints written there by this manager are kept on disk.
+    Whole modules, e.g. for code that loads a model with torch.load, can be
+    written along with a checkpoint in the same way.
+
+    Example usage:
+
+    manager = CheckpointManager(keep_last=3)
+    manager.save(path, {'model': model.state_dict(), 'optim': optim.state_dict()})
+    ...
+    state = manager.load(path)
+    model.load_state_dict(state['model'])
+    optim.load_state_dict(state['optim'])
+    """
+
+    def __init__(self, keep_last=3):
+        """
+        Inputs:
+        - keep_last: Number of checkpoints to keep per directory; older
+          checkpoints written into the same directory by this manager are
+          deleted. None keeps all of them.
+        """
+        self.keep_last = keep_last
+        self._written = collections.defaultdict(collections.deque)
+        self._thread = None
+        self._error = None
+
+    def save(self, path, state, modules=None):
+        """
+        Snapshot state and write it to path in the background. If the previous
+        checkpoint is still being written, this waits for it first.
+
+        Inputs:
+        - path: path string of the checkpoint file
+        - state: (nested) dictionary of tensors and python objects, usually
+          made of state_dicts
+        - modules: Optional dictionary mapping path strings to nn.Modules that
+          are pickled whole with torch.save. Their tensors are snapshotted to
+          the host like state, so the pickled modules load on the CPU. They
+          are not counted by keep_last.
+        """
+        snapshot = _snapshot(state)
+        module_snapshots = {str(p): _snapshot_module(m) for p, m in (modules or {}).items()}
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(str(path), snapshot, module_snapshots, event))
+        self._thread.start()
+
+    def wait(self):
+        """
+        Block until the pending checkpoint is on disk. Errors raised by the
+        writer thread are re-raised here.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def load(self, path):
+        """
+        Load a checkpoint written by save(). Tensors are mapped to the CPU;
+        load_state_dict() moves them to the device of the target module.
+        """
+        self.wait()
+        return torch.load(str(path), map_location='cpu')
+
+    @staticmethod
+    def _write_file(path, obj):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write(self, path, snapshot, module_snapshots, event):
+        try:
+            if event is not None:
+                event.synchronize()
+
+            for module_path, module in module_snapshots.items():
+                self._write_file(module_path, module)
+            self._write_file(path, snapshot)
+
+            written = self._written[os.path.dirname(os.path.abspath(path))]
+            if path in written:
+                written.remove(path)
+            written.append(path)
+            while self.keep_last is not None and len(written) > self.keep_last:
+                old_path = written.popleft()
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+        except Exception as e:
+            self._error = e
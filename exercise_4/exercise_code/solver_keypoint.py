@@ -20,6 +20,8 @@ class SolverKeyPoint(object):
         self.loss_func = loss_func
 
         self._reset_histories()
+        self.epochs = [0] * 15
+        self.batches_done = [0] * 15
 
     def _reset_histories(self):
         """
@@ -60,9 +62,14 @@ class SolverKeyPoint(object):
             try:
                 batch = next(train_iterators[i])
             except StopIteration:
+                self.epochs[i] += 1
+                self.batches_done[i] = 0
+                if hasattr(train_loaders[i].sampler, 'set_epoch'):
+                    train_loaders[i].sampler.set_epoch(self.epochs[i])
                 train_iterators[i] = iter(train_loaders[i])
                 batch = next(train_iterators[i])
                 print("restart")
+            self.batches_done[i] += 1
 
             model.train()
 